@@ -0,0 +1,93 @@
+"""
+Resolution of coordinates to the areas of the administrative levels.
+The areas of each level (italy-<level>.json, the geojson used by
+PlotUtils.getArea) are indexed once in a STRtree and reindexed when the
+geojson changes: a lookup tests only the areas whose bounding box contains
+the point, with prepared geometries.
+"""
+import threading
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import geopandas as gpd
+from highlander.endpoints.utils import MapCropConfig
+from restapi.utilities.logs import log
+from shapely.geometry import Point
+from shapely.prepared import prep
+from shapely.strtree import STRtree
+
+LEVELS = ["regions", "provinces", "basins", "municipalities"]
+
+
+def get_geojson_path(level: str) -> Path:
+    return Path(MapCropConfig.GEOJSON_PATH, f"italy-{level}.json")
+
+
+class AreaIndex:
+    """
+    Spatial index of the areas of an administrative level
+    """
+
+    def __init__(self, level: str, mtime_ns: int) -> None:
+        self.mtime_ns = mtime_ns
+        areas = gpd.read_file(get_geojson_path(level))
+        if areas.crs and not areas.crs.is_geographic:
+            areas = areas.to_crs(epsg=4326)
+        # the polygons of the same area are merged as in PlotUtils.getAreas
+        areas = areas.dissolve(by="name")
+        areas = areas[~areas.geometry.is_empty]
+        self.names: List[str] = list(areas.index)
+        self.geometries = list(areas.geometry)
+        self.prepared = [prep(g) for g in self.geometries]
+        self.tree = STRtree(self.geometries)
+        # the tree returns the indexed geometries
+        self.positions = {id(g): i for i, g in enumerate(self.geometries)}
+
+    def lookup(self, latitude: float, longitude: float) -> Optional[str]:
+        """
+        Name of the area containing the point, if any
+        """
+        point = Point(longitude, latitude)
+        for geometry in self.tree.query(point):
+            i = self.positions[id(geometry)]
+            # the points on the borders are assigned to the first area
+            if self.prepared[i].covers(point):
+                return self.names[i]
+        return None
+
+
+_indexes: Dict[str, AreaIndex] = {}
+_lock = threading.Lock()
+
+
+def get_area_index(level: str) -> AreaIndex:
+    """
+    :raises FileNotFoundError: if there is no geojson for the level
+    """
+    mtime_ns = get_geojson_path(level).stat().st_mtime_ns
+    with _lock:
+        index = _indexes.get(level)
+        if index is None or index.mtime_ns != mtime_ns:
+            log.info("Indexing the areas of {}", level)
+            index = AreaIndex(level, mtime_ns)
+            _indexes[level] = index
+    return index
+
+
+def resolve_points(
+    points: Iterable[Tuple[float, float]], levels: Iterable[str]
+) -> List[Dict[str, Optional[str]]]:
+    """
+    Areas containing the points (latitude, longitude) for each level.
+    The levels without a geojson are skipped
+    """
+    indexes = {}
+    for level in levels:
+        try:
+            indexes[level] = get_area_index(level)
+        except FileNotFoundError:
+            log.warning("No geojson found for level {}", level)
+    return [
+        {level: index.lookup(lat, lon) for level, index in indexes.items()}
+        for lat, lon in points
+    ]
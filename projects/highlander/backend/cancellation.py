@@ -0,0 +1,48 @@
+"""
+Cancellation of the user requests.
+Queued tasks are revoked, running tasks are flagged as cancelled and check
+the flag between their steps to stop and remove their partial outputs
+"""
+from typing import Any
+
+from highlander.exceptions import RequestCancelled
+from restapi.connectors import celery, redis
+from restapi.utilities.logs import log
+
+# the flags outlive the tasks waiting in the queues
+CANCELLATION_TTL = 7 * 86400
+
+
+def cancellation_key(request_id: int) -> str:
+    return f"highlander:cancelled:{request_id}"
+
+
+def cancel_request(request: Any) -> None:
+    """
+    Flag the request as cancelled and revoke its task
+    """
+    try:
+        redis.get_instance().r.set(cancellation_key(request.id), 1, ex=CANCELLATION_TTL)
+    except Exception as exc:
+        log.warning("Unable to flag request {} as cancelled: {}", request.id, exc)
+    if request.task_id:
+        # a revoked task still waiting in the queue is discarded by the workers
+        celery.get_instance().celery_app.control.revoke(request.task_id)
+
+
+def is_cancelled(request_id: int) -> bool:
+    try:
+        return bool(redis.get_instance().r.exists(cancellation_key(request_id)))
+    except Exception as exc:
+        log.warning(
+            "Unable to check the cancellation of request {}: {}", request_id, exc
+        )
+        return False
+
+
+def check_cancelled(request_id: int) -> None:
+    """
+    :raises RequestCancelled: if the request has been cancelled
+    """
+    if is_cancelled(request_id):
+        raise RequestCancelled(f"Request ID<{request_id}> cancelled")
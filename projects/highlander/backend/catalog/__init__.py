@@ -1,26 +1,45 @@
 import os.path
 import pathlib
-from typing import Any, List
+import threading
+from typing import Any, Dict, List, Optional, Tuple
 
 import yaml
+from highlander.constants import CATALOG_DIR
 from highlander.models.schemas import DatasetInfo
 from marshmallow import ValidationError
 from restapi.utilities.logs import log
 
+CATALOG_EXT_PATH = CATALOG_DIR.joinpath("catalog-ext.yaml")
+
+# catalog file and dataset files with their modification times
+Signature = Tuple[Tuple[str, Optional[float]], ...]
+
+
+def get_mtime(path: str) -> Optional[float]:
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return None
+
 
 class CatalogExt:
     """
-    Class for DDS catalog extension
+    Class for DDS catalog extension.
+    The catalog is parsed once and reloaded when the catalog file or
+    one of the dataset files change
     """
 
+    # parsed catalogs by path: signature, datasets and datasets by id
+    _cache: Dict[str, Tuple[Signature, List[Any], Dict[str, Any]]] = {}
+    _lock = threading.Lock()
+
     def __init__(self, path: str) -> None:
         file = pathlib.Path(path)
         if not file.exists():
             raise ValueError(f"Invalid config file: <{path}>")
-        self.path = path
+        self.path = str(path)
 
-    def get_datasets(self) -> List:
-        res = []
+    def get_dataset_paths(self) -> List[str]:
         paths = []
         with open(self.path) as f:
             try:
@@ -39,6 +58,11 @@ def get_datasets(self) -> List:
             except yaml.YAMLError as exc:
                 log.error(exc)
                 # FIXME (?)
+        return paths
+
+    @staticmethod
+    def load_datasets(paths: List[str]) -> List[Any]:
+        res = []
         for path in paths:
             with open(path) as f:
                 try:
@@ -59,9 +83,49 @@ def get_datasets(self) -> List:
                     log.error(exc)
         return res
 
+    def load(self) -> Tuple[List[Any], Dict[str, Any]]:
+        cached = self._cache.get(self.path)
+        if cached:
+            signature, datasets, index = cached
+            # the cached catalog is valid until one of its files changes
+            if all(get_mtime(path) == mtime for path, mtime in signature):
+                return datasets, index
+
+        with self._lock:
+            catalog_mtime = get_mtime(self.path)
+            paths = self.get_dataset_paths()
+            signature = ((self.path, catalog_mtime),) + tuple(
+                (path, get_mtime(path)) for path in paths
+            )
+            cached = self._cache.get(self.path)
+            if cached and cached[0] == signature:
+                return cached[1], cached[2]
+            datasets = self.load_datasets(paths)
+            index = {d["id"]: d for d in datasets}
+            self._cache[self.path] = (signature, datasets, index)
+            log.info("Catalog extension loaded from {}", self.path)
+        return datasets, index
+
+    def get_datasets(self) -> List:
+        # copy the list: the callers can extend it
+        return list(self.load()[0])
+
+    def get_dataset(self, dataset_id: str) -> Optional[Any]:
+        return self.load()[1].get(dataset_id)
+
     def get_dataset_content_filename(self, dataset_id: str, content_type: str) -> Any:
-        datasets = self.get_datasets()
-        found = next(v for v in datasets if v["id"] == dataset_id)
+        found = self.get_dataset(dataset_id)
         if not found:
             raise LookupError(f"Dataset <{dataset_id}> does not exist")
         return found.get(content_type)
+
+
+def get_catalog_ext() -> Optional[CatalogExt]:
+    """
+    The catalog extension, if any
+    """
+    try:
+        return CatalogExt(path=str(CATALOG_EXT_PATH))
+    except ValueError:
+        # for missing or invalid cat_ext
+        return None
@@ -14,6 +14,8 @@
 from dds_backend.core.base.ex import DMSKeyError
 from dds_backend.core.base.log_utils import LogObject
 from dds_backend.core.base.util import Query
+from highlander.catalog import get_catalog_ext
+from highlander.output_formats import FORMATS
 from restapi.connectors import Connector, ExceptionsList
 from restapi.utilities.logs import log
 
@@ -116,28 +118,28 @@ def get_uncached_datasets(self) -> Optional[List[str]]:
         self.broker.cache_files = self.reading_cache_config()
 
         dataset_names = list(self.broker.list_datasets().keys())
-        dataset_wout_cache: List[str] = []
-        for dn in dataset_names:
-            # check if all the products in the dataset have a cache
-            for product in self.broker.open_catalog(self.broker.catalog[dn].path):
-                product_key = self.broker.generate_product_key(
-                    dataset_name=dn, product_type=product
-                )
-                if (
-                    product_key not in self.broker.cache_files
-                    or not Path(self.broker.cache_files[product_key]).exists()
-                ):
-                    dataset_wout_cache.append(dn)
-                    break
-        return dataset_wout_cache
+        return [dn for dn in dataset_names if not self.is_dataset_cached(dn)]
+
+    def is_dataset_cached(self, dataset_name: str) -> bool:
+        # check if all the products in the dataset have a cache
+        for product in self.broker.open_catalog(self.broker.catalog[dataset_name].path):
+            product_key = self.broker.generate_product_key(
+                dataset_name=dataset_name, product_type=product
+            )
+            if (
+                product_key not in self.broker.cache_files
+                or not Path(self.broker.cache_files[product_key]).exists()
+            ):
+                return False
+        return True
 
     def get_datasets(self, filter_dataset_ids: List[str] = []) -> Dict[str, Any]:
         dataset_names = list(self.broker.list_datasets().keys())
         if filter_dataset_ids:
             dataset_names = [x for x in dataset_names if x in filter_dataset_ids]
-        # discard the datasets without a cache
-        dataset_wout_cache = self.get_uncached_datasets()
-        dataset_names = [x for x in dataset_names if x not in dataset_wout_cache]
+        # discard the datasets without a cache, checking only the requested ones
+        self.broker.cache_files = self.reading_cache_config()
+        dataset_names = [x for x in dataset_names if self.is_dataset_cached(x)]
         res: Dict[str, Any] = {}
         for dn in dataset_names:
             try:
@@ -492,9 +494,10 @@ def get_product_for_dataset(
 
         # Format
         if "format" not in exclude_widgets:
+            # the formats for a location only are validated with the request
             format_list = [
-                {"value": "netcdf", "label": "Netcdf", "ext": ".nc"},
-                # {'value': 'pickle', 'label': 'Pickle', 'ext': '.pickle'}
+                {"value": value, "label": fmt["label"], "ext": fmt["ext"]}
+                for value, fmt in FORMATS.items()
             ]
             w = Widget(
                 wname="format",
@@ -509,11 +512,28 @@ def get_product_for_dataset(
 
         return data
 
+    @staticmethod
+    def get_ext_datasets() -> List[Any]:
+        """
+        The datasets of the external applications, from the catalog extension
+        """
+        cat_ext = get_catalog_ext()
+        return cat_ext.get_datasets() if cat_ext else []
+
+    @staticmethod
+    def get_ext_dataset(dataset_id: str) -> Optional[Any]:
+        cat_ext = get_catalog_ext()
+        return cat_ext.get_dataset(dataset_id) if cat_ext else None
+
     def get_dataset_content_filename(self, dataset_id: str, content_type: str) -> Any:
         datasets = self.get_datasets([dataset_id])
-        if dataset_id not in datasets:
+        if dataset_id in datasets:
+            return datasets[dataset_id]["dataset_info"].get(content_type)
+        log.debug("Dataset <{}> NOT managed locally", dataset_id)
+        cat_ext = get_catalog_ext()
+        if not cat_ext:
             raise LookupError(f"Dataset <{dataset_id}> does not exist")
-        return datasets[dataset_id]["dataset_info"].get(content_type)
+        return cat_ext.get_dataset_content_filename(dataset_id, content_type)
 
     @staticmethod
     def unwrap(obj: Any) -> Any:
@@ -0,0 +1,231 @@
+"""
+In-memory index of the coordinates of the dataset products.
+The extraction requests are validated and normalized against the index
+before being submitted, so that the requests out of the product coverage are
+rejected without enqueueing a task or opening the data.
+The index is built from the broker details of the products and rebuilt when
+the broker cache changes.
+"""
+import os
+import threading
+from datetime import datetime
+from typing import Any, Dict, List, Mapping, Optional, Set, Tuple
+
+import numpy as np
+from restapi.exceptions import BadRequest, NotFound
+from restapi.utilities.logs import log
+
+MAIN_COORDS = {"time", "latitude", "longitude"}
+TIME_LIMITS = {"month": (1, 12), "day": (1, 31), "hour": (0, 23)}
+
+
+def unwrap(obj: Any) -> Any:
+    if isinstance(obj, (set, list)):
+        return next(iter(obj))
+    return obj
+
+
+def to_datetime(value: Any) -> datetime:
+    return np.datetime64(unwrap(value)).astype("M8[h]").astype("O")
+
+
+class ProductCoordinates:
+    """
+    Coverage of a product: time range, grid bounds and resolution,
+    values of the auxiliary coordinates and variables
+    """
+
+    def __init__(self, product: Mapping[str, Any]) -> None:
+        coords = product.get("coordinates", {})
+        self.variables: Set[str] = set(product.get("variables", {}))
+        self.time_range: Optional[Tuple[datetime, datetime]] = None
+        if "time" in coords:
+            time = coords["time"]
+            self.time_range = (
+                to_datetime(sorted(time["min"])[0]),
+                to_datetime(sorted(time["max"], reverse=True)[0]),
+            )
+        # bounds and resolution of the grid
+        self.bounds: Dict[str, Tuple[float, float]] = {}
+        self.resolution: Dict[str, float] = {}
+        for coord in ("latitude", "longitude"):
+            if coord not in coords:
+                continue
+            min_ = float(unwrap(coords[coord]["min"]))
+            max_ = float(unwrap(coords[coord]["max"]))
+            self.bounds[coord] = (min_, max_)
+            size = unwrap(coords[coord].get("dds_nb_elements", 0)) or 0
+            self.resolution[coord] = (max_ - min_) / (size - 1) if size > 1 else 0
+        self.aux_values: Dict[str, List[Any]] = {
+            coord: list(values["value"])
+            for coord, values in coords.items()
+            if coord not in MAIN_COORDS and "value" in values
+        }
+
+    def check_variables(self, variables: List[str]) -> None:
+        unknown = set(variables) - self.variables
+        if self.variables and unknown:
+            raise BadRequest(f"Unknown variables: {', '.join(sorted(unknown))}")
+
+    def normalize_time(self, time: Dict[str, List[str]]) -> Dict[str, List[str]]:
+        if not self.time_range:
+            raise BadRequest("The product has no time coordinate")
+        start, stop = self.time_range
+        normalized: Dict[str, List[str]] = {}
+        for key, values in time.items():
+            try:
+                numbers = sorted({int(v) for v in values})
+            except ValueError:
+                raise BadRequest(f"Invalid {key} values: {values}")
+            min_, max_ = TIME_LIMITS.get(key, (start.year, stop.year))
+            invalid = [v for v in numbers if not min_ <= v <= max_]
+            if invalid:
+                raise BadRequest(
+                    f"{key.capitalize()} out of the product coverage "
+                    f"[{min_}, {max_}]: {invalid}"
+                )
+            # keep the original format of the values (e.g. zero padded hours)
+            normalized[key] = sorted(set(values), key=int)
+        return normalized
+
+    def normalize_longitude(self, longitude: float) -> float:
+        """
+        Longitude in the convention of the product grid ([0, 360] or [-180, 180])
+        """
+        lon_min, lon_max = self.bounds["longitude"]
+        if lon_max > 180 and longitude < 0:
+            return longitude + 360
+        if lon_min < 0 and longitude > 180:
+            return longitude - 360
+        return longitude
+
+    def normalize_area(self, area: Dict[str, float]) -> Dict[str, float]:
+        if not self.bounds:
+            raise BadRequest("The product has no spatial coordinates")
+        south, north = sorted((area["south"], area["north"]))
+        lat_min, lat_max = self.bounds["latitude"]
+        lon_min, lon_max = self.bounds["longitude"]
+        west = self.normalize_longitude(area["west"])
+        east = self.normalize_longitude(area["east"])
+        # the west and east bounds are not swapped: an area crossing the
+        # antimeridian would become a different area
+        if west > east:
+            raise BadRequest(
+                "Invalid area: the west bound is greater than the east bound"
+            )
+        if north < lat_min or south > lat_max or east < lon_min or west > lon_max:
+            raise BadRequest("Area out of the product coverage")
+        # clip the area to the grid
+        return {
+            "north": min(north, lat_max),
+            "south": max(south, lat_min),
+            "east": min(east, lon_max),
+            "west": max(west, lon_min),
+        }
+
+    def check_location(self, location: Mapping[str, Any]) -> None:
+        if not self.bounds:
+            raise BadRequest("The product has no spatial coordinates")
+        for coord in ("latitude", "longitude"):
+            try:
+                value = float(location[coord])
+            except (KeyError, TypeError, ValueError):
+                raise BadRequest(f"Invalid location: missing {coord}")
+            min_, max_ = self.bounds[coord]
+            # the nearest grid cell can be half a cell outside the bounds
+            margin = self.resolution.get(coord, 0) / 2
+            if not min_ - margin <= value <= max_ + margin:
+                raise BadRequest(
+                    f"Location {coord} out of the product coverage [{min_}, {max_}]"
+                )
+
+    def check_aux_coord(self, coord: str, values: Any) -> None:
+        allowed = self.aux_values[coord]
+        if isinstance(values, dict):
+            # range of values
+            try:
+                requested = [
+                    float(v)
+                    for v in (values.get("start"), values.get("stop"))
+                    if v is not None
+                ]
+                min_, max_ = min(map(float, allowed)), max(map(float, allowed))
+            except (TypeError, ValueError):
+                raise BadRequest(f"Invalid {coord} range: {values}")
+            if requested and (max(requested) < min_ or min(requested) > max_):
+                raise BadRequest(f"{coord} range out of the product coverage")
+            return
+        if not isinstance(values, list):
+            values = [values]
+        allowed_keys = {str(v) for v in allowed}
+        invalid = [v for v in values if str(v) not in allowed_keys]
+        if invalid:
+            raise BadRequest(f"Invalid {coord} values: {invalid}")
+
+    def normalize(self, args: Mapping[str, Any]) -> Dict[str, Any]:
+        """
+        Check the request against the coverage of the product.
+        Returns the normalized request
+        """
+        normalized = dict(args)
+        if "variable" in args:
+            self.check_variables(args["variable"])
+        if args.get("time"):
+            normalized["time"] = self.normalize_time(args["time"])
+        if args.get("area"):
+            normalized["area"] = self.normalize_area(args["area"])
+        if args.get("location"):
+            self.check_location(args["location"])
+        for coord in self.aux_values:
+            if coord in args:
+                self.check_aux_coord(coord, args[coord])
+        return normalized
+
+
+class CoordinateIndex:
+    def __init__(self) -> None:
+        self.products: Dict[Tuple[str, str], ProductCoordinates] = {}
+        self.signature: Optional[float] = None
+        self.lock = threading.Lock()
+
+    def get(self, dds: Any, dataset_name: str, product: str) -> ProductCoordinates:
+        # the details of the products change only with the broker cache
+        signature = get_cache_signature(dds)
+        key = (dataset_name, product)
+        with self.lock:
+            if signature != self.signature:
+                self.products.clear()
+                self.signature = signature
+            if key not in self.products:
+                datasets = dds.get_datasets([dataset_name])
+                if dataset_name not in datasets:
+                    raise NotFound(f"Dataset <{dataset_name}> does not exist")
+                products = datasets[dataset_name]["products"]
+                if product not in products:
+                    raise NotFound(
+                        f"Product <{product}> of dataset <{dataset_name}> "
+                        "does not exist"
+                    )
+                log.debug("Indexing the coordinates of {}:{}", dataset_name, product)
+                self.products[key] = ProductCoordinates(products[product])
+            return self.products[key]
+
+
+def get_cache_signature(dds: Any) -> Optional[float]:
+    try:
+        return os.stat(dds.broker.cache_config_file).st_mtime
+    except OSError:
+        return None
+
+
+index = CoordinateIndex()
+
+
+def normalize_request(
+    dds: Any, dataset_name: str, args: Mapping[str, Any]
+) -> Dict[str, Any]:
+    """
+    Validate an extraction request against the coordinates of the product
+    """
+    product = index.get(dds, dataset_name, args["product_type"])
+    return product.normalize(args)
@@ -0,0 +1,264 @@
+"""
+Manifest of the cached crop outputs (cropped data, maps, plots, climate stripes
+and reports).
+Each output is recorded with the version of its source file (mtime and size),
+the version of the legend of the map and the version of the renderer.
+A cached output is served while its source and the renderer are unchanged,
+otherwise it is rendered again. The purge_crops task removes the outputs with
+a changed source, legend or renderer, the reports replaced by newer ones and
+the untracked outputs, so that the crops tree doesn't have to be deleted after
+the data updates.
+The outputs served by the endpoints are marked as accessed: the evict_crops task
+keeps the crops tree under CROPS_DISK_BUDGET and the outputs of the datasets
+under their quotas (CROPS_DATASET_QUOTAS) removing the least recently used ones.
+"""
+import hashlib
+import json
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, List, Mapping, Optional, Set, Tuple
+
+from highlander.retention import parse_dataset_values
+from restapi.connectors import sqlalchemy
+from restapi.env import Env
+from restapi.utilities.logs import log
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.sql import func
+
+# to be increased when the rendering of the outputs changes:
+# all the cached outputs become stale
+RENDERER_VERSION = "1"
+# extensions of the cached outputs (the reports have the maps as source)
+# and of the cropped data they are plotted from
+OUTPUT_EXTENSIONS = {".png", ".webp", ".json", ".pdf", ".nc"}
+# the untracked outputs younger than this (seconds) may be still recording,
+# the replaced reports may be still downloading
+UNTRACKED_GRACE_PERIOD = 3600
+# the reports of an area are named <area>_report_<key>.pdf
+REPORT_MARKER = "_report_"
+# the accesses are recorded at most once in this interval (seconds) by output
+ACCESS_RECORD_INTERVAL = 3600
+
+# maximum size (bytes) of the crops tree and of the outputs of the datasets,
+# in the form dataset:bytes,dataset:bytes (0 or missing for no limit)
+CROPS_DISK_BUDGET = Env.get_int("CROPS_DISK_BUDGET", 0)
+CROPS_DATASET_QUOTAS = parse_dataset_values(Env.get("CROPS_DATASET_QUOTAS", ""))
+
+SourceVersion = Tuple[float, int]
+
+
+def get_source_version(source_path: Path) -> Optional[SourceVersion]:
+    try:
+        stat = source_path.stat()
+    except OSError:
+        return None
+    return stat.st_mtime, stat.st_size
+
+
+def get_legend_version(levels: List[float]) -> str:
+    return hashlib.sha1(json.dumps(levels).encode()).hexdigest()[:16]
+
+
+def record_output(
+    path: Path,
+    source_path: Optional[Path],
+    legend_layer: Optional[str] = None,
+    legend_levels: Optional[List[float]] = None,
+    dataset_id: Optional[str] = None,
+) -> None:
+    """
+    Record a rendered output with the versions of its sources
+    """
+    if source_path is None:
+        log.warning("Output {} not recorded: unknown source", path)
+        return
+    source_version = get_source_version(source_path)
+    if source_version is None:
+        return
+    db = sqlalchemy.get_instance()
+    artifact = db.CropArtifact.query.filter_by(path=str(path)).first()
+    if artifact is None:
+        artifact = db.CropArtifact(path=str(path))
+        db.session.add(artifact)
+    artifact.source_path = str(source_path)
+    artifact.source_mtime, artifact.source_size = source_version
+    artifact.legend_layer = legend_layer
+    artifact.legend_version = (
+        get_legend_version(legend_levels) if legend_levels else None
+    )
+    artifact.renderer_version = RENDERER_VERSION
+    artifact.dataset_id = dataset_id
+    artifact.size = path.stat().st_size
+    artifact.last_access = datetime.utcnow()
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # recorded at the same time by another worker
+        db.session.rollback()
+
+
+def is_current(artifact: Any) -> bool:
+    source_version = get_source_version(Path(artifact.source_path))
+    return artifact.renderer_version == RENDERER_VERSION and source_version == (
+        artifact.source_mtime,
+        artifact.source_size,
+    )
+
+
+def is_fresh(path: Path) -> bool:
+    """
+    Check if a cached output exists and is up to date with its source
+    """
+    if not path.is_file() or path.stat().st_size < 1:
+        return False
+    db = sqlalchemy.get_instance()
+    artifact = db.CropArtifact.query.filter_by(path=str(path)).first()
+    # the untracked outputs (e.g. rendered before the manifest) are rendered again
+    if artifact is None or not is_current(artifact):
+        return False
+    record_access(db, artifact)
+    return True
+
+
+def record_access(db: Any, artifact: Any) -> None:
+    """
+    Mark an output as used, for the eviction of the least recently used ones
+    """
+    now = datetime.utcnow()
+    last_access = artifact.last_access or artifact.rendered
+    # the frequent accesses don't need a write each
+    if last_access and now - last_access < timedelta(seconds=ACCESS_RECORD_INTERVAL):
+        return
+    artifact.last_access = now
+    db.session.commit()
+
+
+def get_report_group(path: Path) -> Optional[str]:
+    """
+    The reports of the same area in the same directory have the same group
+    """
+    if path.suffix != ".pdf" or REPORT_MARKER not in path.name:
+        return None
+    return str(path.with_name(path.name.rsplit(REPORT_MARKER, 1)[0]))
+
+
+def remove_output(db: Any, artifact: Any) -> None:
+    Path(artifact.path).unlink(missing_ok=True)
+    db.session.delete(artifact)
+
+
+def purge_outputs(
+    roots: Iterable[Path], get_legend_levels: Callable[[str], List[float]]
+) -> Tuple[int, int]:
+    """
+    Remove the stale and the untracked outputs of the crops trees.
+    Returns the number of removed stale and untracked outputs
+    """
+    db = sqlalchemy.get_instance()
+    legend_versions: Dict[str, Optional[str]] = {}
+    stale = 0
+    tracked: Set[str] = set()
+    artifacts = db.CropArtifact.query.all()
+    # the latest report of each area replaces the older ones
+    latest_reports: Dict[str, datetime] = {}
+    for artifact in artifacts:
+        group = get_report_group(Path(artifact.path))
+        if group and artifact.rendered > latest_reports.get(group, datetime.min):
+            latest_reports[group] = artifact.rendered
+    replaced_before = datetime.utcnow() - timedelta(seconds=UNTRACKED_GRACE_PERIOD)
+    for artifact in artifacts:
+        outdated = not Path(artifact.path).is_file() or not is_current(artifact)
+        group = get_report_group(Path(artifact.path))
+        if not outdated and group:
+            outdated = (
+                artifact.rendered < latest_reports[group]
+                and artifact.rendered < replaced_before
+            )
+        if not outdated and artifact.legend_layer:
+            layer = artifact.legend_layer
+            if layer not in legend_versions:
+                try:
+                    levels = get_legend_levels(layer)
+                except Exception as exc:
+                    log.warning("Unable to get the legend of {}: {}", layer, exc)
+                    levels = []
+                # without the legend it is checked again at the next purge
+                legend_versions[layer] = get_legend_version(levels) if levels else None
+            version = legend_versions[layer]
+            outdated = version is not None and version != artifact.legend_version
+        if outdated:
+            remove_output(db, artifact)
+            stale += 1
+        else:
+            tracked.add(artifact.path)
+    db.session.commit()
+
+    untracked = 0
+    threshold = time.time() - UNTRACKED_GRACE_PERIOD
+    for root in roots:
+        for path in root.rglob("*"):
+            if (
+                path.suffix in OUTPUT_EXTENSIONS
+                and str(path) not in tracked
+                and path.is_file()
+                and path.stat().st_mtime < threshold
+            ):
+                path.unlink(missing_ok=True)
+                untracked += 1
+    return stale, untracked
+
+
+def evict_lru(db: Any, budget: int, dataset_id: Optional[str] = None) -> int:
+    """
+    Remove the least recently used outputs (of a dataset, if any) until their
+    size is within the budget. Returns the number of evicted outputs
+    """
+    filters = [db.CropArtifact.dataset_id == dataset_id] if dataset_id else []
+    used = (
+        db.session.query(func.coalesce(func.sum(db.CropArtifact.size), 0))
+        .filter(*filters)
+        .scalar()
+    )
+    to_free = used - budget
+    if to_free <= 0:
+        return 0
+    log.warning(
+        "Crops of {} over budget: {} bytes to free", dataset_id or "all", to_free
+    )
+    last_use = func.coalesce(db.CropArtifact.last_access, db.CropArtifact.rendered)
+    # the outputs from the least recently used
+    candidates = (
+        db.session.query(db.CropArtifact.id, db.CropArtifact.size)
+        .filter(*filters)
+        .order_by(last_use.asc())
+        .all()
+    )
+    evicted = 0
+    for candidate in candidates:
+        if to_free <= 0:
+            break
+        to_free -= candidate.size or 0
+        remove_output(db, db.CropArtifact.query.get(candidate.id))
+        evicted += 1
+    db.session.commit()
+    return evicted
+
+
+def evict_outputs(
+    budget: int = CROPS_DISK_BUDGET,
+    quotas: Mapping[str, int] = CROPS_DATASET_QUOTAS,
+) -> int:
+    """
+    Remove the least recently used outputs of the datasets over their quota,
+    then the ones of the whole crops tree if it is over the budget.
+    Returns the number of evicted outputs
+    """
+    db = sqlalchemy.get_instance()
+    evicted = 0
+    for dataset_id, quota in quotas.items():
+        if quota > 0:
+            evicted += evict_lru(db, quota, dataset_id)
+    if budget > 0:
+        evicted += evict_lru(db, budget)
+    return evicted
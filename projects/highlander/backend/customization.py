@@ -59,6 +59,16 @@ def get_custom_input_fields(request: FlaskRequest, scope: int) -> Props:
                         "description": "Disk quota in bytes",
                     },
                 ),
+                "output_retention_days": fields.Int(
+                    required=False,
+                    allow_none=True,
+                    validate=validate.Range(min=1),
+                    metadata={
+                        "label": "Output retention",
+                        "description": "Days before the output files expire "
+                        "(the default retention when empty)",
+                    },
+                ),
             }
 
         # these are editable fields in profile
@@ -78,4 +88,5 @@ def get_custom_output_fields(request: FlaskRequest) -> Props:
         """
         return {
             "disk_quota": fields.Int(),
+            "output_retention_days": fields.Int(allow_none=True),
         }
@@ -0,0 +1,73 @@
+from typing import Dict, List
+
+from highlander.area_index import LEVELS, resolve_points
+from restapi import decorators
+from restapi.models import Schema, fields, validate
+from restapi.rest.definition import EndpointResource, Response
+from restapi.utilities.logs import log
+
+MAX_POINTS = 10000
+
+
+class Location(Schema):
+    latitude = fields.Float(required=True, validate=validate.Range(-90, 90))
+    longitude = fields.Float(required=True, validate=validate.Range(-180, 180))
+
+
+class AreaLookup(Location):
+    levels = fields.List(
+        fields.Str(validate=validate.OneOf(LEVELS)),
+        required=False,
+        load_default=LEVELS,
+    )
+
+
+class BatchAreaLookup(Schema):
+    points = fields.List(
+        fields.Nested(Location),
+        required=True,
+        validate=validate.Length(min=1, max=MAX_POINTS),
+    )
+    levels = fields.List(
+        fields.Str(validate=validate.OneOf(LEVELS)),
+        required=False,
+        load_default=LEVELS,
+    )
+
+
+class Areas(EndpointResource):
+    @decorators.endpoint(
+        path="/areas/lookup",
+        summary="Get the areas containing a point",
+        description="The area ids (null if none) of each administrative level",
+        responses={
+            200: "areas successfully retrieved",
+            400: "invalid coordinates or levels",
+        },
+    )
+    @decorators.use_kwargs(AreaLookup, location="query")
+    def get(
+        self, latitude: float, longitude: float, levels: List[str] = LEVELS
+    ) -> Response:
+        log.debug("Lookup of the areas of ({}, {})", latitude, longitude)
+        return self.response(resolve_points([(latitude, longitude)], levels)[0])
+
+    @decorators.endpoint(
+        path="/areas/lookup",
+        summary="Get the areas containing several points",
+        description="The area ids (null if none) of each administrative level, "
+        "in the order of the points",
+        responses={
+            200: "areas successfully retrieved",
+            400: "invalid coordinates or levels",
+        },
+    )
+    @decorators.use_kwargs(BatchAreaLookup)
+    def post(
+        self, points: List[Dict[str, float]], levels: List[str] = LEVELS
+    ) -> Response:
+        log.debug("Lookup of the areas of {} points", len(points))
+        areas = resolve_points(
+            ((p["latitude"], p["longitude"]) for p in points), levels
+        )
+        return self.response(areas)
@@ -0,0 +1,154 @@
+from typing import Any, Dict, List, Optional
+
+from highlander import scheduling
+from highlander.connectors import broker
+from highlander.endpoints.utils import MapCropConfig as config
+from highlander.endpoints.utils import CropEngine, PlotUtils
+from highlander.requests_count import invalidate_requests_count
+from marshmallow import ValidationError, pre_load
+from restapi import decorators
+from restapi.connectors import celery, sqlalchemy
+from restapi.exceptions import NotFound, ServerError
+from restapi.models import Schema, fields, validate
+from restapi.rest.definition import EndpointResource, Response
+from restapi.services.authentication import User
+from restapi.utilities.logs import log
+
+AREA_TYPES = ["regions", "provinces", "basins"]
+DAILY_METRICS = ["daymax", "daymin", "daymean"]
+OUTPUTS = ["map", "plot", "report"]
+
+
+class BatchDetails(Schema):
+    area_type = fields.Str(required=True, validate=validate.OneOf(AREA_TYPES))
+    area_ids = fields.List(fields.Str(), required=False)
+    all_areas = fields.Bool(required=False, load_default=False)
+    outputs = fields.List(
+        fields.Str(validate=validate.OneOf(OUTPUTS)),
+        required=False,
+        load_default=OUTPUTS,
+        validate=validate.Length(min=1),
+    )
+    indicator = fields.Str(required=True)
+    model_id = fields.Str(required=False)
+    year = fields.Str(required=False)
+    date = fields.Str(required=False)
+    daily_metric = fields.Str(required=False, validate=validate.OneOf(DAILY_METRICS))
+    time_period = fields.Str(required=False)
+    reference_period = fields.Str(required=False)
+    label = fields.Str(required=False)
+
+    # Validation. Check whether the areas are given
+    @pre_load
+    def params_validation(self, data: Dict[str, Any], **kwargs: Any) -> Dict[str, Any]:
+        if not data.get("area_ids") and not data.get("all_areas"):
+            raise ValidationError(
+                "a list of area ids or all_areas have to be specified"
+            )
+        return data
+
+
+class BatchCrop(EndpointResource):
+    labels = ["batch"]
+
+    @decorators.auth.require()
+    @decorators.use_kwargs(BatchDetails)
+    @decorators.endpoint(
+        path="/datasets/<dataset_id>/products/<product_id>/batch",
+        summary="Request the maps, plots and reports of several areas in a zip file",
+        responses={
+            202: "Batch request accepted",
+            400: "Missing parameters",
+            404: "Dataset, product or areas not found",
+        },
+    )
+    def post(
+        self,
+        dataset_id: str,
+        product_id: str,
+        user: User,
+        area_type: str,
+        indicator: str,
+        outputs: List[str],
+        all_areas: bool = False,
+        area_ids: Optional[List[str]] = None,
+        **kwargs: Optional[str],
+    ) -> Response:
+        log.debug("Batch request for <{}:{}>", dataset_id, product_id)
+        dds = broker.get_instance()
+        # check if the dataset exists
+        dataset_details = dds.get_dataset_details([dataset_id])
+        if not dataset_details["data"]:
+            raise NotFound(f"dataset {dataset_id} not found")
+
+        # check if product exists
+        if not CropEngine.getProductDetails(dataset_details, dataset_id, product_id):
+            raise NotFound(f"product {product_id} for dataset {dataset_id} not found")
+
+        variables: Dict[str, Any] = {
+            "dataset_id": dataset_id,
+            "product_id": product_id,
+            "area_type": area_type,
+            "indicator": indicator,
+            **kwargs,
+        }
+        CropEngine.checkMandatoryParams(dataset_id, product_id, variables)
+        if not config.getOutputPath(dataset_id, product_id, variables):
+            raise ServerError(
+                f"{dataset_id} or {product_id} keys not present in output structure map"
+            )
+
+        # check the areas
+        if all_areas:
+            area_ids = None
+        areas = PlotUtils.getAreas(area_ids, area_type)
+        if areas.empty:
+            raise NotFound(f"No area found in {area_type}")
+        if area_ids:
+            missing = {a.lower() for a in area_ids} - set(areas.index)
+            if missing:
+                raise NotFound(
+                    f"Areas {', '.join(sorted(missing))} not found in {area_type}"
+                )
+
+        args: Dict[str, Any] = {
+            "area_type": area_type,
+            "area_ids": sorted(areas.index) if area_ids else None,
+            "outputs": outputs,
+            "indicator": indicator,
+        }
+        args.update({k: v for k, v in kwargs.items() if v})
+
+        c = celery.get_instance()
+        task = None
+        db = sqlalchemy.get_instance()
+        try:
+            # save request record in db
+            request = db.Request(
+                name="batch",
+                dataset_name=dataset_id,
+                args={"product_id": product_id, **args},
+                user_id=user.id,
+                status="CREATED",
+                queue=scheduling.LARGE,
+            )
+            db.session.add(request)
+            db.session.commit()
+
+            task = c.celery_app.send_task(
+                "batch_crop",
+                args=[user.id, dataset_id, product_id, args, request.id],
+                queue=scheduling.QUEUES[scheduling.LARGE],
+                priority=scheduling.get_priority(db, user.id, scheduling.LARGE),
+            )
+            request.task_id = task.id
+            request.status = task.status  # 'PENDING'
+            db.session.commit()
+            log.info("Batch request <ID:{}> successfully saved", request.id)
+            invalidate_requests_count(user.id)
+        except Exception as exc:
+            log.exception(exc)
+            db.session.rollback()
+            raise ServerError("Unable to submit the request")
+
+        return self.response(task.id, code=202)
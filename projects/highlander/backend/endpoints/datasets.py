@@ -3,7 +3,6 @@
 from typing import List, Optional
 
 from flask import send_from_directory
-from highlander.catalog import CatalogExt
 from highlander.connectors import broker
 from highlander.constants import CATALOG_DIR
 from highlander.exceptions import NotYetImplemented
@@ -15,7 +14,6 @@
 from restapi.utilities.logs import log
 
 AVAILABLE_PERIODIC_PRODUCTS = ["crop-water:crop-water"]
-CATALOG_EXT_DIR = f"{CATALOG_DIR}/catalog-ext.yaml"
 
 
 class Datasets(EndpointResource):
@@ -43,13 +41,7 @@ def get(self, application: Optional[bool] = None) -> Response:
         ]
         # additional external applications?
         if application:
-            try:
-                cat_ext = CatalogExt(path=CATALOG_EXT_DIR)
-                out = cat_ext.get_datasets()
-                res.extend(out)
-            except ValueError:
-                # for missing or invalid cat_ext
-                pass
+            res.extend(dds.get_ext_datasets())
         else:
             # exclude unwanted datasets (no applied to applications)
             res = [x for x in res if not x.get("exclude", False)]
@@ -79,16 +71,7 @@ def get(self, dataset_id: str, application: bool = False) -> Response:
         if not details:
             if application:
                 # check in the external catalog
-                try:
-                    cat_ext = CatalogExt(path=CATALOG_EXT_DIR)
-                    out = cat_ext.get_datasets()
-                    for d in out:
-                        if d.get("id", None) == dataset_id:
-                            details = d
-                            break
-                except ValueError:
-                    # for missing or invalid cat_ext
-                    pass
+                details = dds.get_ext_dataset(dataset_id)
                 if details:
                     return self.response(details)
             raise NotFound(f"Dataset ID<{dataset_id}> not found")
@@ -173,19 +156,7 @@ def get(self, dataset_id: str, type: str) -> Response:
         log.debug("Get {} for dataset <{}>", type, dataset_id)
         try:
             dds = broker.get_instance()
-            content_filename = None
-            try:
-                content_filename = dds.get_dataset_content_filename(dataset_id, type)
-            except LookupError:
-                log.debug("Dataset <{}> NOT managed locally", dataset_id)
-                try:
-                    cat_ext = CatalogExt(path=CATALOG_EXT_DIR)
-                    content_filename = cat_ext.get_dataset_content_filename(
-                        dataset_id, type
-                    )
-                except ValueError:
-                    # for missing or invalid cat_ext
-                    pass
+            content_filename = dds.get_dataset_content_filename(dataset_id, type)
             if not content_filename:
                 raise Warning(
                     f"Content <{type}> NOT configured for dataset <{dataset_id}>"
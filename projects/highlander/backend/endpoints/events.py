@@ -0,0 +1,29 @@
+from flask import Response as FlaskResponse
+from flask import stream_with_context
+from highlander.notifications import stream_events
+from restapi import decorators
+from restapi.rest.definition import EndpointResource, Response
+from restapi.services.authentication import User
+
+
+class RequestsEvents(EndpointResource):
+    labels = ["requests"]
+
+    @decorators.auth.require(allow_access_token_parameter=True)
+    @decorators.endpoint(
+        path="/events/requests",
+        summary="Stream the status changes of the user requests",
+        description="Server-sent events stream. Each request event carries the "
+        "request id, task id and status, with the progress of running requests",
+        responses={200: "Stream of request events"},
+    )
+    def get(self, user: User) -> Response:
+        return FlaskResponse(
+            stream_with_context(stream_events(user.id)),
+            mimetype="text/event-stream",
+            headers={
+                "Cache-Control": "no-cache",
+                # do not buffer the stream in the proxy
+                "X-Accel-Buffering": "no",
+            },
+        )
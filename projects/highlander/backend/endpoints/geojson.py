@@ -1,31 +1,40 @@
 from pathlib import Path
-from typing import Any
+from typing import Any, Optional
 
-from flask import send_file
-from highlander.catalog import CatalogExt
-from highlander.constants import CATALOG_DIR
+from highlander.catalog import get_catalog_ext
 from highlander.endpoints.utils import MapCropConfig as config
+from highlander.static_assets import SIMPLIFY_TOLERANCES, send_static_json
 from restapi import decorators
 from restapi.exceptions import BadRequest, NotFound
 from restapi.models import Schema, fields, validate
 from restapi.rest.definition import EndpointResource, Response
 from restapi.utilities.logs import log
 
-CATALOG_EXT_DIR = f"{CATALOG_DIR}/catalog-ext.yaml"
-
 
 class GeoJson(EndpointResource):
     @decorators.endpoint(
         path="/geojson/<filename>",
         summary="Get a geojson file",
+        description="The geometries can be simplified at a lower level of detail",
         responses={
             200: "geojson file successfully retrieved",
+            304: "geojson file not modified",
+            400: "the file can not be simplified",
             404: "geojson file not found",
         },
     )
+    @decorators.use_kwargs(
+        {
+            "detail": fields.Str(
+                required=False, validate=validate.OneOf(SIMPLIFY_TOLERANCES)
+            )
+        },
+        location="query",
+    )
     def get(
         self,
         filename: str,
+        detail: Optional[str] = None,
     ) -> Any:
         # get the filepath
         geojson_filepath = Path(config.GEOJSON_PATH, f"{filename}.json")
@@ -34,8 +43,11 @@ def get(
         if not geojson_filepath.exists():
             raise NotFound(f"file {filename}.json not found")
 
-        # return the retrieved file
-        return send_file(geojson_filepath, mimetype="application/json")
+        # return the retrieved file (compressed and simplified if requested)
+        try:
+            return send_static_json(geojson_filepath, detail)
+        except ValueError as exc:
+            raise BadRequest(str(exc))
 
 
 class JsonData(EndpointResource):
@@ -44,6 +56,7 @@ class JsonData(EndpointResource):
         summary="Get a json data",
         responses={
             200: "json data file successfully retrieved",
+            304: "json data file not modified",
             400: "the selected dataset does not have json data",
             404: "json data file not found",
         },
@@ -54,20 +67,12 @@ def get(
         filename: str,
     ) -> Any:
         # get the source filepath from the dataset
-        try:
-            cat_ext = CatalogExt(path=CATALOG_EXT_DIR)
-            external_datasets = cat_ext.get_datasets()
-        except ValueError:
+        cat_ext = get_catalog_ext()
+        if not cat_ext:
             # for missing or invalid cat_ext
             raise NotFound("Not found Datasets with Json data")
-        if not external_datasets:
-            raise NotFound("Not found Datasets with Json data")
 
-        dataset_details = None
-        for d in external_datasets:
-            if d.get("id", None) == dataset_id:
-                dataset_details = d
-                break
+        dataset_details = cat_ext.get_dataset(dataset_id)
         if not dataset_details:
             raise NotFound(f"dataset {dataset_id} not found")
 
@@ -85,4 +90,4 @@ def get(
             raise NotFound(f"file {filename}.json not found")
 
         # return the retrieved file
-        return send_file(json_filepath, mimetype="application/json")
+        return send_static_json(json_filepath)
@@ -2,13 +2,19 @@
 from pathlib import Path
 from typing import Any, Dict, List, Optional, Union
 
-import numpy as np
-import pandas as pd  # type: ignore
 from flask import send_file
 from highlander.connectors import broker
+from highlander.crop_manifest import is_fresh
 from highlander.endpoints.utils import MapCropConfig as config
-from highlander.endpoints.utils import PlotUtils
-from marshmallow import ValidationError, pre_load
+from highlander.endpoints.utils import (
+    DEFAULT_RESOLUTION,
+    IMAGE_FORMATS,
+    RESOLUTIONS,
+    CropEngine,
+    PlotUtils,
+)
+from highlander.metrics import StageTimer
+from marshmallow import ValidationError, pre_load, validates_schema
 from restapi import decorators
 from restapi.connectors import Connector
 from restapi.exceptions import BadRequest, NotFound, ServerError
@@ -17,11 +23,18 @@
 from restapi.utilities.logs import log
 
 AREA_TYPES = ["regions", "provinces", "basins", "municipalities", "bbox", "polygon"]
+ADMINISTRATIVE_AREA_TYPES = AREA_TYPES[:4]
 DAILY_METRICS = ["daymax", "daymin", "daymean"]
 TYPES = ["map", "plot"]
 PLOT_TYPES = ["boxplot", "distribution"]
-FORMATS = ["png", "json"]
-MIMETYPES_MAP = {".png": "image/png", ".json": "application/json"}
+FORMATS = [*IMAGE_FORMATS, "json"]
+MIMETYPES_MAP = {
+    ".png": "image/png",
+    ".webp": "image/webp",
+    ".json": "application/json",
+}
+# maximum number of days of a crop of a daily product
+MAX_DAYS = 31
 
 
 class SubsetDetails(Schema):
@@ -38,6 +51,7 @@ class SubsetDetails(Schema):
     type = fields.Str(required=True, validate=validate.OneOf(TYPES))
     plot_type = fields.Str(required=False, validate=validate.OneOf(PLOT_TYPES))
     plot_format = fields.Str(required=False, validate=validate.OneOf(FORMATS))
+    resolution = fields.Str(required=False, validate=validate.OneOf(RESOLUTIONS))
 
     @pre_load
     def params_validation(
@@ -63,13 +77,50 @@ def params_validation(
         type = data.get("type")
         plot_type = data.get("plot_type", None)
         plot_format = data.get("plot_format", None)
-        if not plot_format or plot_format == "png":
+        if not plot_format or plot_format in IMAGE_FORMATS:
             if type == "plot" and not plot_type:
                 raise ValidationError("a plot type have to be specified")
 
         return data
 
 
+class DaysSubsetDetails(Schema):
+    year = fields.Str(required=True, validate=validate.Regexp(r"^\d{4}$"))
+    start_date = fields.Date(required=True)
+    end_date = fields.Date(required=True)
+    area_id = fields.Str(required=True)
+    area_type = fields.Str(
+        required=True, validate=validate.OneOf(ADMINISTRATIVE_AREA_TYPES)
+    )
+    indicator = fields.Str(required=True)
+    daily_metric = fields.Str(required=True, validate=validate.OneOf(DAILY_METRICS))
+    type = fields.Str(required=False, validate=validate.OneOf(TYPES))
+    plot_type = fields.Str(required=False, validate=validate.OneOf(PLOT_TYPES))
+    plot_format = fields.Str(required=False, validate=validate.OneOf(FORMATS))
+    resolution = fields.Str(required=False, validate=validate.OneOf(RESOLUTIONS))
+
+    @validates_schema
+    def validate_days(self, data: Dict[str, Any], **kwargs: Any) -> None:
+        start_date, end_date = data["start_date"], data["end_date"]
+        if end_date < start_date:
+            raise ValidationError(
+                "the end date has to follow the start date", field_name="end_date"
+            )
+        if (end_date - start_date).days >= MAX_DAYS:
+            raise ValidationError(
+                f"at most {MAX_DAYS} days can be requested", field_name="end_date"
+            )
+        # the daily data of each year are in a file
+        if not start_date.year == end_date.year == int(data["year"]):
+            raise ValidationError(
+                "the dates have to be in the requested year", field_name="year"
+            )
+        plot_format = data.get("plot_format")
+        if data.get("type") == "plot" and not data.get("plot_type"):
+            if not plot_format or plot_format in IMAGE_FORMATS:
+                raise ValidationError("a plot type have to be specified")
+
+
 class MapCrop(EndpointResource):
     @decorators.endpoint(
         path="/datasets/<dataset_id>/products/<product_id>/crop",
@@ -102,62 +153,43 @@ def get(
         area_coords: Optional[List[float]] = None,
         plot_type: Optional[str] = None,
         plot_format: str = "png",
+        resolution: str = DEFAULT_RESOLUTION,
     ) -> Any:
 
+        timer = StageTimer("crop")
         dds = broker.get_instance()
         # check if the dataset exists
-        dataset_details = dds.get_dataset_details([dataset_id])
+        with timer.stage("dataset_details"):
+            dataset_details = dds.get_dataset_details([dataset_id])
         if not dataset_details["data"]:
             raise NotFound(f"dataset {dataset_id} not found")
 
         # check if product exists
-        dataset_products = dataset_details["data"][0]["products"]
-        product_details: Optional[Dict[str, Any]] = None
-        for p in dataset_products:
-            if product_id in p["id"]:
-                product_details = p
-                break
-            # check if there are exception for the product
-            if (
-                dataset_id in config.PRODUCT_EXCEPTION.keys()
-                and product_id in config.PRODUCT_EXCEPTION[dataset_id].keys()
-                and config.PRODUCT_EXCEPTION[dataset_id][product_id] in p["id"]
-            ):
-                product_details = p
-                break
-            # # case of humanwellbeing multi-year: product not in dds but its details are the same of the daily
-            # if (
-            #     dataset_id == "human-wellbeing"
-            #     and product_id == "multi-year"
-            #     and p["id"] == "daily"
-            # ):
-            #     product_details = p
-            #     break
+        product_details = CropEngine.getProductDetails(
+            dataset_details, dataset_id, product_id
+        )
         if not product_details:
             raise NotFound(f"product {product_id} for dataset {dataset_id} not found")
+        timer.set_labels(dataset_id, product_id)
 
         # check mandatory params according to dataset and product
-        endpoint_arguments = locals()
-        try:
-            for product, param_list in config.MANDATORY_PARAM_MAP[dataset_id].items():
-                if product == product_id or product == "all_products":
-                    for param in param_list:
-                        if not endpoint_arguments[param]:
-                            raise BadRequest(
-                                f"{param} parameter is needed for {product_id} product in {dataset_id}"
-                            )
-        except KeyError:
-            raise ServerError(f"{dataset_id} not found in Mandatory param map")
-
-        year_day: Optional[int] = None
-        if date and product == "daily":
-            year_day = int(datetime.datetime.strptime(date, "%Y-%m-%d").strftime("%j"))
+        variables: Dict[str, Any] = {
+            "dataset_id": dataset_id,
+            "product_id": product_id,
+            "area_type": area_type,
+            "indicator": indicator,
+            "model_id": model_id,
+            "year": year,
+            "date": date,
+            "daily_metric": daily_metric,
+            "time_period": time_period,
+            "reference_period": reference_period,
+        }
+        CropEngine.checkMandatoryParams(dataset_id, product_id, variables)
 
         if area_type != "bbox" or area_type != "polygon":
-            # get the area
-            area_name, area = PlotUtils.getArea(area_id, area_type)
-            if area.empty:
-                raise NotFound(f"Area {area_name} not found in {area_type}")
+            # the area is checked when its data are cropped
+            area_name = area_id.lower()
         else:
             # case of custom areas:
             # The data are cropped and streamed. Cropped data are not saved in the folders and
@@ -166,16 +198,14 @@ def get(
             return self.empty_response()
 
         # get the output structure
-        output_structure = config.getOutputPath(
-            dataset_id, product_id, endpoint_arguments
-        )
+        output_structure = config.getOutputPath(dataset_id, product_id, variables)
         if not output_structure:
             raise ServerError(
                 f"{dataset_id} or {product_id} keys not present in output structure map"
             )
         # get the output filename
         output_filename = config.getOutputFilename(
-            type, plot_format, plot_type, area_name
+            type, plot_format, plot_type, area_name, resolution
         )
 
         # build the filepath
@@ -183,137 +213,193 @@ def get(
         log.debug(f"Output dir: {output_dir}")
         filepath = Path(output_dir, output_filename)
 
-        # check if the crop has already been created
-        if filepath.is_file() and filepath.stat().st_size >= 1:
-            return send_file(filepath, mimetype=MIMETYPES_MAP[filepath.suffix])
+        # check if the crop has already been created from the current source
+        if is_fresh(filepath):
+            return timer.finalize(
+                send_file(filepath, mimetype=MIMETYPES_MAP[filepath.suffix])
+            )
 
-        # get the map to crop
-        # check if the model name and the filename correspond
-        if model_id:
-            model_filename: str = model_id
-            for m, v in config.MODELS_MAPPING.items():
-                if m in model_id:
-                    model_filename = model_id.replace(m, v)
+        # crop the area, or reuse the data cropped for its other outputs
+        nc_cropped = CropEngine.getCrop(
+            dds,
+            dataset_id,
+            product_id,
+            product_details,
+            variables,
+            area_id,
+            area_type,
+            timer=timer,
+        )
+        # plot the cropped data
+        CropEngine.plotCrop(
+            nc_cropped,
+            dataset_id,
+            product_id,
+            variables,
+            type,
+            plot_type,
+            plot_format,
+            filepath,
+            timer=timer,
+            resolution=resolution,
+        )
 
-        # get the file urlpath
-        product_urlpath = dds.broker.catalog[dataset_id][product_details["id"]].urlpath
-        log.debug(product_urlpath)
-        product_urlpath_root = product_urlpath.split(dataset_id)[0]
-        if dataset_id == "era5-downscaled-over-italy":
-            product_urlpath_root = product_urlpath.split("vhr-rea")[0]
-        log.debug(product_urlpath_root)
-        try:
-            data_to_crop_url = f"{product_urlpath_root}{config.SOURCE_FILE_URL_MAP[dataset_id][product_id]['url']}"
-        except KeyError:
-            raise ServerError(
-                f"{dataset_id} or {product_id} keys not present in source file url map"
-            )
-        # substitute the parameters
-        endpoint_variables = locals()
-        if "params" in config.SOURCE_FILE_URL_MAP[dataset_id][product_id]:
-            for p in config.SOURCE_FILE_URL_MAP[dataset_id][product_id]["params"]:
-                data_to_crop_url = data_to_crop_url.replace(p, endpoint_variables[p])
+        return timer.finalize(
+            send_file(filepath, mimetype=MIMETYPES_MAP[filepath.suffix])
+        )
 
-        data_to_crop_filepath = Path(data_to_crop_url)
 
-        if not data_to_crop_filepath.is_file():
-            raise NotFound(
-                f"Requested data to crop not found: source file {data_to_crop_filepath} does not exists"
-            )
-        log.debug(f"source path of the data to crop: {data_to_crop_filepath}")
+class MapCropDays(EndpointResource):
+    @decorators.endpoint(
+        path="/datasets/<dataset_id>/products/<product_id>/crop/days",
+        summary="Get the statistics of the days of a daily product over an area",
+        description="The maps (or plots) of the days are created from a single "
+        "read of the data and cached: the crops of the single days are then "
+        "served from the cache",
+        responses={
+            200: "statistics of the days successfully retrieved",
+            400: "missing parameters or invalid days",
+            404: "Area not found",
+            500: "Errors in cropping or plotting the data",
+        },
+    )
+    @decorators.use_kwargs(
+        DaysSubsetDetails,
+        location="query",
+    )
+    def get(
+        self,
+        dataset_id: str,
+        product_id: str,
+        year: str,
+        start_date: datetime.date,
+        end_date: datetime.date,
+        area_id: str,
+        area_type: str,
+        indicator: str,
+        daily_metric: str,
+        type: str = "map",
+        plot_type: Optional[str] = None,
+        plot_format: str = "png",
+        resolution: str = DEFAULT_RESOLUTION,
+    ) -> Any:
+        timer = StageTimer("crop_days")
+        if product_id != "daily":
+            raise BadRequest(f"product {product_id} has no daily data")
+        dds = broker.get_instance()
+        # check if the dataset exists
+        with timer.stage("dataset_details"):
+            dataset_details = dds.get_dataset_details([dataset_id])
+        if not dataset_details["data"]:
+            raise NotFound(f"dataset {dataset_id} not found")
 
-        # get the data variable. The data variable is ALWAYS equal to the lowercase indicator
-        try:
-            nc_variable = config.VARIABLES_MAP[indicator]
-        except KeyError:
-            raise NotFound(
-                f"indicator {indicator} for product {product_id} for dataset {dataset_id} not found"
-            )
+        # check if product exists
+        product_details = CropEngine.getProductDetails(
+            dataset_details, dataset_id, product_id
+        )
+        if not product_details:
+            raise NotFound(f"product {product_id} for dataset {dataset_id} not found")
+        timer.set_labels(dataset_id, product_id)
 
-        # names for variables in forest species projections are different. This is an exception for this case
-        # TODO try to get a correct file in order to delete this exception
-        if product_id == "forest-species-suitability-proj":
-            nc_variable = f"{nc_variable.split('_')[0].title()}{nc_variable.split('_')[1].title()}"
+        variables: Dict[str, Any] = {
+            "dataset_id": dataset_id,
+            "product_id": product_id,
+            "area_type": area_type,
+            "indicator": indicator,
+            "year": year,
+            "date": start_date.isoformat(),
+            "daily_metric": daily_metric,
+        }
+        CropEngine.checkMandatoryParams(dataset_id, product_id, variables)
+
+        area_name = area_id.lower()
+        output_filename = config.getOutputFilename(
+            type, plot_format, plot_type, area_name, resolution
+        )
+        dates = [
+            start_date + datetime.timedelta(days=i)
+            for i in range((end_date - start_date).days + 1)
+        ]
+        # the outputs are the ones of the crops of the single days
+        days_variables: Dict[datetime.date, Dict[str, Any]] = {}
+        filepaths: Dict[datetime.date, Path] = {}
+        cropped_filepaths: Dict[datetime.date, Optional[Path]] = {}
+        for date in dates:
+            day_variables = {**variables, "date": date.isoformat()}
+            output_structure = config.getOutputPath(
+                dataset_id, product_id, day_variables
+            )
+            if not output_structure:
+                raise ServerError(
+                    f"{dataset_id} or {product_id} keys not present in output structure map"
+                )
+            days_variables[date] = day_variables
+            filepaths[date] = config.CROPS_OUTPUT_ROOT.joinpath(
+                *output_structure, output_filename
+            )
+            # the cropped data of the day are shared with its other outputs
+            cropped_filepaths[date] = CropEngine.getCroppedFilepath(
+                dataset_id, product_id, day_variables, area_name
+            )
 
-        # crop the area
-        try:
-            has_time = True
-            if product_id in config.PRODUCT_WOUT_TIME:
-                has_time = False
+        # the days with fresh cropped data are not read again
+        missing = [
+            date
+            for date in dates
+            if not cropped_filepaths[date] or not is_fresh(cropped_filepaths[date])
+        ]
 
-            nc_cropped = PlotUtils.cropArea(
-                data_to_crop_filepath,
+        # crop all the missing days at once
+        crops: Dict[datetime.date, Any] = {}
+        if missing:
+            with timer.stage("get_area"):
+                area_name, area = PlotUtils.getArea(area_id, area_type)
+            if area.empty:
+                raise NotFound(f"Area {area_name} not found in {area_type}")
+            crops = CropEngine.cropDataDays(
+                dds,
+                dataset_id,
+                product_id,
+                product_details,
+                variables,
                 area_name,
                 area,
-                nc_variable,
-                year_day,
-                has_time,
+                missing,
+                timer=timer,
             )
-        except Exception as exc:
-            raise ServerError(f"Errors in cropping the data: {exc}")
-        # create the output directory if it does not exists
-        output_dir.mkdir(parents=True, exist_ok=True)
-        try:
-            if type == "map":
-                # get the layer name to get the legends
-                try:
-                    layer_name = config.GEOSERVER_LAYER_MAP[dataset_id][product_id][
-                        "layer"
-                    ]
-                    # substitute the parameters
-                    if "params" in config.GEOSERVER_LAYER_MAP[dataset_id][product_id]:
-                        for p in config.GEOSERVER_LAYER_MAP[dataset_id][product_id][
-                            "params"
-                        ]:
-                            layer_name = layer_name.replace(p, endpoint_variables[p])
-                except KeyError:
-                    layer_name = ""
-                    pass
-
-                # plot the cropped map
-                PlotUtils.plotMapNetcdf(
-                    nc_cropped.values,
-                    nc_cropped.lat.values,
-                    nc_cropped.lon.values,
-                    nc_cropped.units,
-                    nc_cropped.long_name,
+        days = []
+        for date in dates:
+            if date in crops:
+                nc_cropped = crops[date]
+                cropped_filepath = cropped_filepaths[date]
+                if cropped_filepath:
+                    CropEngine.storeCrop(
+                        nc_cropped, cropped_filepath, dataset_id, timer
+                    )
+            else:
+                nc_cropped = CropEngine.getCrop(
+                    dds,
+                    dataset_id,
                     product_id,
-                    filepath,
-                    layer_name,
+                    product_details,
+                    days_variables[date],
+                    area_id,
+                    area_type,
+                    timer=timer,
                 )
-            else:
-                # plot the boxplot
-                df_stas = pd.DataFrame([])
-                df_stas = pd.concat(
-                    [
-                        df_stas,
-                        pd.DataFrame(
-                            np.array(nc_cropped.values).ravel(),
-                            columns=[str(product_id)],  # data_to_crop_filepath)[:-21]],
-                        ),
-                    ],
-                    axis=1,
+            if not is_fresh(filepaths[date]):
+                CropEngine.plotCrop(
+                    nc_cropped,
+                    dataset_id,
+                    product_id,
+                    days_variables[date],
+                    type,
+                    plot_type,
+                    plot_format,
+                    filepaths[date],
+                    timer=timer,
+                    resolution=resolution,
                 )
-                # log.debug("Colums")
-                # log.debug(df_stas.columns[0][-4:])
-
-                if plot_format == "json":
-                    df_stas.to_json(path_or_buf=filepath)
-                    return send_file(filepath, mimetype=MIMETYPES_MAP[filepath.suffix])
-
-                # if not json plot the image
-                if plot_type == "boxplot":
-                    PlotUtils.plotBoxplot(df_stas, filepath)
-                elif plot_type == "distribution":
-                    PlotUtils.plotDistribution(
-                        df_stas, filepath, nc_cropped.long_name, nc_cropped.units
-                    )
-
-        except Exception as exc:
-            raise ServerError(f"Errors in plotting the data: {exc}")
-
-        # check that the output has been correctly created
-        if not filepath.is_file() or not filepath.stat().st_size >= 1:
-            raise ServerError("Errors in plotting the data")
+            days.append({"date": date.isoformat(), **PlotUtils.getStats(nc_cropped)})
 
-        return send_file(filepath, mimetype=MIMETYPES_MAP[filepath.suffix])
+        return timer.finalize(self.response(days))
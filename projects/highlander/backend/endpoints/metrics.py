@@ -0,0 +1,18 @@
+from flask import Response as FlaskResponse
+from highlander.metrics import generate_metrics
+from restapi import decorators
+from restapi.rest.definition import EndpointResource, Response
+from restapi.services.authentication import Role, User
+
+
+class Metrics(EndpointResource):
+    @decorators.auth.require_any(Role.ADMIN)
+    @decorators.endpoint(
+        path="/admin/metrics",
+        summary="Get the timing metrics of the crop, stripes and report pipelines",
+        description="Metrics are returned in the Prometheus text format",
+        responses={200: "Metrics successfully retrieved"},
+    )
+    def get(self, user: User) -> Response:
+        content, mimetype = generate_metrics()
+        return FlaskResponse(content, mimetype=mimetype)
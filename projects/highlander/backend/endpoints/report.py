@@ -1,15 +1,15 @@
-import io
-from datetime import date
 from pathlib import Path
-from typing import Any, Optional
+from typing import Any, Dict, Optional
 
 from flask import send_file
-from fpdf import FPDF
 from highlander.connectors import broker
+from highlander.crop_manifest import is_fresh
 from highlander.endpoints.utils import MapCropConfig as config
+from highlander.endpoints.utils import CropEngine, PlotUtils
+from highlander.metrics import StageTimer
 from restapi import decorators
 from restapi.connectors import Connector
-from restapi.exceptions import BadRequest, NotFound, ServerError
+from restapi.exceptions import NotFound, ServerError
 from restapi.models import Schema, fields, validate
 from restapi.rest.definition import EndpointResource
 from restapi.services.authentication import User
@@ -17,46 +17,6 @@
 
 AREA_TYPES = ["regions", "provinces", "basins"]
 DAILY_METRICS = ["daymax", "daymin", "daymean"]
-LOGO_URL = Path(config.GEOJSON_PATH, "highlander-logo.png")
-EU_LOGO_URL = Path(config.GEOJSON_PATH, "en_horizontal_cef_logo_2.png")
-
-
-class PDF(FPDF):
-    ch = 8
-    # license = "CC BY 4.0"
-    license = ""
-
-    def header(self):
-        self.image(str(LOGO_URL), 90, 5, 40)
-        self.image(str(EU_LOGO_URL), 130, 12, 50)
-        self.ln(15)
-
-    def footer(self):
-        self.set_y(-15)
-        self.set_font("Arial", "I", 8)
-        self.cell(w=30, h=self.ch, txt=f"License : {self.license}", ln=1)
-        self.set_text_color(128)
-        self.cell(0, 10, "Page " + str(self.page_no()), 0, 0, "C")
-
-    def report_title(self, label):
-        self.set_font("Arial", "B", 20)
-        self.set_fill_color(r=30, g=154, b=47)
-        self.multi_cell(w=0, h=self.ch, txt=label, align="C", fill=True)
-        self.ln(1)
-        self.set_text_color(r=0, g=0, b=0)
-        self.set_font("Arial", "", 12)
-        self.cell(w=30, h=self.ch, txt="Date: ", ln=0)
-        self.cell(w=30, h=self.ch, txt=str(date.today()), ln=1)
-        self.cell(w=30, h=self.ch, txt="Attribution:", ln=0)
-        self.cell(w=30, h=self.ch, txt="Highlander Project", ln=1)
-
-        self.ln(self.ch)
-
-    def report_body(self, label_map, file_path):
-        self.set_font("Arial", "B", 20)
-        self.multi_cell(w=0, h=self.ch, txt=label_map, align="C")
-        self.image(file_path, x=5, y=None, w=200, h=0, type="PNG", link="")
-        self.ln(self.ch)
 
 
 class SubsetReportDetails(Schema):
@@ -104,101 +64,171 @@ def get(
         time_period: Optional[str] = None,
         reference_period: Optional[str] = None,
     ) -> Any:
+        timer = StageTimer("report")
         # get the dataset
         dds = broker.get_instance()
-        dataset_details = dds.get_dataset_details([dataset_id])
+        with timer.stage("dataset_details"):
+            dataset_details = dds.get_dataset_details([dataset_id])
         if not dataset_details["data"]:
             raise NotFound(f"dataset {dataset_id} not found")
 
         # check if all the params of the output structure are present
-        endpoint_arguments = locals()
-        try:
-            for product, param_list in config.MANDATORY_PARAM_MAP[dataset_id].items():
-                if product == product_id or product == "all_products":
-                    for param in param_list:
-                        if not endpoint_arguments[param]:
-                            raise BadRequest(
-                                f"{param} parameter is needed for {product_id} product in {dataset_id}"
-                            )
-        except KeyError:
-            raise ServerError(f"{dataset_id} not found in Mandatory param map")
+        variables: Dict[str, Any] = {
+            "dataset_id": dataset_id,
+            "product_id": product_id,
+            "area_type": area_type,
+            "indicator": indicator,
+            "model_id": model_id,
+            "year": year,
+            "date": date,
+            "daily_metric": daily_metric,
+            "time_period": time_period,
+            "reference_period": reference_period,
+        }
+        CropEngine.checkMandatoryParams(dataset_id, product_id, variables)
 
         # get the output structure
         area_name = area_id.lower()
 
-        output_structure = config.getOutputPath(
-            dataset_id, product_id, endpoint_arguments
-        )
+        output_structure = config.getOutputPath(dataset_id, product_id, variables)
         if not output_structure:
             raise ServerError(
                 f"{dataset_id} or {product_id} keys not present in output structure map"
             )
+        timer.set_labels(dataset_id, product_id)
 
         output_dir = config.CROPS_OUTPUT_ROOT.joinpath(*output_structure)
         log.debug(f"Output dir: {output_dir}")
 
-        # get the map filename
-        map_filename = config.getOutputFilename("map", "png", "", area_name)
-        # build the filepath for map
-        map_filepath = Path(output_dir, map_filename)
-        if not map_filepath.is_file():
-            raise NotFound(
-                "Map file for requested report not found: Please use /crop api to create it"
-            )
+        # get the map and the plot filepaths
+        map_filepath, plot_filepath = CropEngine.getReportArtifacts(
+            dataset_id, area_name, output_dir, variables
+        )
 
-        # get the plot filename
-        # TODO the plot for the report will be the boxplot
-        if dataset_id != "era5-downscaled-over-italy":
-            plot_filename = config.getOutputFilename(
-                "plot", "png", "distribution", area_name
-            )
-            # build the filepath for plot
-            plot_filepath = Path(output_dir, plot_filename)
-        else:
-            plot_dir, plot_filename = config.getStripesOutputPath(
-                area_name, indicator, reference_period, time_period, area_type
+        # create the missing map and plot
+        self.create_missing_outputs(
+            dds,
+            dataset_details,
+            variables,
+            area_name,
+            map_filepath,
+            plot_filepath,
+            timer,
+        )
+
+        label_map, label_plot = CropEngine.getReportLabels(
+            dataset_id, area_id, output_structure, label, reference_period
+        )
+        report_filepath = CropEngine.writeReport(
+            dataset_details,
+            output_structure,
+            area_name,
+            label_map,
+            map_filepath,
+            label_plot,
+            plot_filepath,
+            timer=timer,
+        )
+
+        return timer.finalize(
+            send_file(
+                report_filepath,
+                download_name="highlander_report.pdf",
+                mimetype="application/pdf",
             )
-            plot_filepath = Path(plot_dir, plot_filename)
+        )
 
-        if not plot_filepath.is_file():
+    @staticmethod
+    def create_missing_outputs(
+        dds: Any,
+        dataset_details: Dict[str, Any],
+        variables: Dict[str, Any],
+        area_name: str,
+        map_filepath: Path,
+        plot_filepath: Path,
+        timer: StageTimer,
+    ) -> None:
+        """
+        Create the map and the plot of the report if they are not cached yet.
+        The map and the plot are shared with the crop and stripes endpoints
+        """
+        map_exists = is_fresh(map_filepath)
+        plot_exists = is_fresh(plot_filepath)
+        if map_exists and plot_exists:
+            return
+
+        dataset_id = variables["dataset_id"]
+        product_id = variables["product_id"]
+        if not variables["indicator"]:
+            missing = "Map" if not map_exists else "Plot"
             raise NotFound(
-                "Plot file for requested report not found: Please use /crop api to create it"
+                f"{missing} file for requested report not found: the indicator parameter is needed to create it"
             )
 
-        # get the dataset title
-        title = dataset_details["data"][0]["label"]
-
-        # create the labels
-        # label params are the same of the output structure excluding the dataset name (first element) and the area type (last element)
-
-        if not label:
-            label_params = output_structure[1:-1]
-            label = " - ".join(
-                l_par.replace("-", " ").title() for l_par in label_params
+        nc_cropped: Any = None
+        if not map_exists or dataset_id != "era5-downscaled-over-italy":
+            product_details = CropEngine.getProductDetails(
+                dataset_details, dataset_id, product_id
+            )
+            if not product_details:
+                raise NotFound(
+                    f"product {product_id} for dataset {dataset_id} not found"
+                )
+            # the data cropped for the map are reused for the plot
+            nc_cropped = CropEngine.getCrop(
+                dds,
+                dataset_id,
+                product_id,
+                product_details,
+                variables,
+                area_name,
+                variables["area_type"],
+                timer=timer,
             )
 
-        if dataset_id != "era5-downscaled-over-italy":
-            label_map = f"Map {area_id.title()} - {label}"
-            label_plot = f"Distribution of {area_id.title()} - {label}"
-        else:
-            label_map = (
-                f"{area_id.title()} - Map of {label} for the {reference_period} period"
+        if not map_exists:
+            CropEngine.plotCrop(
+                nc_cropped,
+                dataset_id,
+                product_id,
+                variables,
+                "map",
+                None,
+                "png",
+                map_filepath,
+                timer=timer,
             )
-            label_plot = f"{area_id.title()} - Anomaly of {label} compared to the average of the period {reference_period}"
-
-        pdf = PDF()
-        # get the dataset license
-        pdf.license = dataset_details["data"][0]["license"]["name"]
-        pdf.add_page()
-        pdf.report_title(title)
-        pdf.report_body(label_map, str(map_filepath))
-        pdf.report_body(label_plot, str(plot_filepath))
-
-        bytes_string = pdf.output(dest="S")
-        pdf_bytes = bytes_string.encode("latin-1")
-
-        return send_file(
-            io.BytesIO(pdf_bytes),
-            download_name="highlander_report.pdf",
-            mimetype="application/pdf",
-        )
+
+        if not plot_exists:
+            if dataset_id != "era5-downscaled-over-italy":
+                CropEngine.plotCrop(
+                    nc_cropped,
+                    dataset_id,
+                    product_id,
+                    variables,
+                    "plot",
+                    "distribution",
+                    "png",
+                    plot_filepath,
+                    timer=timer,
+                )
+            else:
+                with timer.stage("get_area"):
+                    area_name, area = PlotUtils.getArea(
+                        area_name, variables["area_type"]
+                    )
+                if area.empty:
+                    raise NotFound(
+                        f"Area {area_name} not found in {variables['area_type']}"
+                    )
+                CropEngine.plotStripes(
+                    dds,
+                    dataset_id,
+                    variables["indicator"],
+                    variables["reference_period"],
+                    variables["time_period"],
+                    area_name,
+                    area,
+                    plot_filepath,
+                    timer=timer,
+                )
@@ -1,34 +1,56 @@
+import base64
 import json
-import shutil
-from typing import Any, Dict, List, Mapping, Optional, Union, cast
+import mimetypes
+import unicodedata
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, List, Mapping, Optional, Tuple, Union, cast
+from urllib.parse import quote
 
+from celery import states
+from flask import make_response, send_file
+from highlander import scheduling
+from highlander.cancellation import cancel_request
 from highlander.connectors import broker
 from highlander.constants import DOWNLOAD_DIR
-from highlander.models.schemas import DataExtraction
+from highlander.coordinate_index import normalize_request
+from highlander.models.schemas import DataExtraction, RequestsListing
+from highlander.notifications import publish_status
+from highlander.output_formats import estimate_output_size
+from highlander.requests_count import count_requests, invalidate_requests_count
+from highlander.retention import get_output_path, remove_output_file, remove_paths
 from restapi import decorators
 from restapi.connectors import celery, sqlalchemy
-from restapi.exceptions import NotFound, ServerError, Unauthorized
+from restapi.env import Env
+from restapi.exceptions import BadRequest, NotFound, ServerError, Unauthorized
 from restapi.rest.definition import EndpointResource, Response
 from restapi.services.authentication import User
-from restapi.services.download import Downloader
 from restapi.utilities.logs import log
-from sqlalchemy import or_
-from sqlalchemy.orm import joinedload
+from sqlalchemy import or_, tuple_
+from sqlalchemy.orm import defer, joinedload
 from sqlalchemy.orm.exc import NoResultFound
 
 RequestArgs = Union[str, List[str], Dict[str, List[str]]]
 
+# internal location of the proxy serving the download dir (e.g. /protected-download/).
+# When set, the output files are sent by the proxy (X-Accel-Redirect)
+DOWNLOAD_ACCEL_REDIRECT = Env.get("DOWNLOAD_ACCEL_REDIRECT", "")
+
 
 class Requests(EndpointResource):
     labels = ["requests"]
 
     @decorators.auth.require()
     @decorators.get_pagination
+    @decorators.use_kwargs(RequestsListing, location="query")
     @decorators.endpoint(
         path="/requests",
         summary="Get submitted job requests",
+        description="Pages after the first one can be requested with the cursor "
+        "returned in the X-Next-Cursor header",
         responses={
             200: "List of submitted user requests",
+            400: "Invalid cursor",
             404: "No request found",
         },
     )
@@ -41,33 +63,46 @@ def get(
         sort_by: str,
         input_filter: str,
         user: User,
+        with_args: bool = True,
+        cursor: Optional[str] = None,
     ) -> Response:
 
         db = sqlalchemy.get_instance()
         if get_total:
-            counter = db.Request.query.filter_by(user_id=user.id).count()
-            return self.pagination_total(counter)
+            return self.pagination_total(count_requests(db, user.id))
 
-        log.debug("paging: page {0}, size {1}", page, size)
-        data = []
-        requests = (
-            db.Request.query.filter_by(user_id=user.id)
-            .options(joinedload(db.Request.output_file))
-            .order_by(db.Request.submission_date.desc())
-            .paginate(page, size, False)
-            .items
+        log.debug("paging: page {0}, size {1}, cursor {2}", page, size, cursor)
+        query = db.Request.query.filter_by(user_id=user.id).options(
+            joinedload(db.Request.output_file)
         )
+        if not with_args:
+            query = query.options(defer(db.Request.args))
+        query = query.order_by(db.Request.submission_date.desc(), db.Request.id.desc())
+        if cursor:
+            # keyset pagination: start after the last request of the previous page
+            last_date, last_id = decode_cursor(cursor)
+            query = query.filter(
+                tuple_(db.Request.submission_date, db.Request.id)
+                < tuple_(last_date, last_id)
+            )
+        elif page > 1:
+            query = query.offset((page - 1) * size)
+        requests = query.limit(size).all()
+
+        data = []
         for r in requests:
-            log.debug(r)
             item = {
                 "id": r.id,
                 "name": r.name,
                 "dataset_name": r.dataset_name,
-                "args": r.args,
                 "submission_date": r.submission_date.isoformat(),
                 "status": r.status,
                 "task_id": r.task_id,
             }
+            if with_args:
+                item["args"] = r.args
+            if r.queue:
+                item["queue"] = r.queue
             if r.end_date:
                 item["end_date"] = r.end_date.isoformat()
             if r.error_message:
@@ -79,7 +114,11 @@ def get(
                     "size": r.output_file.size,
                 }
             data.append(item)
-        return self.response(data)
+
+        headers = {}
+        if len(requests) == size:
+            headers["X-Next-Cursor"] = encode_cursor(requests[-1])
+        return self.response(data, headers=headers)
 
     @decorators.auth.require()
     @decorators.use_kwargs(DataExtraction)
@@ -89,12 +128,27 @@ def get(
         responses={
             202: "Data extraction request accepted",
             400: "Invalid request",
+            404: "Dataset or product does not exist",
         },
     )
     def post(self, dataset_name: str, user: User, **kwargs: RequestArgs) -> Response:
         c = celery.get_instance()
         log.debug("Request for extraction for <{}>", dataset_name)
         args = build_request_args(**kwargs)
+        dds = broker.get_instance()
+        # reject the requests out of the product coverage before enqueueing them
+        args = normalize_request(dds, dataset_name, args)
+
+        # route the request by its size
+        estimated_size: Optional[int] = None
+        try:
+            estimated_size = estimate_output_size(
+                dds.broker.estimate_size(dataset_name=dataset_name, request=dict(args)),
+                args["format"],
+            )
+        except Exception as exc:
+            log.warning("Unable to estimate the request size: {}", exc)
+        size_class = scheduling.classify(estimated_size)
 
         task = None
         db = sqlalchemy.get_instance()
@@ -106,17 +160,22 @@ def post(self, dataset_name: str, user: User, **kwargs: RequestArgs) -> Response
                 args=args,
                 user_id=user.id,
                 status="CREATED",
+                queue=size_class,
             )
             db.session.add(request)
             db.session.commit()
 
             task = c.celery_app.send_task(
-                "extract_data", args=[user.id, dataset_name, args, request.id]
+                "extract_data",
+                args=[user.id, dataset_name, args, request.id],
+                queue=scheduling.QUEUES[size_class],
+                priority=scheduling.get_priority(db, user.id, size_class),
             )
             request.task_id = task.id
             request.status = task.status  # 'PENDING'
             db.session.commit()
             log.info("Request <ID:{}> successfully saved", request.id)
+            invalidate_requests_count(user.id)
         except Exception as exc:
             log.exception(exc)
             db.session.rollback()
@@ -170,33 +229,72 @@ def delete(self, request_id: str, user: User) -> Response:
         if req.user_id != user.id:
             raise Unauthorized("Unauthorized request")
 
-        output_file = req.output_file
-        if output_file:
-            try:
-                db.session.delete(output_file)  # type: ignore
-                if output_file.timestamp:
-                    filepath = DOWNLOAD_DIR.joinpath(output_file.timestamp)
-                    shutil.rmtree(filepath)
-                else:
-                    filepath = DOWNLOAD_DIR.joinpath(output_file.filename)
-                    filepath.unlink()
-            except FileNotFoundError as error:
-                # silently pass when file is not found
-                log.warning(error)
+        # stop the task of an active request
+        if req.status in scheduling.ACTIVE_STATES:
+            cancel_request(req)
+
+        paths: List[Path] = []
+        if req.output_file:
+            paths = remove_output_file(db, req.output_file)
         db.session.delete(req)  # type: ignore
         db.session.commit()
+        # the files are removed once their rows are deleted
+        remove_paths(paths)
+        invalidate_requests_count(req.user_id)
         return self.response(f"Request ID<{request_id}> successfully removed")
 
 
+class RequestCancellation(EndpointResource):
+    labels = ["request"]
+
+    @decorators.auth.require()
+    @decorators.endpoint(
+        path="/requests/<request_id>/cancel",
+        summary="Cancel a queued or running request",
+        responses={
+            200: "Request cancelled successfully.",
+            400: "Request already completed.",
+            404: "Request does not exist.",
+        },
+    )
+    def post(self, request_id: str, user: User) -> Response:
+        log.debug("cancel request {}", request_id)
+        db = sqlalchemy.get_instance()
+        # check if the request exists, locking it until it is cancelled:
+        # the task of the request can't complete it in the meantime
+        req = db.Request.query.filter_by(id=int(request_id)).with_for_update().first()
+        if not req:
+            raise NotFound(f"Request ID<{request_id}> NOT found")
+
+        # check if the user owns the request
+        if req.user_id != user.id:
+            raise Unauthorized("Unauthorized request")
+
+        if req.status not in scheduling.ACTIVE_STATES:
+            raise BadRequest(f"Request ID<{request_id}> already completed")
+
+        cancel_request(req)
+        req.status = states.REVOKED
+        req.error_message = "Cancelled by the user"
+        req.end_date = datetime.utcnow()
+        db.session.commit()
+        publish_status(user.id, req)
+        return self.response(f"Request ID<{request_id}> successfully cancelled")
+
+
 class DownloadData(EndpointResource):
     @decorators.auth.require(allow_access_token_parameter=True)
     @decorators.endpoint(
         path="/download/<timestamp>",
         summary="Download output file",
+        description="Interrupted downloads can be resumed with a Range request",
         responses={
             200: "File successfully downloaded",
+            206: "Requested range of the file successfully downloaded",
+            304: "File not modified",
             401: "Unauthorized request",
             404: "File not found",
+            416: "Requested range not satisfiable",
         },
     )
     def get(self, timestamp: str, user: User) -> Response:
@@ -216,18 +314,14 @@ def get(self, timestamp: str, user: User) -> Response:
             # check if user owns the file
             if output_file.request.user_id != user.id:
                 raise Unauthorized("Unauthorized request")
-            file_dir = DOWNLOAD_DIR
-            if output_file.timestamp:
-                file_dir = DOWNLOAD_DIR.joinpath(output_file.timestamp)
-            file_path = file_dir.joinpath(output_file.filename)
-            if not file_path.exists():
-                log.error(
-                    f"Expected filename <{output_file.filename}> in the path {file_dir}"
-                )
+            file_path = get_output_path(output_file)
+            if not file_path:
+                log.error("Output file <{}> not found", output_file.filename)
                 raise FileNotFoundError()
-            return Downloader.send_file_streamed(
-                file_path.name, subfolder=file_path.parent
-            )
+            # the least recently used outputs are the first ones to be evicted
+            output_file.last_access = datetime.utcnow()
+            db.session.commit()
+            return send_output_file(file_path)
         except (NoResultFound, FileNotFoundError):
             raise NotFound(f"OutputFile with TIMESTAMP<{timestamp}> NOT found")
 
@@ -240,7 +334,11 @@ class EstimateSize(EndpointResource):
     @decorators.endpoint(
         path="/estimate-size/<dataset_name>",
         summary="Estimate request size",
-        responses={200: "Estimated size", 404: "Dataset does not exist"},
+        responses={
+            200: "Estimated size",
+            400: "Invalid request",
+            404: "Dataset or product does not exist",
+        },
     )
     def post(self, dataset_name: str, user: User, **kwargs: RequestArgs) -> Response:
         log.debug(f"Estimate size for dataset <{dataset_name}>")
@@ -248,17 +346,85 @@ def post(self, dataset_name: str, user: User, **kwargs: RequestArgs) -> Response
         log.debug(f"request: {args}")
 
         dds = broker.get_instance()
-        if dataset_name not in dds.get_datasets([dataset_name]):
-            raise NotFound(f"Dataset <{dataset_name}> does not exist")
+        # the dataset and the coverage of the request are checked on the index
+        args = normalize_request(dds, dataset_name, args)
         try:
             estimated_size = dds.estimate_size_check(
                 dataset_name=dataset_name, request=args
             )
         except Exception as e:
             raise ServerError(f"Unable to get size estimation: {e}")
+        # the outputs are compressed (or converted to text)
+        estimated_size = estimate_output_size(estimated_size, args["format"])
         return self.response(estimated_size)
 
 
+def encode_cursor(request: Any) -> str:
+    position = f"{request.submission_date.isoformat()}|{request.id}"
+    return base64.urlsafe_b64encode(position.encode()).decode()
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    try:
+        position = base64.urlsafe_b64decode(cursor.encode()).decode()
+        submission_date, request_id = position.split("|")
+        return datetime.fromisoformat(submission_date), int(request_id)
+    except ValueError:
+        raise BadRequest("Invalid cursor")
+
+
+def get_filename_options(filename: str) -> Dict[str, str]:
+    """
+    Filename options of the Content-Disposition, as set by send_file:
+    the non ascii names are sent encoded (RFC 5987) with an ascii fallback
+    """
+    try:
+        filename.encode("ascii")
+    except UnicodeEncodeError:
+        simple = unicodedata.normalize("NFKD", filename)
+        simple = simple.encode("ascii", "ignore").decode("ascii")
+        # safe = RFC 5987 attr-char
+        quoted = quote(filename, safe="!#$&+-.^_`|~")
+        return {"filename": simple, "filename*": f"UTF-8''{quoted}"}
+    return {"filename": filename}
+
+
+def send_output_file(file_path: Path) -> Response:
+    """
+    Send an output file supporting the conditional and the range requests
+    (Range, If-Range, If-None-Match) to resume the interrupted downloads
+    """
+    mimetype = mimetypes.guess_type(file_path.name)[0] or "application/octet-stream"
+    # the proxy can send only the files of the download dir (not of the cold storage)
+    if DOWNLOAD_ACCEL_REDIRECT and file_path.is_relative_to(DOWNLOAD_DIR):
+        # the proxy sends the file and handles the ranges and the validators
+        response = make_response("")
+        # the uri is decoded by the proxy: spaces and non-ascii chars are quoted
+        response.headers["X-Accel-Redirect"] = "{}/{}".format(
+            DOWNLOAD_ACCEL_REDIRECT.rstrip("/"),
+            quote(file_path.relative_to(DOWNLOAD_DIR).as_posix()),
+        )
+        response.headers["Content-Type"] = mimetype
+        # the options are quoted when needed
+        response.headers.set(
+            "Content-Disposition",
+            "attachment",
+            **get_filename_options(file_path.name),
+        )
+        return response
+
+    stat = file_path.stat()
+    return send_file(
+        file_path,
+        mimetype=mimetype,
+        as_attachment=True,
+        download_name=file_path.name,
+        conditional=True,
+        etag=f"{stat.st_size:x}-{stat.st_mtime_ns:x}",
+        max_age=0,
+    )
+
+
 def build_request_args(**kwargs: RequestArgs) -> Mapping[str, Any]:
     payload = kwargs.copy()
     log.debug(json.dumps(payload, indent=2, sort_keys=True))
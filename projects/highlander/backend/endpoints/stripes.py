@@ -1,15 +1,16 @@
 from pathlib import Path
 from typing import Any, Dict, List, Optional, Union
 
-import xarray as xr
 from flask import send_file, send_from_directory
 from highlander.connectors import broker
+from highlander.crop_manifest import is_fresh
 from highlander.endpoints.utils import MapCropConfig as config
-from highlander.endpoints.utils import PlotUtils
+from highlander.endpoints.utils import CropEngine, PlotUtils
+from highlander.metrics import StageTimer
 from marshmallow import ValidationError, pre_load
 from restapi import decorators
 from restapi.connectors import Connector
-from restapi.exceptions import NotFound, ServerError
+from restapi.exceptions import NotFound
 from restapi.models import Schema, fields, validate
 from restapi.rest.definition import EndpointResource, Response
 from restapi.services.authentication import User
@@ -74,9 +75,15 @@ def get(
         area_id: Optional[str] = None,
     ) -> Response:
 
+        timer = StageTimer("stripes")
+        dds = broker.get_instance()
+        if dataset_id in dds.broker.list_datasets():
+            timer.set_labels(dataset_id, indicator)
         # Normalise area_id names to standard format that cope with the different geojson structures.
+        area = None
         if administrative != "Italy":
-            area_name, area = PlotUtils.getArea(area_id, administrative)
+            with timer.stage("get_area"):
+                area_name, area = PlotUtils.getArea(area_id, administrative)
 
             if area.empty:
                 raise NotFound(f"Area {area_name} not found in {administrative}")
@@ -92,81 +99,19 @@ def get(
         output_filepath = Path(output_dir, output_filename)
 
         # Check if the stripes have already been created.
-        # If they already exist.
-        if output_filepath.is_file() and output_filepath.stat().st_size >= 1:
-            return send_file(output_filepath)
-            # Testing output:
-            # res = f"OK / Stripes already created at {output_filepath}"
-            # return self.response(res)
-
         # If they do not exist yet, then, create them.
-        else:
-
-            # We define a STRIPES_INPUT_ROOT using the details of a dataset available in the dds.
-            dds = broker.get_instance()
-            try:
-                product_urlpath = dds.broker.catalog[dataset_id][
-                    "VHR-REA_IT_1981_2020_hourly"
-                ].urlpath
-                product_urlpath_root = product_urlpath.split("vhr-rea")[0]
-            except Exception as exc:
-                raise NotFound(f"Unable to get dataset url root: {exc}")
-
-            # Check if input data exists.
-            input_filename = f"{indicator}_1981-2020_{time_period}_anomalies_vs_{reference_period}.nc"
-            data_filepath = Path(
-                product_urlpath_root, "climate_stripes", input_filename
+        if not is_fresh(output_filepath):
+            CropEngine.plotStripes(
+                dds,
+                dataset_id,
+                indicator,
+                reference_period,
+                time_period,
+                area_name,
+                area,
+                output_filepath,
+                timer=timer,
             )
 
-            if data_filepath.is_file() is False:
-                raise NotFound(
-                    f"Data file {input_filename} not found in {data_filepath}"
-                )
-
-            # If necessary crop the area.
-            if administrative != "Italy":
-                try:
-                    nc_data_to_plot = PlotUtils.cropArea(
-                        data_filepath, area_name, area, indicator, decode_time=True
-                    )
-                except Exception as exc:
-                    raise ServerError(f"Errors in cropping the data: {exc}")
-                else:
-                    nc_data_to_plot_mean = nc_data_to_plot.mean(
-                        axis=(1, 2)
-                    ).values.reshape((1, len(nc_data_to_plot.time)))
-                    nc_data_to_plot_years = [
-                        str(x.astype("datetime64[Y]"))
-                        for x in nc_data_to_plot.time.values
-                    ]
-            # Otherwise simply load data
-            else:
-                nc_data = xr.open_dataset(data_filepath)
-                nc_data_to_plot = nc_data[indicator][:]
-                nc_data_to_plot_mean = nc_data_to_plot.mean(axis=(1, 2)).values.reshape(
-                    (1, len(nc_data_to_plot.time))
-                )
-                nc_data_to_plot_years = [
-                    str(x.astype("datetime64[Y]")) for x in nc_data_to_plot.time.values
-                ]
-
-            # Create the output directory if it does not exists.
-            if not output_dir.is_dir():
-                output_dir.mkdir(parents=True, exist_ok=True)
-
-            # Plot stripes.
-            try:
-                PlotUtils.plotStripes(
-                    nc_data_to_plot_mean,
-                    nc_data_to_plot_years,
-                    area_name,
-                    output_filepath,
-                )
-            except Exception as exc:
-                raise ServerError(f"Errors in plotting the data: {exc}")
-
-            # Send the output
-            return send_file(output_filepath)
-            # Testing output:
-            # res = f"OK / Stripes created at {output_filepath}"
-            # return self.response(res)
+        # Send the output
+        return timer.finalize(send_file(output_filepath))
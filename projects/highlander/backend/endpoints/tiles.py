@@ -0,0 +1,35 @@
+from typing import Any
+
+from highlander.static_assets import send_static_file
+from highlander.vector_tiles import MAX_ZOOM, get_tile, is_valid_tile
+from restapi import decorators
+from restapi.exceptions import BadRequest, NotFound
+from restapi.rest.definition import EndpointResource
+
+MVT_MIMETYPE = "application/vnd.mapbox-vector-tile"
+
+
+class BoundaryTiles(EndpointResource):
+    @decorators.endpoint(
+        path="/tiles/<administrative>/<int:z>/<int:x>/<int:y>.mvt",
+        summary="Get a vector tile of the administrative boundaries",
+        description=f"Mapbox vector tiles, up to zoom {MAX_ZOOM}",
+        responses={
+            200: "tile successfully retrieved",
+            204: "no boundaries in the tile",
+            304: "tile not modified",
+            400: "invalid tile coordinates",
+            404: "administrative level not found",
+        },
+    )
+    def get(self, administrative: str, z: int, x: int, y: int) -> Any:
+        if not is_valid_tile(z, x, y):
+            raise BadRequest(f"Invalid tile {z}/{x}/{y}")
+        try:
+            tile_path = get_tile(administrative, z, x, y)
+        except FileNotFoundError:
+            raise NotFound(f"boundaries for {administrative} not found")
+
+        if not tile_path.stat().st_size:
+            return self.empty_response()
+        return send_static_file(tile_path, MVT_MIMETYPE)
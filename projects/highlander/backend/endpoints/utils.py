@@ -1,22 +1,38 @@
+import datetime
+import hashlib
+import io
+import json
 import math
 import os
+import string
+import threading
 import warnings
 from pathlib import Path
-from typing import Any, List, Optional
+from typing import Any, Dict, List, Mapping, Optional, Tuple
 
 import cartopy  # type: ignore
 import cartopy.crs as ccrs  # type: ignore
 import geopandas as gpd  # type: ignore
 import matplotlib as mpl  # type: ignore
-import matplotlib.pyplot as plt  # type: ignore
 import numpy as np
 import pandas as pd  # type: ignore
 import regionmask  # type: ignore
 import requests
 import seaborn as sns  # type: ignore
 import xarray as xr  # type: ignore
+import yaml
+from fpdf import FPDF
+from highlander.crop_manifest import is_fresh, record_output
+from highlander.metrics import StageTimer, stage
+from highlander.models.schemas import MapCropSettings as MapCropSettingsSchema
+from highlander.static_assets import write_atomic
+from marshmallow import ValidationError
 from matplotlib import cm
-from restapi.exceptions import ServerError
+from matplotlib.backends.backend_agg import FigureCanvasAgg  # type: ignore
+from matplotlib.figure import Figure  # type: ignore
+from PIL import Image
+from restapi.env import Env
+from restapi.exceptions import BadRequest, NotFound, ServerError
 from restapi.utilities.logs import log
 
 # set the cartopy data_dir
@@ -25,535 +41,261 @@
 )
 
 
-class MapCropConfig:
-    GEOJSON_PATH = "/catalog/assets"
+# request parameters that can be used in the templates of the map crop config
+TEMPLATE_FIELDS = {
+    "dataset_id",
+    "product_id",
+    "model_id",
+    "model_filename",
+    "year",
+    "date",
+    "indicator",
+    "daily_metric",
+    "time_period",
+    "reference_period",
+    "area_type",
+}
+ALL_PRODUCTS = "all_products"
+
+# dpi of the rendered images by resolution
+RESOLUTIONS = {"thumbnail": 20, "screen": 100, "print": 300}
+DEFAULT_RESOLUTION = "screen"
+# png: lossless, png8: png with a quantized palette, webp: lossy webp
+IMAGE_FORMATS = {"png": "png", "png8": "png", "webp": "webp"}
+WEBP_QUALITY = 80
+# variable of the cached cropped data, shared by the outputs of an area
+CROP_VARIABLE = "data"
+
+# font sizes of the plots. They are passed to the artists instead of being set
+# in the rcParams, that are global to the process: the figures are drawn
+# concurrently and each one keeps its own style
+MAP_FONT_SIZE = 15
+PLOT_FONT_SIZE = 14
+STRIPES_FONT_SIZE = 25
+# the seaborn "ticks" style of the boxplots, at the "notebook" scale
+TICKS_COLOR = ".15"
+
+
+def new_figure(**kwargs: Any) -> Figure:
+    """
+    Figure drawn on an Agg canvas. Unlike the pyplot figures it is not kept
+    in a global registry and it is freed with its last reference
+    """
+    fig = Figure(**kwargs)
+    FigureCanvasAgg(fig)
+    return fig
+
+
+class CompiledTemplate:
+    """
+    A str.format template with the list of its fields
+    """
+
+    def __init__(self, template: str) -> None:
+        self.template = template
+        self.fields = tuple(
+            field for _, field, _, _ in string.Formatter().parse(template) if field
+        )
+        unknown_fields = set(self.fields) - TEMPLATE_FIELDS
+        if unknown_fields:
+            raise ValueError(f"Unknown fields {unknown_fields} in <{template}>")
+
+    def format(self, variables: Mapping[str, Any]) -> str:
+        return self.template.format(**{f: variables[f] for f in self.fields})
+
+
+class MapStyle:
+    def __init__(self, colormap: str, levels: List[float]) -> None:
+        try:
+            self.cmap = mpl.colormaps[colormap]
+        except KeyError:
+            raise ValueError(f"Unknown colormap <{colormap}>")
+        self.levels = levels
+
+
+class MapCropSettings:
+    """
+    Lookup tables of the map crop engine precompiled from the yaml configuration
+    """
+
+    def __init__(self, config: Mapping[str, Any]) -> None:
+        self.product_exception: Dict[str, Dict[str, str]] = config.get(
+            "product_exception", {}
+        )
+        self.models_mapping: Dict[str, str] = config.get("models_mapping", {})
+        self.variables: Dict[str, str] = config["variables"]
+        self.products_without_time = frozenset(config.get("products_without_time", []))
+        self.output_structure: Dict[str, Dict[str, List[str]]] = config[
+            "output_structure"
+        ]
+        # params needed by each product: the ones common to all the products come first
+        self.mandatory_params: Dict[str, Dict[str, Tuple[str, ...]]] = {}
+        for dataset_id, products in config["mandatory_params"].items():
+            common = tuple(products.get(ALL_PRODUCTS, []))
+            self.mandatory_params[dataset_id] = {
+                p: common + tuple(params)
+                for p, params in products.items()
+                if p != ALL_PRODUCTS
+            }
+            self.mandatory_params[dataset_id][ALL_PRODUCTS] = common
+        self.source_files: Dict[str, Dict[str, CompiledTemplate]] = {
+            dataset_id: {p: CompiledTemplate(url) for p, url in products.items()}
+            for dataset_id, products in config["source_files"].items()
+        }
+        self.geoserver_layers: Dict[str, Dict[str, CompiledTemplate]] = {
+            dataset_id: {p: CompiledTemplate(layer) for p, layer in products.items()}
+            for dataset_id, products in config.get("geoserver_layers", {}).items()
+        }
+        self.map_styles: Dict[str, MapStyle] = {
+            name: MapStyle(**style) for name, style in config["map_styles"].items()
+        }
+
+    def get_product_alias(self, dataset_id: str, product_id: str) -> Optional[str]:
+        return self.product_exception.get(dataset_id, {}).get(product_id)
+
+    def get_mandatory_params(self, dataset_id: str, product_id: str) -> Tuple[str, ...]:
+        """
+        :raises KeyError: if the dataset is not configured
+        """
+        products = self.mandatory_params[dataset_id]
+        return products.get(product_id, products[ALL_PRODUCTS])
+
+    def get_output_structure(self, dataset_id: str, product_id: str) -> List[str]:
+        """
+        :raises KeyError: if the dataset or the product are not configured
+        """
+        products = self.output_structure[dataset_id]
+        if ALL_PRODUCTS in products:
+            return products[ALL_PRODUCTS]
+        return products[product_id]
+
+    def get_model_filename(self, model_id: str) -> str:
+        model_filename = model_id
+        for m, v in self.models_mapping.items():
+            if m in model_id:
+                model_filename = model_id.replace(m, v)
+        return model_filename
+
+    def get_source_file(
+        self, dataset_id: str, product_id: str, variables: Mapping[str, Any]
+    ) -> str:
+        """
+        :raises KeyError: if the dataset or the product are not configured
+        """
+        return self.source_files[dataset_id][product_id].format(variables)
+
+    def get_geoserver_layer(
+        self, dataset_id: str, product_id: str, variables: Mapping[str, Any]
+    ) -> str:
+        try:
+            template = self.geoserver_layers[dataset_id][product_id]
+        except KeyError:
+            return ""
+        return template.format(variables)
+
+    def has_time(self, product_id: str) -> bool:
+        return product_id not in self.products_without_time
+
+    def get_map_style(self, product: str, main_product: str) -> MapStyle:
+        """
+        :raises LookupError: if no style is defined for the product
+        """
+        if main_product in self.map_styles:
+            return self.map_styles[main_product]
+        # check if its legend is common with the one of the main product
+        if product in self.map_styles:
+            return self.map_styles[product]
+        raise LookupError(
+            f"plotting style not defined for product {main_product} (product long name: {product})"
+        )
 
-    PRODUCT_EXCEPTION = {
-        "human-wellbeing": {"multi-year": "daily", "anomalies": "daily"},
-        "soil-erosion": {
-            "rainfall-erosivity-anomalies": "rainfall-erosivity-proj",
-            "soil-loss-anomalies": "soil-loss-proj",
-        },
-        "land-suitability-for-forests": {
-            "bioclimatic-precipitations-hist": "bioclimatic-variables-hist",
-            "bioclimatic-precipitations-proj": "bioclimatic-variables-proj",
-            "bioclimatic-temperatures-hist": "bioclimatic-variables-hist",
-            "bioclimatic-temperatures-proj": "bioclimatic-variables-proj",
-        },
-    }
 
+class MapCropConfig:
+    GEOJSON_PATH = "/catalog/assets"
     CROPS_OUTPUT_ROOT = Path("/catalog/crops/")
     STRIPES_OUTPUT_ROOT = Path("/catalog/climate_stripes/")
 
-    # variable used for the cases where the model name and the file name does not match
-    MODELS_MAPPING = {"RF": "R"}
-
-    # mandatory params for the different datasets and their different products
-    MANDATORY_PARAM_MAP = {
-        "soil-erosion": {"all_products": ["model_id"]},
-        "human-wellbeing": {
-            "all_products": ["daily_metric", "indicator"],
-            "daily": ["year", "date"],
-            "anomalies": ["time_period"],
-        },
-        "era5-downscaled-over-italy": {
-            "all_products": ["time_period", "indicator", "reference_period"]
-        },
-        "land-suitability-for-forests": {"all_products": ["indicator"]},
-    }
-
-    # output structure for the different datasets and their different products
-    OUTPUT_STRUCTURE_MAP = {
-        "soil-erosion": {
-            "all_products": ["dataset_id", "product_id", "model_id", "area_type"]
-        },
-        "human-wellbeing": {
-            "daily": [
-                "dataset_id",
-                "product_id",
-                "indicator",
-                "year",
-                "date",
-                "area_type",
-            ],
-            "multi-year": ["dataset_id", "product_id", "indicator", "area_type"],
-            "anomalies": [
-                "dataset_id",
-                "product_id",
-                "indicator",
-                "time_period",
-                "area_type",
-            ],
-        },
-        "era5-downscaled-over-italy": {
-            "all_products": [
-                "dataset_id",
-                "product_id",
-                "indicator",
-                "reference_period",
-                "time_period",
-                "area_type",
-            ],
-        },
-        "land-suitability-for-forests": {
-            "all_products": ["dataset_id", "product_id", "indicator", "area_type"],
-        },
-    }
-
-    # url where to find source data files for the different datasets
-    SOURCE_FILE_URL_MAP = {
-        "soil-erosion": {
-            "rainfall-erosivity": {
-                "url": "soil-erosion/Rfactor/model_filename_1991_2020_VHR-REA_regular.nc",
-                "params": ["model_filename"],
-            },
-            "soil-loss": {
-                "url": "soil-erosion/SoilLoss/model_filename_1991_2020_VHR-REA.nc",
-                "params": ["model_filename"],
-            },
-            "rainfall-erosivity-anomalies": {
-                "url": "soil-erosion/Rfactor-anomalies/model_filename_2021_2050_ass_1991_2020_VHR-PRO_regular.nc",
-                "params": ["model_filename"],
-            },
-            "soil-loss-anomalies": {
-                "url": "soil-erosion/SoilLoss-anomalies/model_filename_2021_2050_ass_1991_2020_VHR-PRO.nc",
-                "params": ["model_filename"],
-            },
-        },
-        "human-wellbeing": {
-            "daily": {
-                "url": "human-wellbeing/reanalysis/regular/indicator_year_daily_metric_VHR-REA_regular.nc",
-                "params": ["indicator", "year", "daily_metric"],
-            },
-            "multi-year": {
-                "url": "human-wellbeing/multiyear/regular/indicator_1989-2020_daily_metric_VHR-REA_multiyearmean.nc",
-                "params": [
-                    "indicator",
-                    "daily_metric",
-                ],
-            },
-            "anomalies": {
-                "url": "human-wellbeing/anomalies/indicator_2021-2050vs1991-2020_daily_metric_VHR-PRO_time_period_ymean.nc",
-                "params": ["indicator", "daily_metric", "time_period"],
-            },
-        },
-        "era5-downscaled-over-italy": {
-            "VHR-REA_IT_1981_2020": {
-                "url": "climate_stripes/indicator_reference_period_monmean_time_period.nc",
-                "params": ["indicator", "reference_period", "time_period"],
-            },
-        },
-        "land-suitability-for-forests": {
-            "bioclimatic-precipitations-hist": {
-                "url": "land-suitability-for-forests/BIO_HIST_FINALI/indicator_edited2.nc",
-                "params": ["indicator"],
-            },
-            "bioclimatic-precipitations-proj": {
-                "url": "land-suitability-for-forests/BIO_PROJ/indicator_21_50.nc",
-                "params": ["indicator"],
-            },
-            "bioclimatic-temperatures-hist": {
-                "url": "land-suitability-for-forests/BIO_HIST_FINALI/indicator_edited2.nc",
-                "params": ["indicator"],
-            },
-            "bioclimatic-temperatures-proj": {
-                "url": "land-suitability-for-forests/BIO_PROJ/indicator_21_50.nc",
-                "params": ["indicator"],
-            },
-            "forest-species-suitability-hist": {
-                "url": "land-suitability-for-forests/SUIT_HIST/FOREST_HIST_SUITABILITY.nc",
-            },
-            "forest-species-suitability-proj": {
-                "url": "land-suitability-for-forests/SUIT_PROJ/FOREST_FUTU_SUITABILITY.nc",
-            },
-        },
-    }
-
-    # list of product that doesn't have the time dimension in theirs nc files
-    PRODUCT_WOUT_TIME = [
-        "bioclimatic-precipitations-hist",
-        "bioclimatic-precipitations-proj",
-        "bioclimatic-temperatures-hist",
-        "bioclimatic-temperatures-proj",
-        "forest-species-suitability-hist",
-        "forest-species-suitability-proj",
-    ]
-
-    # map for indicator and variables
-    VARIABLES_MAP = {
-        # soil erosion
-        "RF": "rf",
-        "SL": "sl",
-        # human wellbeing
-        "WC": "wc",
-        "H": "h",
-        "DI": "di",
-        "AT": "at",
-        # era5
-        "T_2M": "T_2M",
-        "TMAX_2M": "TMAX_2M",
-        "TMIN_2M": "TMIN_2M",
-        # suitability for forest
-        "BIO1": "bio1",
-        "BIO2": "bio2",
-        "BIO3": "bio3",
-        "BIO4": "bio4",
-        "BIO5": "bio5",
-        "BIO6": "bio6",
-        "BIO7": "bio7",
-        "BIO8": "bio8",
-        "BIO9": "bio9",
-        "BIO10": "bio10",
-        "BIO11": "bio11",
-        "BIO12": "bio12",
-        "BIO13": "bio13",
-        "BIO14": "bio14",
-        "BIO15": "bio15",
-        "BIO16": "bio16",
-        "BIO17": "bio17",
-        "BIO18": "bio18",
-        "BIO19": "bio19",
-        "Abies_alba": "Abies_alba",
-        "Acer_campestre": "Acer_campestre",
-        "Carpinus_betulus": "Carpinus_betulus",
-        "Castanea_sativa": "Castanea_sativa",
-        "Corylus_sp": "Corylus_sp",
-        "Fagus_sylvatica": "Fagus_sylvatica",
-        "Fraxinus_ornus": "Fraxinus_ornus",
-        "Larix_decidua": "Larix_decidua",
-        "Ostrya_carpinifolia": "Ostrya_carpinifolia",
-        "Picea_abies": "Picea_abies",
-        "Pinus_cembra": "Pinus_cembra",
-        "Pinus_halepensis": "Pinus_halepensis",
-        "Pinus_pinaster": "Pinus_pinaster",
-        "Pinus_sylvestris": "Pinus_sylvestris",
-        "Quercus_cerris": "Quercus_cerris",
-        "Quercus_ilex": "Quercus_ilex",
-        "Quercus_petraea": "Quercus_petraea",
-        "Quercus_pubescens": "Quercus_pubescens",
-        "Quercus_robur": "Quercus_robur",
-        "Quercus_suber": "Quercus_suber",
-    }
-
-    # name of geoserver layers for the different datasets and their different products (needed to get the legend intervals)
-    GEOSERVER_LAYER_MAP = {
-        # for now are mapped only the products with legends not directly related to the single products
-        "human-wellbeing": {
-            "daily": {
-                "layer": "highlander:indicator_year_daily_metric_VHR-REA_regular",
-                "params": ["indicator", "year", "daily_metric"],
-            },
-            "multi-year": {
-                "layer": "highlander:indicator_1989-2020_daily_metric_VHR-REA_multiyearmean",
-                "params": [
-                    "indicator",
-                    "daily_metric",
-                ],
-            },
-            "anomalies": {
-                "layer": "highlander:indicator_anomalies_daily_metric_time_period",
-                "params": ["indicator", "daily_metric", "time_period"],
-            },
-        },
-        "land-suitability-for-forests": {
-            "bioclimatic-precipitations-hist": {
-                "layer": "highlander:indicator_1991_2020",
-                "params": ["indicator"],
-            },
-            "bioclimatic-precipitations-proj": {
-                "layer": "highlander:indicator_2021_2050",
-                "params": ["indicator"],
-            },
-            "bioclimatic-temperatures-hist": {
-                "layer": "highlander:indicator_1991_2020",
-                "params": ["indicator"],
-            },
-            "bioclimatic-temperatures-proj": {
-                "layer": "highlander:indicator_2021_2050",
-                "params": ["indicator"],
-            },
-            "forest-species-suitability-hist": {
-                "layer": "highlander:indicator_1991_2020",
-                "params": ["indicator"],
-            },
-            "forest-species-suitability-proj": {
-                "layer": "highlander:indicator_2021_2050",
-                "params": ["indicator"],
-            },
-        },
-        "era5-downscaled-over-italy": {
-            "VHR-REA_IT_1981_2020": {
-                "layer": "highlander:indicator_reference_period_monmean_time_period",
-                "params": ["indicator", "reference_period", "time_period"],
-            }
-        },
-    }
-
-    # map of themes and level for cropped map
-    MAP_STYLES = {
-        "r-factor": {
-            "colormap": "mpl.cm.viridis_r",
-            "levels": [0, 500, 1000, 1500, 2000, 2500, 3000, 4000, 6000, 8000, 10000],
-        },
-        "soil-loss": {
-            "colormap": "mpl.cm.Oranges",
-            "levels": [0, 1, 2.5, 5, 10, 50, 100, 500, 1000, 2000],
-        },
-        "rainfall-erosivity-anomalies": {
-            "colormap": "mpl.cm.viridis",
-            "levels": [
-                -300,
-                -250,
-                -200,
-                -150,
-                -100,
-                -50,
-                0,
-                50,
-                100,
-                150,
-                200,
-                250,
-                300,
-                350,
-                400,
-                450,
-                500,
-                550,
-                600,
-                650,
-                700,
-            ],
-        },
-        "soil-loss-anomalies": {
-            "colormap": "mpl.cm.viridis",
-            "levels": [
-                -300,
-                -250,
-                -200,
-                -150,
-                -100,
-                -50,
-                0,
-                50,
-                100,
-                150,
-                200,
-                250,
-                300,
-                350,
-                400,
-                450,
-                500,
-                550,
-                600,
-                650,
-                700,
-            ],
-        },
-        "apparent-temperature": {
-            "colormap": "mpl.cm.nipy_spectral",
-            "levels": [
-                -30,
-                -25,
-                -20,
-                -15,
-                -10,
-                -5,
-                0,
-                5,
-                10,
-                15,
-                20,
-                25,
-                30,
-                35,
-                40,
-                45,
-            ],  # 50,],
-        },
-        "discomfort-index-Thom": {
-            "colormap": "mpl.cm.nipy_spectral",
-            "levels": [
-                -30,
-                -25,
-                -20,
-                -15,
-                -10,
-                -5,
-                0,
-                5,
-                10,
-                15,
-                20,
-                25,
-                30,
-                35,
-                40,
-                45,
-            ],  # 50,],
-        },
-        "humidex": {
-            "colormap": "mpl.cm.nipy_spectral",
-            "levels": [
-                -30,
-                -25,
-                -20,
-                -15,
-                -10,
-                -5,
-                0,
-                5,
-                10,
-                15,
-                20,
-                25,
-                30,
-                35,
-                40,
-                45,
-            ],  # 50,],
-        },
-        "wind-chill": {
-            "colormap": "mpl.cm.nipy_spectral",
-            "levels": [
-                -30,
-                -25,
-                -20,
-                -15,
-                -10,
-                -5,
-                0,
-                5,
-                10,
-                15,
-                20,
-                25,
-                30,
-                35,
-                40,
-                45,
-            ],  # 50,],
-        },
-        "2m temperature": {
-            "colormap": "mpl.cm.nipy_spectral",
-            "levels": [
-                -15,
-                -10,
-                -5,
-                0,
-                5,
-                10,
-                15,
-                20,
-                25,
-                30,
-                35,
-            ],
-        },
-        "2m maximum temperature": {
-            "colormap": "mpl.cm.nipy_spectral",
-            "levels": [
-                -15,
-                -10,
-                -5,
-                0,
-                5,
-                10,
-                15,
-                20,
-                25,
-                30,
-                35,
-            ],
-        },
-        "2m minimum temperature": {
-            "colormap": "mpl.cm.nipy_spectral",
-            "levels": [
-                -15,
-                -10,
-                -5,
-                0,
-                5,
-                10,
-                15,
-                20,
-                25,
-                30,
-                35,
-            ],
-        },
-        "bioclimatic-precipitations-hist": {
-            # TODO
-            "colormap": "mpl.cm.Blues",
-            "levels": [50, 75, 100, 250, 500, 750, 1000, 1500, 2000, 2500, 3000, 3500],
-        },
-        "bioclimatic-precipitations-proj": {
-            # TODO
-            "colormap": "mpl.cm.Blues",
-            "levels": [50, 75, 100, 250, 500, 750, 1000, 1500, 2000, 2500, 3000, 3500],
-        },
-        "bioclimatic-temperatures-hist": {
-            # TODO
-            "colormap": "mpl.cm.turbo",
-            "levels": [
-                -15,
-                -10,
-                -5,
-                0,
-                5,
-                10,
-                15,
-                20,
-                25,
-                30,
-                35,
-                40,
-            ],
-        },
-        "bioclimatic-temperatures-proj": {
-            # TODO
-            "colormap": "mpl.cm.turbo",
-            "levels": [
-                -15,
-                -10,
-                -5,
-                0,
-                5,
-                10,
-                15,
-                20,
-                25,
-                30,
-                35,
-                40,
-            ],
-        },
-        "forest-species-suitability-hist": {
-            # TODO
-            "colormap": "mpl.cm.Greens",
-            "levels": [0, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0],
-        },
-        "forest-species-suitability-proj": {
-            # TODO
-            "colormap": "mpl.cm.Greens",
-            "levels": [0, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0],
-        },
-    }
+    # yaml file with the dataset specific configuration of the crop engine
+    SETTINGS_PATH = Path(
+        Env.get("MAP_CROP_CONFIG", str(Path(__file__).with_name("map_crop.yaml")))
+    )
+
+    _settings: Optional[MapCropSettings] = None
+    _settings_mtime: Optional[float] = None
+    _settings_lock = threading.Lock()
+
+    @staticmethod
+    def load_settings(path: Path) -> MapCropSettings:
+        """
+        Read, validate and compile the map crop config
+
+        :raises ValueError: for an invalid config
+        """
+        with open(path) as f:
+            try:
+                config = MapCropSettingsSchema().load(yaml.safe_load(f))
+            except yaml.YAMLError as exc:
+                raise ValueError(f"Invalid yaml: {exc}")
+            except ValidationError as exc:
+                raise ValueError(exc.messages)
+        return MapCropSettings(config)
+
+    @classmethod
+    def settings(cls) -> MapCropSettings:
+        """
+        Get the crop engine settings, reloaded when the config file changes
+        """
+        try:
+            mtime: Optional[float] = cls.SETTINGS_PATH.stat().st_mtime
+        except OSError:
+            mtime = None
+        if cls._settings is not None and mtime == cls._settings_mtime:
+            return cls._settings
+
+        with cls._settings_lock:
+            if cls._settings is None or mtime != cls._settings_mtime:
+                try:
+                    cls._settings = cls.load_settings(cls.SETTINGS_PATH)
+                    log.info("Map crop config loaded from {}", cls.SETTINGS_PATH)
+                except (OSError, ValueError) as exc:
+                    if cls._settings is None:
+                        raise ServerError(f"Unable to load the map crop config: {exc}")
+                    # keep the last valid config
+                    log.error("Invalid map crop config {}: {}", cls.SETTINGS_PATH, exc)
+                cls._settings_mtime = mtime
+        return cls._settings
 
     @staticmethod
     def getOutputFilename(
-        output_type: str, plot_format: str, plot_type: str, area_name: str
+        output_type: str,
+        plot_format: str,
+        plot_type: str,
+        area_name: str,
+        resolution: str = DEFAULT_RESOLUTION,
     ) -> str:
+        filename = area_name.replace(" ", "_").lower()
         if output_type == "plot":
-            if plot_format == "png":
-                return (
-                    f"{area_name.replace(' ', '_').lower()}_{plot_type}.{plot_format}"
-                )
-            else:
-                return f"{area_name.replace(' ', '_').lower()}.{plot_format}"
+            if plot_format not in IMAGE_FORMATS:
+                return f"{filename}.{plot_format}"
+            filename = f"{filename}_{plot_type}"
         else:
-            return f"{area_name.replace(' ', '_').lower()}_map.png"
+            filename = f"{filename}_map"
+            if plot_format not in IMAGE_FORMATS:
+                plot_format = "png"
+        # each render is cached separately, the default one keeps its name
+        if resolution != DEFAULT_RESOLUTION:
+            filename = f"{filename}_{resolution}"
+        if plot_format == "png8":
+            filename = f"{filename}_png8"
+        return f"{filename}.{IMAGE_FORMATS[plot_format]}"
+
+    @staticmethod
+    def getCroppedFilename(area_name: str) -> str:
+        return f"{area_name.replace(' ', '_').lower()}_crop.nc"
+
+    @staticmethod
+    def getReportFilename(area_name: str, report_key: str) -> str:
+        return f"{area_name.replace(' ', '_').lower()}_report_{report_key}.pdf"
 
     @staticmethod
     def getOutputPath(
@@ -561,18 +303,12 @@ def getOutputPath(
     ) -> Optional[List[str]]:
         # get the output structure
         try:
-            if "all_products" in MapCropConfig.OUTPUT_STRUCTURE_MAP[dataset_id]:
-                output_structure = [
-                    variables[i]
-                    for i in MapCropConfig.OUTPUT_STRUCTURE_MAP[dataset_id][
-                        "all_products"
-                    ]
-                ]
-            else:
-                output_structure = [
-                    variables[i]
-                    for i in MapCropConfig.OUTPUT_STRUCTURE_MAP[dataset_id][product_id]
-                ]
+            output_structure = [
+                variables[i]
+                for i in MapCropConfig.settings().get_output_structure(
+                    dataset_id, product_id
+                )
+            ]
         except KeyError:
             return None
 
@@ -596,6 +332,33 @@ def getStripesOutputPath(
 
 
 class PlotUtils:
+    @staticmethod
+    def renderFigure(fig: Figure, resolution: str, **kwargs: Any) -> bytes:
+        """
+        Render a figure as png at the dpi of the resolution
+        """
+        buffer = io.BytesIO()
+        fig.savefig(buffer, format="png", dpi=RESOLUTIONS[resolution], **kwargs)
+        return buffer.getvalue()
+
+    @staticmethod
+    def writeImage(png: bytes, outputfile: Path, image_format: str) -> None:
+        """
+        Write a rendered png in the requested image format
+        """
+        if image_format == "png":
+            outputfile.write_bytes(png)
+            return
+        with Image.open(io.BytesIO(png)) as image:
+            image = image.convert("RGBA")
+            if image_format == "png8":
+                # the discrete colormaps fit in the palette (with the transparency)
+                image.quantize(colors=256, method=Image.Quantize.FASTOCTREE).save(
+                    outputfile, format="PNG", optimize=True
+                )
+            else:
+                image.save(outputfile, format="WEBP", quality=WEBP_QUALITY, method=6)
+
     @staticmethod
     def getLegendLevels(layer_name):
         log.debug(f"legends for layer {layer_name}")
@@ -651,6 +414,30 @@ def getArea(area_id: str, administrative: str):
         area = areas[areas["name"] == area_name]
         return area_name, area
 
+    @staticmethod
+    def getAreas(area_ids: Optional[List[str]], administrative: str) -> Any:
+        """
+        Get several areas (all the areas if no ids are given) of an administrative
+        level, parsing the geojson once. The result has an area for each row,
+        indexed by area name
+        """
+        geojson_file = Path(MapCropConfig.GEOJSON_PATH, f"italy-{administrative}.json")
+        areas = gpd.read_file(geojson_file)
+        if area_ids is not None:
+            areas = areas[areas["name"].isin({a.lower() for a in area_ids})]
+        # merge the polygons of the same area
+        return areas.dissolve(by="name")
+
+    @staticmethod
+    def openDataset(netcdf_path: Path, decode_time: bool = False) -> Any:
+        data = xr.open_dataset(netcdf_path, decode_times=decode_time)
+        # rfactor projections have different names for lat lon --> rename the variables
+        if "latitude" in data.coords:
+            data = data.rename({"latitude": "lat"})
+        if "longitude" in data.coords:
+            data = data.rename({"longitude": "lon"})
+        return data
+
     @staticmethod
     def cropArea(
         netcdf_path: Path,
@@ -660,38 +447,163 @@ def cropArea(
         year_day: Optional[int] = "",
         has_time: bool = False,
         decode_time: bool = False,
+        timer: Optional[StageTimer] = None,
     ) -> Any:
         # read the netcdf file
-        data_to_crop = xr.open_dataset(netcdf_path, decode_times=decode_time)
-        # data_to_crop = xr.open_dataset(netcdf_path)
-        # rfactor projections have different names for lat lon --> rename the variables
-        if "latitude" in data_to_crop.coords:
-            data_to_crop = data_to_crop.rename({"latitude": "lat"})
-        if "longitude" in data_to_crop.coords:
-            data_to_crop = data_to_crop.rename({"longitude": "lon"})
+        with stage(timer, "open_dataset"):
+            data_to_crop = PlotUtils.openDataset(netcdf_path, decode_time)
 
         # create the polygon mask
-        polygon_mask = regionmask.Regions(
-            name=area_name,
-            outlines=list(area.geometry.values[i] for i in range(0, area.shape[0])),
+        with stage(timer, "masking"):
+            polygon_mask = regionmask.Regions(
+                name=area_name,
+                outlines=list(area.geometry.values[i] for i in range(0, area.shape[0])),
+            )
+
+            mask = polygon_mask.mask(data_to_crop, lat_name="lat", lon_name="lon")
+
+        with stage(timer, "read_data"):
+            if year_day:
+                # crop only the data related to the requested date. N.B. the related layer is day-1 (the 1st january is layer 0)
+                nc_cropped = data_to_crop[data_variable][year_day - 1].where(
+                    mask == np.isnan(mask)
+                )
+            elif has_time:
+                nc_cropped = data_to_crop[data_variable][0].where(
+                    mask == np.isnan(mask)
+                )
+            else:
+                nc_cropped = data_to_crop[data_variable].where(mask == np.isnan(mask))
+
+            nc_cropped = nc_cropped.dropna("lat", how="all")
+            nc_cropped = nc_cropped.dropna("lon", how="all")
+
+        return nc_cropped
+
+    @staticmethod
+    def writeCrop(nc_cropped: Any, filepath: Path) -> None:
+        """
+        Store the cropped data in a compressed netcdf file
+        """
+        filepath.parent.mkdir(parents=True, exist_ok=True)
+        tmp_filepath = filepath.with_name(
+            f"{filepath.name}.{os.getpid()}.{threading.get_ident()}"
         )
+        nc_cropped.to_dataset(name=CROP_VARIABLE).to_netcdf(
+            tmp_filepath, encoding={CROP_VARIABLE: {"zlib": True, "complevel": 4}}
+        )
+        # the concurrent readers get either the old or the new file
+        tmp_filepath.replace(filepath)
+
+    @staticmethod
+    def readCrop(filepath: Path) -> Any:
+        with xr.open_dataset(filepath) as data:
+            return data[CROP_VARIABLE].load()
 
-        mask = polygon_mask.mask(data_to_crop, lat_name="lat", lon_name="lon")
+    @staticmethod
+    def cropAreaDays(
+        netcdf_path: Path,
+        area_name: str,
+        area: Any,
+        data_variable: str,
+        year_days: List[int],
+        timer: Optional[StageTimer] = None,
+    ) -> Dict[int, Any]:
+        """
+        Crop the data of several days of the year over an area, opening the source
+        file and computing the mask once. The days are read in a single slab,
+        limited to the rows and columns of the area
+        """
+        with stage(timer, "open_dataset"):
+            data_to_crop = PlotUtils.openDataset(netcdf_path)
 
-        if year_day:
-            # crop only the data related to the requested date. N.B. the related layer is day-1 (the 1st january is layer 0)
-            nc_cropped = data_to_crop[data_variable][year_day - 1].where(
-                mask == np.isnan(mask)
+        with stage(timer, "masking"):
+            polygon_mask = regionmask.Regions(
+                name=area_name,
+                outlines=list(area.geometry.values),
             )
-        elif has_time:
-            nc_cropped = data_to_crop[data_variable][0].where(mask == np.isnan(mask))
-        else:
-            nc_cropped = data_to_crop[data_variable].where(mask == np.isnan(mask))
+            mask = polygon_mask.mask(data_to_crop, lat_name="lat", lon_name="lon")
+            inside = mask.notnull()
+            window = {
+                "lat": inside.any("lon").values,
+                "lon": inside.any("lat").values,
+            }
+            inside = inside.isel(window)
 
-        nc_cropped = nc_cropped.dropna("lat", how="all")
-        nc_cropped = nc_cropped.dropna("lon", how="all")
+        with stage(timer, "read_data"):
+            first_day = min(year_days)
+            # N.B. the related layer is day-1 (the 1st january is layer 0)
+            data = data_to_crop[data_variable][first_day - 1 : max(year_days)]
+            data = data.isel(window).where(inside).load()
 
-        return nc_cropped
+            crops: Dict[int, Any] = {}
+            for year_day in year_days:
+                nc_cropped = data[year_day - first_day]
+                nc_cropped = nc_cropped.dropna("lat", how="all")
+                crops[year_day] = nc_cropped.dropna("lon", how="all")
+
+        return crops
+
+    @staticmethod
+    def getStats(nc_cropped: Any) -> Dict[str, Optional[float]]:
+        """
+        Summary statistics of the cropped data (none for an area without data)
+        """
+        values = np.asarray(nc_cropped.values, dtype=float).ravel()
+        values = values[~np.isnan(values)]
+        if not values.size:
+            return dict.fromkeys(["min", "max", "mean", "median"])
+        return {
+            "min": float(values.min()),
+            "max": float(values.max()),
+            "mean": float(values.mean()),
+            "median": float(np.median(values)),
+        }
+
+    @staticmethod
+    def cropAreas(
+        netcdf_path: Path,
+        areas: Any,
+        data_variable: str,
+        year_day: Optional[int] = None,
+        has_time: bool = False,
+        decode_time: bool = False,
+        timer: Optional[StageTimer] = None,
+    ) -> Dict[str, Any]:
+        """
+        Crop the data over several areas (as returned by getAreas), opening the
+        source file once and computing a single mask where each area is a region
+        """
+        with stage(timer, "open_dataset"):
+            data_to_crop = PlotUtils.openDataset(netcdf_path, decode_time)
+
+        area_names = list(areas.index)
+        with stage(timer, "masking"):
+            regions = regionmask.Regions(
+                outlines=list(areas.geometry.values),
+                numbers=list(range(len(area_names))),
+                names=area_names,
+            )
+            mask = regions.mask(data_to_crop, lat_name="lat", lon_name="lon")
+
+        with stage(timer, "read_data"):
+            if year_day:
+                # N.B. the related layer is day-1 (the 1st january is layer 0)
+                data = data_to_crop[data_variable][year_day - 1]
+            elif has_time:
+                data = data_to_crop[data_variable][0]
+            else:
+                data = data_to_crop[data_variable]
+            # read the data once for all the areas
+            data = data.load()
+
+            crops: Dict[str, Any] = {}
+            for number, area_name in enumerate(area_names):
+                nc_cropped = data.where(mask == number)
+                nc_cropped = nc_cropped.dropna("lat", how="all")
+                crops[area_name] = nc_cropped.dropna("lon", how="all")
+
+        return crops
 
     @staticmethod
     def plotMapNetcdf(
@@ -703,172 +615,858 @@ def plotMapNetcdf(
         main_product: str,
         outputfile: Path,
         geoserver_layer: str,
-    ) -> None:
+        timer: Optional[StageTimer] = None,
+        image_format: str = "png",
+        resolution: str = DEFAULT_RESOLUTION,
+    ) -> List[float]:
         """
-        This function plot with the xarray tool the field of netcdf
+        This function plot with the xarray tool the field of netcdf.
+        Returns the levels of the legend
         """
         log.debug(f"plotting map on {outputfile}")
-        fig1 = plt.figure(figsize=(15, 15))
-        mpl.rcParams["font.size"] = 15
-
-        with warnings.catch_warnings():
-            warnings.filterwarnings(
-                "ignore",
-                message="The value of the smallest subnormal for <class 'numpy.float64'> type is zero",
-            )
-            ax1 = fig1.add_subplot(111, projection=ccrs.PlateCarree())
-
-        ax1.set(frame_on=False)
-        ax1.axis("off")
-        ax1.set_xticks(ax1.get_xticks())
-        ax1.set_yticks(ax1.get_yticks())
-        ax1.add_feature(cartopy.feature.LAND)
-        ax1.add_feature(cartopy.feature.OCEAN)
-        ax1.add_feature(cartopy.feature.COASTLINE)
-        ax1.add_feature(cartopy.feature.BORDERS, color="k", linestyle=":")
-        ax1.add_feature(cartopy.feature.LAKES)
-        ax1.add_feature(cartopy.feature.RIVERS, color="b")
-        ax1.gridlines(
-            crs=ccrs.PlateCarree(),
-            draw_labels=True,
-            linewidth=1,
-            color="gray",
-            alpha=0.5,
-            linestyle="--",
-        )
-        with warnings.catch_warnings():
-            warnings.filterwarnings(
-                "ignore",
-                message="This usage of Quadmesh is deprecated: Parameters meshWidth and meshHeights will be removed; coordinates must be 2D; all parameters except coordinates will be keyword-only.",
-            )
         try:
-            levels: List[float] = []
-            legend_product = main_product
-            legend_product = main_product
-            # log.debug(f"main product: {main_product}, product: {product}")
-            if main_product not in MapCropConfig.MAP_STYLES.keys():
-                # check if its legend is common with the one of the main product
-                if product not in MapCropConfig.MAP_STYLES.keys():
-                    raise ServerError(
-                        f"plotting style not defined for product {main_product} (product long name: {product})"
-                    )
-                else:
-                    legend_product = product
-
-            cmap = eval(MapCropConfig.MAP_STYLES[legend_product]["colormap"])
-            levels = []
-            if geoserver_layer:
-                try:
+            style = MapCropConfig.settings().get_map_style(product, main_product)
+        except LookupError as e:
+            raise ServerError(str(e))
+        cmap = style.cmap
+        levels: List[float] = []
+        if geoserver_layer:
+            try:
+                with stage(timer, "legend"):
                     levels = PlotUtils.getLegendLevels(geoserver_layer)
-                except Exception as e:
-                    log.warning(f"unable to get levels from geoserver: {e}")
-                    pass
-            if not levels:
-                # use the default
-                levels = MapCropConfig.MAP_STYLES[legend_product]["levels"]
+            except Exception as e:
+                log.warning(f"unable to get levels from geoserver: {e}")
+                pass
+        if not levels:
+            # use the default
+            levels = style.levels
+        try:
             norm = mpl.colors.BoundaryNorm(levels, cmap.N)
-
         except Exception as e:
             raise ServerError(f"Errors in passing data variable: {e}")
 
-        fig1.colorbar(
-            mpl.cm.ScalarMappable(cmap=cmap, norm=norm),
-            ax=ax1,
-            ticks=levels,
-            spacing="uniform",
-            orientation="vertical",
-            label=f"{product} [{units}]",
-            anchor=(0.5, 0.5),
-            shrink=np.round(min(len(lon) / len(lat), len(lat) / len(lon)), 2),  # 0.8
-        )
-        ax1.pcolormesh(lon, lat, field, cmap=cmap, alpha=1, norm=norm)
-        with warnings.catch_warnings():
+        with stage(timer, "plotting"):
+            fig1 = new_figure(figsize=(15, 15))
+
+            with warnings.catch_warnings():
+                warnings.filterwarnings(
+                    "ignore",
+                    message="The value of the smallest subnormal for <class 'numpy.float64'> type is zero",
+                )
+                ax1 = fig1.add_subplot(111, projection=ccrs.PlateCarree())
+
+            ax1.set(frame_on=False)
+            ax1.axis("off")
+            ax1.set_xticks(ax1.get_xticks())
+            ax1.set_yticks(ax1.get_yticks())
+            ax1.add_feature(cartopy.feature.LAND)
+            ax1.add_feature(cartopy.feature.OCEAN)
+            ax1.add_feature(cartopy.feature.COASTLINE)
+            ax1.add_feature(cartopy.feature.BORDERS, color="k", linestyle=":")
+            ax1.add_feature(cartopy.feature.LAKES)
+            ax1.add_feature(cartopy.feature.RIVERS, color="b")
+            gridlines = ax1.gridlines(
+                crs=ccrs.PlateCarree(),
+                draw_labels=True,
+                linewidth=1,
+                color="gray",
+                alpha=0.5,
+                linestyle="--",
+            )
+            gridlines.xlabel_style = {"size": MAP_FONT_SIZE}
+            gridlines.ylabel_style = {"size": MAP_FONT_SIZE}
+
+            colorbar = fig1.colorbar(
+                mpl.cm.ScalarMappable(cmap=cmap, norm=norm),
+                ax=ax1,
+                ticks=levels,
+                spacing="uniform",
+                orientation="vertical",
+                anchor=(0.5, 0.5),
+                shrink=np.round(min(len(lon) / len(lat), len(lat) / len(lon)), 2),
+            )
+            colorbar.set_label(f"{product} [{units}]", size=MAP_FONT_SIZE)
+            colorbar.ax.tick_params(labelsize=MAP_FONT_SIZE)
+            with warnings.catch_warnings():
+                warnings.filterwarnings(
+                    "ignore",
+                    message="This usage of Quadmesh is deprecated: Parameters meshWidth and meshHeights will be removed; coordinates must be 2D; all parameters except coordinates will be keyword-only.",
+                )
+                ax1.pcolormesh(lon, lat, field, cmap=cmap, alpha=1, norm=norm)
+        with warnings.catch_warnings(), stage(timer, "savefig"):
             warnings.filterwarnings(
                 "ignore",
                 message='facecolor will have no effect as it has been defined as "never".',
             )
-            fig1.savefig(
-                outputfile, transparent=True, bbox_inches="tight", pad_inches=0
+            png = PlotUtils.renderFigure(
+                fig1,
+                resolution,
+                transparent=True,
+                bbox_inches="tight",
+                pad_inches=0,
             )
+        with stage(timer, "write_image"):
+            PlotUtils.writeImage(png, outputfile, image_format)
+        return levels
 
     @staticmethod
-    def plotBoxplot(field: Any, outputfile: Path) -> None:
+    def plotBoxplot(
+        field: Any,
+        outputfile: Path,
+        image_format: str = "png",
+        resolution: str = DEFAULT_RESOLUTION,
+        timer: Optional[StageTimer] = None,
+    ) -> None:
         """
         This function plot with the xarray tool the field of netcdf
         """
         log.debug(f"plotting boxplot on {outputfile}")
-        fig4, (ax4) = plt.subplots(
-            1, 1, figsize=(15, 7)
-        )  # len(field.lon)/100, len(field.lat)/100))
-        sns.set_theme(style="ticks")
-        sns.despine(fig4)
-        with warnings.catch_warnings():
-            warnings.filterwarnings(
-                "ignore",
-                message="iteritems is deprecated and will be removed in a future version. Use .items instead.",
-            )
-            sns.boxplot(data=field, whis=[1, 99], showfliers=False, palette="Set3")
+        with stage(timer, "plotting"):
+            fig4 = new_figure(figsize=(15, 7))
+            ax4 = fig4.subplots(1, 1)  # len(field.lon)/100, len(field.lat)/100))
+            sns.despine(fig4)
+            with warnings.catch_warnings():
+                warnings.filterwarnings(
+                    "ignore",
+                    message="iteritems is deprecated and will be removed in a future version. Use .items instead.",
+                )
+                sns.boxplot(
+                    data=field,
+                    whis=[1, 99],
+                    showfliers=False,
+                    palette="Set3",
+                    ax=ax4,
+                )
 
-        ax4.xaxis.set_major_formatter(mpl.ticker.ScalarFormatter())
-        mpl.rcParams["font.size"] = 14
-        # TODO label not hardcoded
-        # ax4.set_xlabel('R-factor')  # ,fontsize=14)
-        # TODO this label to have not to be hardcoded or it's the same for all the boxplots?
-        ax4.set_ylabel("Count")  # ,fontsize=14)
-        ax4.tick_params(axis="both", which="major")  # , labelsize=14)
-        ax4.tick_params(axis="both", which="minor")  # , labelsize = 14)
+            ax4.xaxis.set_major_formatter(mpl.ticker.ScalarFormatter())
+            # TODO label not hardcoded
+            # ax4.set_xlabel('R-factor')  # ,fontsize=14)
+            # TODO this label to have not to be hardcoded or it's the same for all the boxplots?
+            ax4.set_ylabel("Count", fontsize=12, color=TICKS_COLOR)
+            ax4.tick_params(
+                axis="both",
+                which="major",
+                direction="out",
+                length=6,
+                width=1.25,
+                labelsize=11,
+                color=TICKS_COLOR,
+                labelcolor=TICKS_COLOR,
+            )
+            ax4.tick_params(
+                axis="both", which="minor", direction="out", length=4, width=1
+            )
+            for spine in ax4.spines.values():
+                spine.set_linewidth(1.25)
+                spine.set_edgecolor(TICKS_COLOR)
 
-        fig4.savefig(outputfile)
+        with stage(timer, "savefig"):
+            png = PlotUtils.renderFigure(fig4, resolution)
+        with stage(timer, "write_image"):
+            PlotUtils.writeImage(png, outputfile, image_format)
 
     @staticmethod
-    def plotDistribution(field: Any, outputfile: Path, name: str, units: str) -> None:
+    def plotDistribution(
+        field: Any,
+        outputfile: Path,
+        name: str,
+        units: str,
+        image_format: str = "png",
+        resolution: str = DEFAULT_RESOLUTION,
+        timer: Optional[StageTimer] = None,
+    ) -> None:
         """
         This function plot with the xarray tool the field of netcdf
         """
-        fig3, (ax3) = plt.subplots(
-            1, 1, figsize=(8, 5)
-        )  # len(field.lon)/100, len(field.lat)/100))
-        # sns.set_theme(style="ticks")
-        # sns.despine(fig3)
-        # log.debug(field.max())
-        # sns.histplot(
-        #    field,
-        #    ax=ax3,
-        #    edgecolor=".3",
-        #    linewidth=0.5,
-        # log_scale=True,
-        # )
-        field.plot.hist(grid=True, bins=20, rwidth=0.9, ax=ax3, color="#607c8e")
-        ax3.xaxis.set_major_formatter(mpl.ticker.ScalarFormatter())
-        mpl.rcParams["font.size"] = 14
-
-        if units:
-            ax3.set_xlabel(f"{name} ({units})", fontsize=16)
-        else:
-            ax3.set_xlabel(f"{name}", fontsize=16)
-        ax3.set_ylabel("Count")  # ,fontsize=14)
-        ax3.tick_params(axis="both", which="major")  # , labelsize=14)
-        ax3.tick_params(axis="both", which="minor")  # , labelsize = 14)
-        ax3.set_title(f'{field.columns[0].replace(".nc", "")} histogram (20 classes)')
-        ax3.get_legend().remove()  # handles = legend.legendHandles
-        # legend.remove()
-        # ax3.legend(handles, ['dep-', 'ind-', 'ind+', 'dep+'], title='Stat.ind.')
+        with stage(timer, "plotting"):
+            fig3 = new_figure(figsize=(8, 5))
+            ax3 = fig3.subplots(1, 1)  # len(field.lon)/100, len(field.lat)/100))
+            field.plot.hist(grid=True, bins=20, rwidth=0.9, ax=ax3, color="#607c8e")
+            ax3.xaxis.set_major_formatter(mpl.ticker.ScalarFormatter())
+
+            if units:
+                ax3.set_xlabel(f"{name} ({units})", fontsize=16)
+            else:
+                ax3.set_xlabel(f"{name}", fontsize=16)
+            ax3.set_ylabel("Count", fontsize=PLOT_FONT_SIZE)
+            ax3.tick_params(axis="both", which="major", labelsize=PLOT_FONT_SIZE)
+            ax3.tick_params(axis="both", which="minor", labelsize=PLOT_FONT_SIZE)
+            ax3.set_title(
+                f'{field.columns[0].replace(".nc", "")} histogram (20 classes)',
+                fontsize=PLOT_FONT_SIZE * 1.2,
+            )
+            ax3.get_legend().remove()  # handles = legend.legendHandles
 
-        fig3.savefig(outputfile)
+        with stage(timer, "savefig"):
+            png = PlotUtils.renderFigure(fig3, resolution)
+        with stage(timer, "write_image"):
+            PlotUtils.writeImage(png, outputfile, image_format)
 
     @staticmethod
     def plotStripes(array, yearsList: list, region_id: str, fileOutput: str):
         region_id = f"{region_id.replace('_', ' ').title()}"
-        fig, ax = plt.subplots(figsize=(20, 8))
-        fig.subplots_adjust(bottom=0.25, left=0.25)  # make room for labels
-        mpl.rcParams["font.size"] = 25
         min_val = math.floor(array.min())  # np.round(array.min()*10)/10
         max_val = math.ceil(array.max())  # np.round(array.max()*10)/10
-        stripes = plt.pcolormesh(array, vmin=min_val, vmax=max_val, cmap="bwr")
-        plt.colorbar(stripes, label="Air temperature [°C]")
-        ax.set_title(region_id, alpha=1)
+        fig = new_figure(figsize=(20, 8))
+        ax = fig.subplots()
+        fig.subplots_adjust(bottom=0.25, left=0.25)  # make room for labels
+        stripes = ax.pcolormesh(array, vmin=min_val, vmax=max_val, cmap="bwr")
+        colorbar = fig.colorbar(stripes, ax=ax)
+        colorbar.set_label("Air temperature [°C]", size=STRIPES_FONT_SIZE)
+        colorbar.ax.tick_params(labelsize=STRIPES_FONT_SIZE)
+        ax.set_title(region_id, alpha=1, fontsize=STRIPES_FONT_SIZE * 1.2)
         ax.set_xticks(np.arange(array.shape[1]) + 0.5, minor=False)
         ax.set_xticklabels(yearsList, rotation=90, size=15)
         ax.axes.get_yaxis().set_visible(False)
-        plt.show()
         fig.savefig(fileOutput, transparent=True, bbox_inches="tight", pad_inches=0)
+
+
+LOGO_URL = Path(MapCropConfig.GEOJSON_PATH, "highlander-logo.png")
+EU_LOGO_URL = Path(MapCropConfig.GEOJSON_PATH, "en_horizontal_cef_logo_2.png")
+
+
+class PDF(FPDF):
+    ch = 8
+    # license = "CC BY 4.0"
+    license = ""
+    report_date = ""
+
+    def header(self):
+        self.image(str(LOGO_URL), 90, 5, 40)
+        self.image(str(EU_LOGO_URL), 130, 12, 50)
+        self.ln(15)
+
+    def footer(self):
+        self.set_y(-15)
+        self.set_font("Arial", "I", 8)
+        self.cell(w=30, h=self.ch, txt=f"License : {self.license}", ln=1)
+        self.set_text_color(128)
+        self.cell(0, 10, "Page " + str(self.page_no()), 0, 0, "C")
+
+    def report_title(self, label):
+        self.set_font("Arial", "B", 20)
+        self.set_fill_color(r=30, g=154, b=47)
+        self.multi_cell(w=0, h=self.ch, txt=label, align="C", fill=True)
+        self.ln(1)
+        self.set_text_color(r=0, g=0, b=0)
+        self.set_font("Arial", "", 12)
+        self.cell(w=30, h=self.ch, txt="Date: ", ln=0)
+        report_date = self.report_date or str(datetime.date.today())
+        self.cell(w=30, h=self.ch, txt=report_date, ln=1)
+        self.cell(w=30, h=self.ch, txt="Attribution:", ln=0)
+        self.cell(w=30, h=self.ch, txt="Highlander Project", ln=1)
+
+        self.ln(self.ch)
+
+    def report_body(self, label_map, file_path):
+        self.set_font("Arial", "B", 20)
+        self.multi_cell(w=0, h=self.ch, txt=label_map, align="C")
+        self.image(file_path, x=5, y=None, w=200, h=0, type="PNG", link="")
+        self.ln(self.ch)
+
+
+class CropEngine:
+    """
+    Crop the source data of the datasets and plot the outputs.
+    Shared by the endpoints creating maps, plots and reports
+    """
+
+    @staticmethod
+    def getProductDetails(
+        dataset_details: Mapping[str, Any], dataset_id: str, product_id: str
+    ) -> Optional[Dict[str, Any]]:
+        settings = MapCropConfig.settings()
+        for p in dataset_details["data"][0]["products"]:
+            if product_id in p["id"]:
+                return p
+            # check if there are exception for the product
+            product_alias = settings.get_product_alias(dataset_id, product_id)
+            if product_alias and product_alias in p["id"]:
+                return p
+        return None
+
+    @staticmethod
+    def checkMandatoryParams(
+        dataset_id: str, product_id: str, variables: Mapping[str, Any]
+    ) -> None:
+        try:
+            mandatory_params = MapCropConfig.settings().get_mandatory_params(
+                dataset_id, product_id
+            )
+        except KeyError:
+            raise ServerError(f"{dataset_id} not found in Mandatory param map")
+        for param in mandatory_params:
+            if not variables.get(param):
+                raise BadRequest(
+                    f"{param} parameter is needed for {product_id} product in {dataset_id}"
+                )
+
+    @staticmethod
+    def getSourceFilepath(
+        dds: Any,
+        dataset_id: str,
+        product_id: str,
+        product_details: Mapping[str, Any],
+        variables: Dict[str, Any],
+    ) -> Path:
+        """
+        Get the source file of the data to crop.
+        The model filename is added to the variables
+        """
+        settings = MapCropConfig.settings()
+        # check if the model name and the filename correspond
+        variables["model_filename"] = None
+        if variables.get("model_id"):
+            variables["model_filename"] = settings.get_model_filename(
+                variables["model_id"]
+            )
+
+        # get the file urlpath
+        product_urlpath = dds.broker.catalog[dataset_id][product_details["id"]].urlpath
+        log.debug(product_urlpath)
+        product_urlpath_root = product_urlpath.split(dataset_id)[0]
+        if dataset_id == "era5-downscaled-over-italy":
+            product_urlpath_root = product_urlpath.split("vhr-rea")[0]
+        log.debug(product_urlpath_root)
+        # substitute the parameters
+        try:
+            source_file = settings.get_source_file(dataset_id, product_id, variables)
+        except KeyError:
+            raise ServerError(
+                f"{dataset_id} or {product_id} keys not present in source file url map"
+            )
+        data_to_crop_filepath = Path(f"{product_urlpath_root}{source_file}")
+
+        if not data_to_crop_filepath.is_file():
+            raise NotFound(
+                f"Requested data to crop not found: source file {data_to_crop_filepath} does not exists"
+            )
+        log.debug(f"source path of the data to crop: {data_to_crop_filepath}")
+        return data_to_crop_filepath
+
+    @staticmethod
+    def getCropSource(
+        dds: Any,
+        dataset_id: str,
+        product_id: str,
+        product_details: Mapping[str, Any],
+        variables: Dict[str, Any],
+    ) -> Tuple[Path, str, Optional[int], bool]:
+        """
+        Get the source file, the data variable, the day of the year and whether
+        the data have the time dimension
+        """
+        settings = MapCropConfig.settings()
+        data_to_crop_filepath = CropEngine.getSourceFilepath(
+            dds, dataset_id, product_id, product_details, variables
+        )
+
+        # get the data variable. The data variable is ALWAYS equal to the lowercase indicator
+        indicator = variables.get("indicator")
+        try:
+            nc_variable = settings.variables[indicator]
+        except KeyError:
+            raise NotFound(
+                f"indicator {indicator} for product {product_id} for dataset {dataset_id} not found"
+            )
+
+        # names for variables in forest species projections are different. This is an exception for this case
+        # TODO try to get a correct file in order to delete this exception
+        if product_id == "forest-species-suitability-proj":
+            nc_variable = f"{nc_variable.split('_')[0].title()}{nc_variable.split('_')[1].title()}"
+
+        year_day: Optional[int] = None
+        if variables.get("date") and product_id == "daily":
+            year_day = int(
+                datetime.datetime.strptime(variables["date"], "%Y-%m-%d").strftime("%j")
+            )
+
+        return (
+            data_to_crop_filepath,
+            nc_variable,
+            year_day,
+            settings.has_time(product_id),
+        )
+
+    @staticmethod
+    def cropData(
+        dds: Any,
+        dataset_id: str,
+        product_id: str,
+        product_details: Mapping[str, Any],
+        variables: Dict[str, Any],
+        area_name: str,
+        area: Any,
+        timer: Optional[StageTimer] = None,
+    ) -> Any:
+        filepath, nc_variable, year_day, has_time = CropEngine.getCropSource(
+            dds, dataset_id, product_id, product_details, variables
+        )
+        # crop the area
+        try:
+            nc_cropped = PlotUtils.cropArea(
+                filepath,
+                area_name,
+                area,
+                nc_variable,
+                year_day,
+                has_time,
+                timer=timer,
+            )
+        except Exception as exc:
+            raise ServerError(f"Errors in cropping the data: {exc}")
+        # the source of the outputs is recorded in the crops manifest
+        nc_cropped.attrs["source_path"] = str(filepath)
+        return nc_cropped
+
+    @staticmethod
+    def getCroppedFilepath(
+        dataset_id: str, product_id: str, variables: Any, area_name: str
+    ) -> Optional[Path]:
+        """
+        Path of the cached cropped data of an area, if the product has an
+        output structure
+        """
+        output_structure = MapCropConfig.getOutputPath(
+            dataset_id, product_id, variables
+        )
+        if not output_structure:
+            return None
+        return MapCropConfig.CROPS_OUTPUT_ROOT.joinpath(
+            *output_structure, MapCropConfig.getCroppedFilename(area_name)
+        )
+
+    @staticmethod
+    def storeCrop(
+        nc_cropped: Any,
+        cropped_filepath: Path,
+        dataset_id: str,
+        timer: Optional[StageTimer] = None,
+    ) -> None:
+        """
+        Cache the cropped data of an area and record them in the crops manifest
+        """
+        with stage(timer, "write_crop"):
+            PlotUtils.writeCrop(nc_cropped, cropped_filepath)
+        record_output(
+            cropped_filepath,
+            Path(nc_cropped.attrs["source_path"]),
+            dataset_id=dataset_id,
+        )
+
+    @staticmethod
+    def getCrop(
+        dds: Any,
+        dataset_id: str,
+        product_id: str,
+        product_details: Mapping[str, Any],
+        variables: Dict[str, Any],
+        area_id: str,
+        administrative: str,
+        timer: Optional[StageTimer] = None,
+    ) -> Any:
+        """
+        Get the data cropped over an area. The cropped data are cached in the
+        crops tree and shared by the maps, plots and reports of the area
+        """
+        cropped_filepath = CropEngine.getCroppedFilepath(
+            dataset_id, product_id, variables, area_id.lower()
+        )
+        if cropped_filepath and is_fresh(cropped_filepath):
+            with stage(timer, "read_crop"):
+                return PlotUtils.readCrop(cropped_filepath)
+
+        with stage(timer, "get_area"):
+            area_name, area = PlotUtils.getArea(area_id, administrative)
+        if area.empty:
+            raise NotFound(f"Area {area_name} not found in {administrative}")
+        nc_cropped = CropEngine.cropData(
+            dds,
+            dataset_id,
+            product_id,
+            product_details,
+            variables,
+            area_name,
+            area,
+            timer=timer,
+        )
+        if cropped_filepath:
+            CropEngine.storeCrop(nc_cropped, cropped_filepath, dataset_id, timer)
+        return nc_cropped
+
+    @staticmethod
+    def cropDataAreas(
+        dds: Any,
+        dataset_id: str,
+        product_id: str,
+        product_details: Mapping[str, Any],
+        variables: Dict[str, Any],
+        areas: Any,
+        timer: Optional[StageTimer] = None,
+    ) -> Dict[str, Any]:
+        filepath, nc_variable, year_day, has_time = CropEngine.getCropSource(
+            dds, dataset_id, product_id, product_details, variables
+        )
+        # crop all the areas
+        try:
+            crops = PlotUtils.cropAreas(
+                filepath,
+                areas,
+                nc_variable,
+                year_day,
+                has_time,
+                timer=timer,
+            )
+        except Exception as exc:
+            raise ServerError(f"Errors in cropping the data: {exc}")
+        # the source of the outputs is recorded in the crops manifest
+        for nc_cropped in crops.values():
+            nc_cropped.attrs["source_path"] = str(filepath)
+        return crops
+
+    @staticmethod
+    def cropDataDays(
+        dds: Any,
+        dataset_id: str,
+        product_id: str,
+        product_details: Mapping[str, Any],
+        variables: Dict[str, Any],
+        area_name: str,
+        area: Any,
+        dates: List[datetime.date],
+        timer: Optional[StageTimer] = None,
+    ) -> Dict[datetime.date, Any]:
+        """
+        Crop the data of several days of a daily product from a single read
+        of its source file
+        """
+        filepath, nc_variable, _, _ = CropEngine.getCropSource(
+            dds, dataset_id, product_id, product_details, variables
+        )
+        year_days = {date: date.timetuple().tm_yday for date in dates}
+        try:
+            crops = PlotUtils.cropAreaDays(
+                filepath,
+                area_name,
+                area,
+                nc_variable,
+                list(year_days.values()),
+                timer=timer,
+            )
+        except Exception as exc:
+            raise ServerError(f"Errors in cropping the data: {exc}")
+        crops_by_date: Dict[datetime.date, Any] = {}
+        for date, year_day in year_days.items():
+            nc_cropped = crops[year_day]
+            # the source of the outputs is recorded in the crops manifest
+            nc_cropped.attrs["source_path"] = str(filepath)
+            crops_by_date[date] = nc_cropped
+        return crops_by_date
+
+    @staticmethod
+    def plotCrop(
+        nc_cropped: Any,
+        dataset_id: str,
+        product_id: str,
+        variables: Mapping[str, Any],
+        output_type: str,
+        plot_type: Optional[str],
+        plot_format: str,
+        filepath: Path,
+        timer: Optional[StageTimer] = None,
+        resolution: str = DEFAULT_RESOLUTION,
+    ) -> None:
+        # create the output directory if it does not exists
+        filepath.parent.mkdir(parents=True, exist_ok=True)
+        image_format = plot_format if plot_format in IMAGE_FORMATS else "png"
+        layer_name: Optional[str] = None
+        levels: Optional[List[float]] = None
+        try:
+            if output_type == "map":
+                # get the layer name to get the legends
+                layer_name = MapCropConfig.settings().get_geoserver_layer(
+                    dataset_id, product_id, variables
+                )
+
+                # plot the cropped map: the legend, plotting, savefig and
+                # write_image stages are timed separately by plotMapNetcdf
+                levels = PlotUtils.plotMapNetcdf(
+                    nc_cropped.values,
+                    nc_cropped.lat.values,
+                    nc_cropped.lon.values,
+                    nc_cropped.units,
+                    nc_cropped.long_name,
+                    product_id,
+                    filepath,
+                    layer_name,
+                    timer=timer,
+                    image_format=image_format,
+                    resolution=resolution,
+                )
+            else:
+                # plot the boxplot
+                df_stas = pd.DataFrame(
+                    np.array(nc_cropped.values).ravel(), columns=[str(product_id)]
+                )
+
+                if plot_format == "json":
+                    with stage(timer, "write_json"):
+                        df_stas.to_json(path_or_buf=filepath)
+                elif plot_type == "boxplot":
+                    PlotUtils.plotBoxplot(
+                        df_stas, filepath, image_format, resolution, timer=timer
+                    )
+                elif plot_type == "distribution":
+                    PlotUtils.plotDistribution(
+                        df_stas,
+                        filepath,
+                        nc_cropped.long_name,
+                        nc_cropped.units,
+                        image_format,
+                        resolution,
+                        timer=timer,
+                    )
+        except Exception as exc:
+            raise ServerError(f"Errors in plotting the data: {exc}")
+
+        # check that the output has been correctly created
+        if not filepath.is_file() or not filepath.stat().st_size >= 1:
+            raise ServerError("Errors in plotting the data")
+
+        source_path = nc_cropped.attrs.get("source_path")
+        record_output(
+            filepath,
+            Path(source_path) if source_path else None,
+            layer_name,
+            levels,
+            dataset_id,
+        )
+
+    @staticmethod
+    def getStripesSourceFilepath(
+        dds: Any,
+        dataset_id: str,
+        indicator: str,
+        reference_period: str,
+        time_period: str,
+    ) -> Path:
+        # We define a STRIPES_INPUT_ROOT using the details of a dataset available in the dds.
+        try:
+            product_urlpath = dds.broker.catalog[dataset_id][
+                "VHR-REA_IT_1981_2020_hourly"
+            ].urlpath
+            product_urlpath_root = product_urlpath.split("vhr-rea")[0]
+        except Exception as exc:
+            raise NotFound(f"Unable to get dataset url root: {exc}")
+
+        # Check if input data exists.
+        input_filename = (
+            f"{indicator}_1981-2020_{time_period}_anomalies_vs_{reference_period}.nc"
+        )
+        data_filepath = Path(product_urlpath_root, "climate_stripes", input_filename)
+
+        if data_filepath.is_file() is False:
+            raise NotFound(f"Data file {input_filename} not found in {data_filepath}")
+        return data_filepath
+
+    @staticmethod
+    def plotStripes(
+        dds: Any,
+        dataset_id: str,
+        indicator: str,
+        reference_period: str,
+        time_period: str,
+        area_name: str,
+        area: Any,
+        output_filepath: Path,
+        timer: Optional[StageTimer] = None,
+    ) -> None:
+        """
+        Plot the climate stripes of an area. With no area the stripes are the
+        ones of the whole Italy
+        """
+        data_filepath = CropEngine.getStripesSourceFilepath(
+            dds, dataset_id, indicator, reference_period, time_period
+        )
+
+        # If necessary crop the area.
+        if area is not None:
+            try:
+                nc_data_to_plot = PlotUtils.cropArea(
+                    data_filepath,
+                    area_name,
+                    area,
+                    indicator,
+                    decode_time=True,
+                    timer=timer,
+                )
+            except Exception as exc:
+                raise ServerError(f"Errors in cropping the data: {exc}")
+        # Otherwise simply load data
+        else:
+            with stage(timer, "open_dataset"):
+                nc_data = xr.open_dataset(data_filepath)
+                nc_data_to_plot = nc_data[indicator][:]
+
+        CropEngine.plotStripesData(
+            nc_data_to_plot,
+            area_name,
+            output_filepath,
+            timer,
+            data_filepath,
+            dataset_id,
+        )
+
+    @staticmethod
+    def plotStripesData(
+        nc_data_to_plot: Any,
+        area_name: str,
+        output_filepath: Path,
+        timer: Optional[StageTimer] = None,
+        source_path: Optional[Path] = None,
+        dataset_id: Optional[str] = None,
+    ) -> None:
+        with stage(timer, "mean"):
+            nc_data_to_plot_mean = nc_data_to_plot.mean(axis=(1, 2)).values.reshape(
+                (1, len(nc_data_to_plot.time))
+            )
+        nc_data_to_plot_years = [
+            str(x.astype("datetime64[Y]")) for x in nc_data_to_plot.time.values
+        ]
+
+        # Create the output directory if it does not exists.
+        output_filepath.parent.mkdir(parents=True, exist_ok=True)
+
+        # Plot stripes.
+        try:
+            with stage(timer, "plotting"):
+                PlotUtils.plotStripes(
+                    nc_data_to_plot_mean,
+                    nc_data_to_plot_years,
+                    area_name,
+                    output_filepath,
+                )
+        except Exception as exc:
+            raise ServerError(f"Errors in plotting the data: {exc}")
+        record_output(output_filepath, source_path, dataset_id=dataset_id)
+
+    @staticmethod
+    def getReportArtifacts(
+        dataset_id: str, area_name: str, output_dir: Path, variables: Mapping[str, Any]
+    ) -> Tuple[Path, Path]:
+        """
+        Get the filepaths of the map and of the plot of a report
+        """
+        # get the map filename
+        map_filename = MapCropConfig.getOutputFilename("map", "png", "", area_name)
+        # build the filepath for map
+        map_filepath = Path(output_dir, map_filename)
+
+        # get the plot filename
+        # TODO the plot for the report will be the boxplot
+        if dataset_id != "era5-downscaled-over-italy":
+            plot_filename = MapCropConfig.getOutputFilename(
+                "plot", "png", "distribution", area_name
+            )
+            # build the filepath for plot
+            plot_filepath = Path(output_dir, plot_filename)
+        else:
+            plot_dir, plot_filename = MapCropConfig.getStripesOutputPath(
+                area_name,
+                variables["indicator"],
+                variables["reference_period"],
+                variables["time_period"],
+                variables["area_type"],
+            )
+            plot_filepath = Path(plot_dir, plot_filename)
+        return map_filepath, plot_filepath
+
+    @staticmethod
+    def getReportLabels(
+        dataset_id: str,
+        area_id: str,
+        output_structure: List[str],
+        label: Optional[str],
+        reference_period: Optional[str],
+    ) -> Tuple[str, str]:
+        # create the labels
+        # label params are the same of the output structure excluding the dataset name (first element) and the area type (last element)
+
+        if not label:
+            label_params = output_structure[1:-1]
+            label = " - ".join(
+                l_par.replace("-", " ").title() for l_par in label_params
+            )
+
+        if dataset_id != "era5-downscaled-over-italy":
+            label_map = f"Map {area_id.title()} - {label}"
+            label_plot = f"Distribution of {area_id.title()} - {label}"
+        else:
+            label_map = (
+                f"{area_id.title()} - Map of {label} for the {reference_period} period"
+            )
+            label_plot = f"{area_id.title()} - Anomaly of {label} compared to the average of the period {reference_period}"
+        return label_map, label_plot
+
+    @staticmethod
+    def writeReport(
+        dataset_details: Mapping[str, Any],
+        output_structure: List[str],
+        area_name: str,
+        label_map: str,
+        map_filepath: Path,
+        label_plot: str,
+        plot_filepath: Path,
+        timer: Optional[StageTimer] = None,
+    ) -> Path:
+        """
+        Create the report PDF in the output directory.
+        The report is cached until its contents change
+        """
+        # get the dataset title
+        title = dataset_details["data"][0]["label"]
+        # get the dataset license
+        license = dataset_details["data"][0]["license"]["name"]
+
+        report_date = str(datetime.date.today())
+        report_key = hashlib.sha1(
+            json.dumps(
+                [
+                    output_structure,
+                    area_name,
+                    title,
+                    license,
+                    label_map,
+                    label_plot,
+                    map_filepath.stat().st_mtime_ns,
+                    plot_filepath.stat().st_mtime_ns,
+                    # the report is dated
+                    report_date,
+                ]
+            ).encode()
+        ).hexdigest()[:16]
+        output_dir = MapCropConfig.CROPS_OUTPUT_ROOT.joinpath(*output_structure)
+        report_filepath = Path(
+            output_dir, MapCropConfig.getReportFilename(area_name, report_key)
+        )
+        if is_fresh(report_filepath):
+            return report_filepath
+
+        with stage(timer, "pdf"):
+            pdf = PDF()
+            pdf.license = license
+            pdf.report_date = report_date
+            pdf.add_page()
+            pdf.report_title(title)
+            pdf.report_body(label_map, str(map_filepath))
+            pdf.report_body(label_plot, str(plot_filepath))
+
+            bytes_string = pdf.output(dest="S")
+            pdf_bytes = bytes_string.encode("latin-1")
+
+        # the outdated reports can be still downloading:
+        # they are removed by the purge_crops task
+        write_atomic(report_filepath, pdf_bytes)
+        # the report is a new file for each new map or plot
+        record_output(report_filepath, map_filepath, dataset_id=output_structure[0])
+        return report_filepath
@@ -13,6 +13,14 @@ class EmptyOutputFile(Exception):
     """Exception for empty output file"""
 
 
+class RequestCancelled(Exception):
+    """Exception for requests cancelled while running"""
+
+
+class UnsupportedPointRequest(Exception):
+    """Exception for location requests not handled by the point extraction"""
+
+
 class NotYetImplemented(RestApiException):
     def __init__(self, exception: ExceptionType, is_warning: bool = False):
         super().__init__(exception, status_code=501, is_warning=is_warning)
@@ -0,0 +1,147 @@
+"""
+Timing instrumentation for the crop, stripes and report pipelines
+"""
+import json
+import os
+import time
+from contextlib import contextmanager, nullcontext
+from typing import Any, ContextManager, Dict, Iterator, List, Optional, Tuple
+
+from flask import request
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+from restapi.env import Env
+from restapi.utilities.logs import log
+
+# always add the Server-Timing header to the instrumented responses.
+# Otherwise it is added only when requested with the X-Timing request header
+SERVER_TIMING = Env.get_bool("SERVER_TIMING")
+TIMING_REQUEST_HEADER = "X-Timing"
+
+STAGE_DURATION = Histogram(
+    "highlander_pipeline_stage_seconds",
+    "Duration of the stages of the crop, stripes and report pipelines",
+    ["pipeline", "dataset", "product", "stage"],
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120),
+)
+
+
+# label of the pipelines of the invalid requests, so that the clients can't
+# create a metric series for each dataset or product id they make up
+INVALID_LABEL = "invalid"
+
+
+class StageTimer:
+    """
+    Collect the durations of the stages of a pipeline.
+    Each stage is observed in the Prometheus histogram as soon as it ends,
+    the whole timing is logged as a structured record when the pipeline ends.
+    The dataset and product labels are set once they are validated: the stages
+    ended before are observed then, or with the invalid label when the pipeline
+    ends without them
+    """
+
+    def __init__(
+        self,
+        pipeline: str,
+        dataset: Optional[str] = None,
+        product: Optional[str] = None,
+    ) -> None:
+        self.pipeline = pipeline
+        self.dataset = INVALID_LABEL
+        self.product = INVALID_LABEL
+        self.labelled = False
+        self.stages: List[Tuple[str, float]] = []
+        self.start = time.perf_counter()
+        if dataset is not None and product is not None:
+            self.set_labels(dataset, product)
+
+    def set_labels(self, dataset: str, product: str) -> None:
+        self.dataset = dataset
+        self.product = product
+        self.labelled = True
+        for name, duration in self.stages:
+            self.observe(name, duration)
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def record(self, name: str, duration: float) -> None:
+        self.stages.append((name, duration))
+        if self.labelled:
+            self.observe(name, duration)
+
+    def observe(self, name: str, duration: float) -> None:
+        STAGE_DURATION.labels(
+            pipeline=self.pipeline,
+            dataset=self.dataset,
+            product=self.product,
+            stage=name,
+        ).observe(duration)
+
+    def total(self) -> float:
+        return time.perf_counter() - self.start
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "pipeline": self.pipeline,
+            "dataset": self.dataset,
+            "product": self.product,
+            "total_ms": round(self.total() * 1000, 1),
+            "stages": [
+                {"stage": name, "ms": round(duration * 1000, 1)}
+                for name, duration in self.stages
+            ],
+        }
+
+    def server_timing(self) -> str:
+        timings = [
+            f"{name};dur={duration * 1000:.1f}" for name, duration in self.stages
+        ]
+        timings.append(f"total;dur={self.total() * 1000:.1f}")
+        return ", ".join(timings)
+
+    def finalize(self, response: Any) -> Any:
+        """
+        Log the pipeline timing and add the Server-Timing header to the response
+        """
+        if not self.labelled:
+            for name, duration in self.stages:
+                self.observe(name, duration)
+        log.info("Pipeline timing: {}", json.dumps(self.to_dict()))
+        if SERVER_TIMING or request.headers.get(TIMING_REQUEST_HEADER):
+            response.headers["Server-Timing"] = self.server_timing()
+        return response
+
+
+def stage(timer: Optional[StageTimer], name: str) -> ContextManager[None]:
+    """
+    Time a stage of the pipeline, if any
+    """
+    if timer is None:
+        return nullcontext()
+    return timer.stage(name)
+
+
+def generate_metrics() -> Tuple[bytes, str]:
+    """
+    Get the metrics in the Prometheus text format.
+    With multiple worker processes the metrics are collected from
+    PROMETHEUS_MULTIPROC_DIR
+    """
+    registry = REGISTRY
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return generate_latest(registry), CONTENT_TYPE_LATEST
@@ -0,0 +1,28 @@
+"""add request listing index
+
+Revision ID: 3d9b6f0c8e21
+Revises: a7c3e19b5d42
+Create Date: 2026-10-19 11:04:52.137560
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "3d9b6f0c8e21"
+down_revision = "a7c3e19b5d42"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index(
+        "ix_request_user_id_submission_date",
+        "request",
+        ["user_id", sa.text("submission_date DESC"), sa.text("id DESC")],
+        unique=False,
+    )
+
+
+def downgrade():
+    op.drop_index("ix_request_user_id_submission_date", table_name="request")
@@ -0,0 +1,39 @@
+"""add used bytes to user
+
+Revision ID: a7c3e19b5d42
+Revises: 6041a4915c53
+Create Date: 2026-10-19 10:12:31.508412
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "a7c3e19b5d42"
+down_revision = "6041a4915c53"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column(
+        "user",
+        sa.Column("used_bytes", sa.BigInteger(), server_default="0", nullable=False),
+    )
+    # initialize the counters from the existing output files
+    op.execute(
+        """
+        UPDATE "user" SET used_bytes = COALESCE(
+            (
+                SELECT SUM(output_file.size) FROM output_file
+                JOIN request ON output_file.request_id = request.id
+                WHERE request.user_id = "user".id
+            ),
+            0
+        )
+        """
+    )
+
+
+def downgrade():
+    op.drop_column("user", "used_bytes")
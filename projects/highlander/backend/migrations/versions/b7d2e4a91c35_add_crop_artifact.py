@@ -0,0 +1,43 @@
+"""add crop artifact
+
+Revision ID: b7d2e4a91c35
+Revises: f3a91c2d7b68
+Create Date: 2026-10-19 21:04:37.581902
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "b7d2e4a91c35"
+down_revision = "f3a91c2d7b68"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "crop_artifact",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("path", sa.Text(), nullable=False),
+        sa.Column("source_path", sa.Text(), nullable=False),
+        sa.Column("source_mtime", sa.Float(), nullable=False),
+        sa.Column("source_size", sa.BigInteger(), nullable=False),
+        sa.Column("legend_layer", sa.String(), nullable=True),
+        sa.Column("legend_version", sa.String(length=64), nullable=True),
+        sa.Column("renderer_version", sa.String(length=64), nullable=False),
+        sa.Column("rendered", sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint("id"),
+        sa.UniqueConstraint("path"),
+    )
+    op.create_index(
+        op.f("ix_crop_artifact_source_path"),
+        "crop_artifact",
+        ["source_path"],
+        unique=False,
+    )
+
+
+def downgrade():
+    op.drop_index(op.f("ix_crop_artifact_source_path"), table_name="crop_artifact")
+    op.drop_table("crop_artifact")
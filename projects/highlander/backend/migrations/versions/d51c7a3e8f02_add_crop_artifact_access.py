@@ -0,0 +1,36 @@
+"""add crop artifact access
+
+Revision ID: d51c7a3e8f02
+Revises: b7d2e4a91c35
+Create Date: 2026-10-19 22:12:05.904417
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "d51c7a3e8f02"
+down_revision = "b7d2e4a91c35"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column("crop_artifact", sa.Column("dataset_id", sa.String(), nullable=True))
+    op.add_column("crop_artifact", sa.Column("size", sa.BigInteger(), nullable=True))
+    op.add_column(
+        "crop_artifact", sa.Column("last_access", sa.DateTime(), nullable=True)
+    )
+    op.create_index(
+        op.f("ix_crop_artifact_dataset_id"),
+        "crop_artifact",
+        ["dataset_id"],
+        unique=False,
+    )
+
+
+def downgrade():
+    op.drop_index(op.f("ix_crop_artifact_dataset_id"), table_name="crop_artifact")
+    op.drop_column("crop_artifact", "last_access")
+    op.drop_column("crop_artifact", "size")
+    op.drop_column("crop_artifact", "dataset_id")
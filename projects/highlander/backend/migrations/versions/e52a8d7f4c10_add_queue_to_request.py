@@ -0,0 +1,23 @@
+"""add queue to request
+
+Revision ID: e52a8d7f4c10
+Revises: 3d9b6f0c8e21
+Create Date: 2026-10-19 11:47:05.902113
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "e52a8d7f4c10"
+down_revision = "3d9b6f0c8e21"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column("request", sa.Column("queue", sa.String(length=64), nullable=True))
+
+
+def downgrade():
+    op.drop_column("request", "queue")
@@ -0,0 +1,27 @@
+"""add output retention
+
+Revision ID: f3a91c2d7b68
+Revises: e52a8d7f4c10
+Create Date: 2026-10-19 18:31:12.417263
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "f3a91c2d7b68"
+down_revision = "e52a8d7f4c10"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column(
+        "user", sa.Column("output_retention_days", sa.Integer(), nullable=True)
+    )
+    op.add_column("output_file", sa.Column("last_access", sa.DateTime(), nullable=True))
+
+
+def downgrade():
+    op.drop_column("output_file", "last_access")
+    op.drop_column("user", "output_retention_days")
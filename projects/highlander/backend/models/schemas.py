@@ -1,7 +1,8 @@
 from typing import Any, Dict, Iterable, Mapping
 
 import numpy as np
-from marshmallow import post_load, pre_load
+from highlander.output_formats import FORMATS, POINT_FORMATS, is_point_request
+from marshmallow import ValidationError, post_load, pre_load, validates_schema
 from restapi.models import ISO8601UTC, Schema, fields, validate
 from restapi.utilities.logs import log
 from webargs import fields as mfields
@@ -199,6 +200,12 @@ class DateStruct(Schema):
     day = fields.Int(required=True)
 
 
+class RequestsListing(Schema):
+    # opaque position returned in the X-Next-Cursor header of the previous page
+    cursor = fields.Str(required=False)
+    with_args = fields.Bool(required=False, load_default=True)
+
+
 class DataExtraction(Schema):
     product_type = fields.Str(required=True)
     variable = fields.List(fields.Str())
@@ -209,7 +216,7 @@ class DataExtraction(Schema):
         keys=fields.Str(validate=validate.OneOf(["year", "month", "day", "hour"])),
         values=fields.List(fields.Str(), min_items=1),
     )
-    format = fields.Str(required=True)
+    format = fields.Str(required=True, validate=validate.OneOf(FORMATS.keys()))
     extra = fields.Dict(allow_none=True)
 
     @pre_load
@@ -223,6 +230,16 @@ def unwrap_envelope(self, data: Dict[str, Any], **kwargs: Any) -> Dict[str, Any]
                 rest[k] = v
         return {"extra": extra or None, **rest}
 
+    @validates_schema
+    def validate_format(self, data: Dict[str, Any], **kwargs: Any) -> None:
+        if data["format"] in POINT_FORMATS and not is_point_request(
+            data.get("extra") or {}
+        ):
+            raise ValidationError(
+                f"{data['format']} format is available only for a location",
+                field_name="format",
+            )
+
 
 class Schedule(Schema):
     id = fields.Integer(required=True)
@@ -240,3 +257,40 @@ class ScheduleInput(Schema):
     task_name = fields.Str(required=True)
     # FIXME need generic rapydo Raw field to be mapped as textarea UI component
     task_args = fields.List(mfields.Raw)
+
+
+class MapStyle(Schema):
+    colormap = fields.Str(required=True)
+    levels = fields.List(fields.Float(), required=True, min_items=2)
+
+
+class MapCropSettings(Schema):
+    """Configuration of the map crop engine"""
+
+    product_exception = fields.Dict(
+        keys=fields.Str(), values=fields.Dict(keys=fields.Str(), values=fields.Str())
+    )
+    models_mapping = fields.Dict(keys=fields.Str(), values=fields.Str())
+    mandatory_params = fields.Dict(
+        keys=fields.Str(),
+        values=fields.Dict(keys=fields.Str(), values=fields.List(fields.Str())),
+        required=True,
+    )
+    output_structure = fields.Dict(
+        keys=fields.Str(),
+        values=fields.Dict(keys=fields.Str(), values=fields.List(fields.Str())),
+        required=True,
+    )
+    source_files = fields.Dict(
+        keys=fields.Str(),
+        values=fields.Dict(keys=fields.Str(), values=fields.Str()),
+        required=True,
+    )
+    products_without_time = fields.List(fields.Str())
+    variables = fields.Dict(keys=fields.Str(), values=fields.Str(), required=True)
+    geoserver_layers = fields.Dict(
+        keys=fields.Str(), values=fields.Dict(keys=fields.Str(), values=fields.Str())
+    )
+    map_styles = fields.Dict(
+        keys=fields.Str(), values=fields.Nested(MapStyle), required=True
+    )
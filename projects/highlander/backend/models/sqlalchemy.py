@@ -7,6 +7,15 @@
 
 # Add (inject) attributes to User
 setattr(User, "disk_quota", db.Column(db.BigInteger, default=1073741824))  # 1 GB
+# bytes used by the output files of the user (see highlander.usage)
+setattr(
+    User,
+    "used_bytes",
+    db.Column(db.BigInteger, default=0, server_default="0", nullable=False),
+)
+# time to live (days) of the user output files, instead of the default one
+# (see highlander.retention)
+setattr(User, "output_retention_days", db.Column(db.Integer, nullable=True))
 setattr(User, "requests", db.relationship("Request", backref="user", lazy=True))
 
 
@@ -27,6 +36,18 @@ class Request(db.Model):  # type: ignore
         "OutputFile", uselist=False, back_populates="request", cascade="delete"
     )
     schedule_id = db.Column(db.Integer, db.ForeignKey("schedule.id"))
+    # scheduling class of the request (see highlander.scheduling)
+    queue = db.Column(db.String(64))
+
+    # index for the listing of the user requests, from the newest
+    __table_args__ = (
+        db.Index(
+            "ix_request_user_id_submission_date",
+            user_id,
+            submission_date.desc(),
+            id.desc(),
+        ),
+    )
 
     def __repr__(self) -> str:
         return "<Request(name='{}', submission date='{}', status='{}')".format(
@@ -41,6 +62,8 @@ class OutputFile(db.Model):  # type: ignore
     filename = db.Column(db.Text, index=True, nullable=False)
     timestamp = db.Column(db.String(64))
     size = db.Column(db.BigInteger)
+    # last download, for the eviction of the least recently used outputs
+    last_access = db.Column(db.DateTime)
     request_id = db.Column(db.Integer, db.ForeignKey("request.id"))
     request = db.relationship("Request", back_populates="output_file")
 
@@ -50,6 +73,33 @@ def __repr__(self) -> str:
         return f"<OutputFile(filepath='{filepath}', size='{self.size}')"
 
 
+class CropArtifact(db.Model):  # type: ignore
+    """
+    A cached output of the crops with the versions of its sources
+    (see highlander.crop_manifest)
+    """
+
+    __tablename__ = "crop_artifact"
+
+    id = db.Column(db.Integer, primary_key=True)
+    path = db.Column(db.Text, unique=True, nullable=False)
+    source_path = db.Column(db.Text, index=True, nullable=False)
+    source_mtime = db.Column(db.Float, nullable=False)
+    source_size = db.Column(db.BigInteger, nullable=False)
+    legend_layer = db.Column(db.String)
+    legend_version = db.Column(db.String(64))
+    renderer_version = db.Column(db.String(64), nullable=False)
+    dataset_id = db.Column(db.String, index=True)
+    size = db.Column(db.BigInteger)
+    # last use by the endpoints, for the eviction of the least recently used
+    last_access = db.Column(db.DateTime)
+    # last rendering
+    rendered = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    def __repr__(self) -> str:
+        return f"<CropArtifact(path='{self.path}', source='{self.source_path}')"
+
+
 class PeriodEnum(enum.Enum):
     days = 1
     hours = 2
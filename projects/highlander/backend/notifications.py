@@ -0,0 +1,71 @@
+"""
+Live status of the user requests.
+The tasks publish the state transitions of the requests on a Redis channel
+of the request owner, streamed to the clients as server-sent events
+"""
+import json
+import time
+from typing import Any, Dict, Iterator, Optional
+
+from restapi.connectors import redis
+from restapi.env import Env
+from restapi.utilities.logs import log
+
+# seconds between the keep-alive comments sent on idle streams
+HEARTBEAT_INTERVAL = 15
+# the streams are closed after this time and reopened by the clients
+STREAM_MAX_DURATION = Env.get_int("REQUESTS_STREAM_MAX_DURATION", 3600)
+# milliseconds suggested to the clients before reconnecting
+RECONNECTION_DELAY = 5000
+
+
+def user_channel(user_id: int) -> str:
+    return f"highlander:requests:{user_id}"
+
+
+def publish_status(
+    user_id: int,
+    request: Any,
+    progress: Optional[str] = None,
+) -> None:
+    """
+    Publish the current state of a request. Failures are only logged:
+    the request is processed even without live notifications
+    """
+    event: Dict[str, Any] = {
+        "id": request.id,
+        "task_id": request.task_id,
+        "status": request.status,
+    }
+    if progress:
+        event["progress"] = progress
+    if request.end_date:
+        event["end_date"] = request.end_date.isoformat()
+    if request.error_message:
+        event["error_message"] = request.error_message
+    try:
+        redis.get_instance().r.publish(user_channel(user_id), json.dumps(event))
+    except Exception as exc:
+        log.warning("Unable to publish the status of request {}: {}", request.id, exc)
+
+
+def stream_events(user_id: int) -> Iterator[str]:
+    """
+    Stream the state transitions of the requests of a user as server-sent events
+    """
+    pubsub = redis.get_instance().r.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(user_channel(user_id))
+    try:
+        yield f"retry: {RECONNECTION_DELAY}\n\n"
+        start = time.monotonic()
+        while time.monotonic() - start < STREAM_MAX_DURATION:
+            message = pubsub.get_message(timeout=HEARTBEAT_INTERVAL)
+            if message is None:
+                yield ": keep-alive\n\n"
+                continue
+            data = message["data"]
+            if isinstance(data, bytes):
+                data = data.decode()
+            yield f"event: request\ndata: {data}\n\n"
+    finally:
+        pubsub.close()
@@ -0,0 +1,178 @@
+"""
+Output formats of the data extractions.
+The data are always retrieved from the broker as NetCDF and then written in
+the requested format: compressed NetCDF4, zipped Zarr or CSV (for the
+extractions at a location only).
+"""
+from pathlib import Path
+from typing import Any, Dict, Mapping, Optional, Sequence, Tuple
+
+import xarray as xr
+import zarr
+from restapi.env import Env
+from restapi.utilities.logs import log
+
+NETCDF = "netcdf"
+ZARR = "zarr"
+CSV = "csv"
+
+FORMATS = {
+    NETCDF: {"label": "NetCDF4 (compressed)", "ext": ".nc"},
+    ZARR: {"label": "Zarr (zipped)", "ext": ".zarr.zip"},
+    CSV: {"label": "CSV (location only)", "ext": ".csv"},
+}
+# formats available only for the extractions at a location
+POINT_FORMATS = (CSV,)
+
+# output size / uncompressed size of the retrieved data.
+# Conservative values measured on the float fields of the catalog:
+# the estimates are used for the disk quota check
+COMPRESSION_RATIOS = {NETCDF: 0.5, ZARR: 0.5, CSV: 3.0}
+
+COMPRESSION_LEVEL = Env.get_int("OUTPUT_COMPRESSION_LEVEL", 4)
+# target size of a chunk of the compressed outputs
+CHUNK_TARGET_BYTES = 1048576  # 1 MB
+
+# the encodings of the source file that are still valid in the new output
+KEPT_ENCODINGS = (
+    "dtype",
+    "_FillValue",
+    "scale_factor",
+    "add_offset",
+    "units",
+    "calendar",
+)
+
+
+def is_point_request(request: Mapping[str, Any]) -> bool:
+    return "location" in request
+
+
+def estimate_output_size(data_size: int, format_: str) -> int:
+    """
+    Size of the output from the uncompressed size of the data to retrieve
+    """
+    if data_size <= 0:
+        return data_size
+    return int(data_size * COMPRESSION_RATIOS.get(format_, 1))
+
+
+def get_chunk_sizes(shape: Tuple[int, ...], itemsize: int) -> Optional[Tuple[int, ...]]:
+    """
+    Chunks of about CHUNK_TARGET_BYTES following the shape of the request.
+    The chunks are filled from the last dimensions (the spatial ones), so that
+    a chunk holds whole layers when the area is small enough and the whole time
+    series when the request is at a location
+    """
+    if not shape or 0 in shape:
+        return None
+    remaining = max(CHUNK_TARGET_BYTES // itemsize, 1)
+    chunks = []
+    for size in reversed(shape):
+        chunk = min(size, remaining)
+        chunks.insert(0, chunk)
+        remaining = max(remaining // chunk, 1)
+    return tuple(chunks)
+
+
+def clean_encoding(ds: xr.Dataset) -> None:
+    for var in ds.variables.values():
+        var.encoding = {k: v for k, v in var.encoding.items() if k in KEPT_ENCODINGS}
+
+
+def write_netcdf(ds: xr.Dataset, output_path: Path) -> None:
+    encoding: Dict[str, Dict[str, Any]] = {}
+    for name, var in ds.data_vars.items():
+        encoding[name] = {"zlib": True, "complevel": COMPRESSION_LEVEL}
+        chunks = get_chunk_sizes(var.shape, var.dtype.itemsize)
+        if chunks:
+            encoding[name]["chunksizes"] = chunks
+    ds.to_netcdf(output_path, format="NETCDF4", engine="netcdf4", encoding=encoding)
+
+
+def write_zarr(ds: xr.Dataset, output_path: Path) -> None:
+    # zarr compresses the chunks with blosc by default
+    store = zarr.ZipStore(str(output_path), mode="w")
+    try:
+        ds.to_zarr(store=store)
+    finally:
+        store.close()
+
+
+def write_csv(ds: xr.Dataset, output_path: Path) -> None:
+    ds.to_dataframe().to_csv(output_path)
+
+
+WRITERS = {NETCDF: write_netcdf, ZARR: write_zarr, CSV: write_csv}
+
+
+def write_tmp_output(ds: xr.Dataset, output_path: Path, format_: str) -> Path:
+    """
+    Write the data in the requested format with a temporary name.
+    Returns the temporary path, to be renamed as the output
+    """
+    tmp_path = output_path.with_name(f"{output_path.name}.tmp")
+    clean_encoding(ds)
+    try:
+        WRITERS[format_](ds, tmp_path)
+    except Exception:
+        tmp_path.unlink(missing_ok=True)
+        raise
+    return tmp_path
+
+
+def write_output(ds: xr.Dataset, output_path: Path, format_: str) -> None:
+    """
+    Write the data in the requested format. The file is written with a
+    temporary name and then renamed, to never expose a partial output
+    """
+    write_tmp_output(ds, output_path, format_).rename(output_path)
+
+
+def open_chunked(paths: Sequence[Path]) -> xr.Dataset:
+    """
+    Open NetCDF files lazily, with the chunks of the outputs: the data are
+    read and written a chunk at a time. The files of a request retrieved a
+    year at a time are merged along the time
+    """
+    if len(paths) == 1:
+        ds = xr.open_dataset(paths[0], chunks={})
+    else:
+        ds = xr.open_mfdataset(
+            paths,
+            chunks={},
+            combine="by_coords",
+            data_vars="minimal",
+            coords="minimal",
+            compat="override",
+        )
+    for name, var in list(ds.data_vars.items()):
+        chunks = get_chunk_sizes(var.shape, var.dtype.itemsize)
+        if chunks:
+            ds[name] = var.chunk(dict(zip(var.dims, chunks)))
+    return ds
+
+
+def convert_output(result_paths: Sequence[Path], format_: str) -> Path:
+    """
+    Write the retrieved NetCDF files in the requested format in place of the
+    first retrieved one, removing the retrieved files.
+    Returns the path of the new output
+    """
+    result_path = result_paths[0]
+    filename = result_path.name
+    if filename.endswith(".nc"):
+        filename = filename[: -len(".nc")]
+    output_path = result_path.with_name(f"{filename}{FORMATS[format_]['ext']}")
+
+    # the retrieved data can be larger than the memory: they are streamed
+    with open_chunked(result_paths) as ds:
+        tmp_path = write_tmp_output(ds, output_path, format_)
+    # the netcdf output replaces the retrieved file with the same name,
+    # once the retrieved files are closed
+    tmp_path.rename(output_path)
+    for path in result_paths:
+        if path != output_path:
+            path.unlink()
+    log.debug("Output written as {}: {}", format_, output_path)
+    return output_path
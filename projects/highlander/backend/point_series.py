@@ -0,0 +1,225 @@
+"""
+Fast extraction of the time series at a location.
+The broker opens the whole product to retrieve a single grid cell: here the
+grid and the time range of each file of the product are indexed once (and
+only the changed files are re-indexed), then only the column of the nearest cell
+is read from the files overlapping the requested years.
+The requests that the fast path can't handle (e.g. with auxiliary coordinates)
+raise UnsupportedPointRequest and are retrieved by the broker.
+"""
+import glob
+import threading
+from pathlib import Path
+from typing import Any, Dict, List, Mapping, Optional, Set, Tuple
+
+import numpy as np
+import xarray as xr
+from highlander.exceptions import EmptyOutputFile, UnsupportedPointRequest
+from highlander.output_formats import FORMATS, write_output
+from restapi.utilities.logs import log
+
+LATITUDE_NAMES = ("lat", "latitude")
+LONGITUDE_NAMES = ("lon", "longitude")
+# request keys handled by the fast path
+SUPPORTED_KEYS = {"product_type", "variable", "time", "location", "format"}
+TIME_FILTERS = ("year", "month", "day", "hour")
+
+FileSignature = Tuple[Tuple[str, int], ...]
+
+
+def find_coord(ds: xr.Dataset, names: Tuple[str, ...]) -> str:
+    for name in names:
+        if name in ds.coords:
+            return name
+    raise UnsupportedPointRequest(f"Missing coordinate: one of {names}")
+
+
+class ProductIndex:
+    """
+    Grid and time ranges of the files of a product
+    """
+
+    def __init__(
+        self,
+        files: List[Path],
+        signature: FileSignature,
+        previous: Optional["ProductIndex"] = None,
+    ) -> None:
+        self.signature = signature
+        self.time_ranges: Dict[Path, Tuple[int, int]] = {}
+        # the files not changed since the previous index are not opened again
+        unchanged = set(previous.signature) if previous else set()
+        if previous and signature[0] in unchanged:
+            self.lat_name, self.lon_name = previous.lat_name, previous.lon_name
+            self.latitude, self.longitude = previous.latitude, previous.longitude
+        else:
+            with xr.open_dataset(files[0]) as ds:
+                self.lat_name = find_coord(ds, LATITUDE_NAMES)
+                self.lon_name = find_coord(ds, LONGITUDE_NAMES)
+                self.latitude = ds[self.lat_name].values
+                self.longitude = ds[self.lon_name].values
+        if self.latitude.ndim != 1 or self.longitude.ndim != 1:
+            raise UnsupportedPointRequest("Only regular grids are indexed")
+        self.lat_step = float(np.abs(np.diff(self.latitude)).max(initial=0))
+        self.lon_step = float(np.abs(np.diff(self.longitude)).max(initial=0))
+        self.indexed = 0
+        for f, file_signature in zip(files, signature):
+            if previous and file_signature in unchanged:
+                self.time_ranges[f] = previous.time_ranges[f]
+                continue
+            with xr.open_dataset(f) as ds:
+                if "time" not in ds.coords:
+                    raise UnsupportedPointRequest(f"Missing time in file {f}")
+                years = ds["time"].dt.year.values
+                self.time_ranges[f] = (int(years.min()), int(years.max()))
+            self.indexed += 1
+
+    def nearest_cell(self, latitude: float, longitude: float) -> Dict[str, int]:
+        """
+        Indexes of the grid cell nearest to the location
+        """
+        lat_idx = int(np.abs(self.latitude - latitude).argmin())
+        lon_idx = int(np.abs(self.longitude - longitude).argmin())
+        # the location has to be within the grid
+        if (
+            abs(self.latitude[lat_idx] - latitude) > self.lat_step
+            or abs(self.longitude[lon_idx] - longitude) > self.lon_step
+        ):
+            raise EmptyOutputFile(
+                f"Location ({latitude}, {longitude}) out of the dataset grid"
+            )
+        return {self.lat_name: lat_idx, self.lon_name: lon_idx}
+
+    def get_files(self, years: Optional[Set[int]]) -> List[Path]:
+        return [
+            f
+            for f, (start, stop) in self.time_ranges.items()
+            if not years or any(start <= y <= stop for y in years)
+        ]
+
+
+_indexes: Dict[Tuple[str, str], ProductIndex] = {}
+# the lock of the indexes and the locks of the products being indexed
+_lock = threading.Lock()
+_product_locks: Dict[Tuple[str, str], threading.Lock] = {}
+
+
+def get_product_files(dds: Any, dataset_name: str, product: str) -> List[Path]:
+    urlpath = dds.broker.catalog[dataset_name][product].urlpath
+    patterns = urlpath if isinstance(urlpath, list) else [urlpath]
+    return sorted(Path(f) for pattern in patterns for f in glob.glob(pattern))
+
+
+def get_product_index(dds: Any, dataset_name: str, product: str) -> ProductIndex:
+    files = get_product_files(dds, dataset_name, product)
+    if not files:
+        raise UnsupportedPointRequest(f"No files found for product {product}")
+    signature = tuple((str(f), f.stat().st_mtime_ns) for f in files)
+    key = (dataset_name, product)
+    with _lock:
+        index = _indexes.get(key)
+        if index is not None and index.signature == signature:
+            return index
+        product_lock = _product_locks.setdefault(key, threading.Lock())
+
+    # the files are opened holding only the lock of the product:
+    # the requests of the other products are not blocked
+    with product_lock:
+        with _lock:
+            index = _indexes.get(key)
+        if index is None or index.signature != signature:
+            index = ProductIndex(files, signature, index)
+            log.info(
+                "Indexed {} of {} files of {}:{}",
+                index.indexed,
+                len(files),
+                dataset_name,
+                product,
+            )
+            with _lock:
+                _indexes[key] = index
+    return index
+
+
+def get_time_filters(request: Mapping[str, Any]) -> Dict[str, Set[int]]:
+    time = request.get("time") or {}
+    if not isinstance(time, dict) or set(time) - set(TIME_FILTERS):
+        raise UnsupportedPointRequest("Only lists of dates are supported")
+    return {k: {int(v) for v in values} for k, values in time.items() if values}
+
+
+def get_nc_variables(
+    ds: xr.Dataset, variables: List[str], product_details: Mapping[str, Any]
+) -> Dict[str, str]:
+    """
+    Map the requested variables to the ones of the files
+    """
+    details = product_details.get("variables", {})
+    nc_variables = {}
+    for variable in variables:
+        nc_name = details.get(variable, {}).get("name", variable)
+        if nc_name not in ds.data_vars:
+            raise UnsupportedPointRequest(f"Variable {variable} not found in files")
+        nc_variables[nc_name] = variable
+    return nc_variables
+
+
+def extract_point_series(
+    dds: Any,
+    dataset_name: str,
+    request: Mapping[str, Any],
+    output_dir: Path,
+) -> Path:
+    """
+    Write the time series of the nearest grid cell to the requested location.
+    Returns the path of the output
+    """
+    if set(request) - SUPPORTED_KEYS:
+        raise UnsupportedPointRequest(
+            f"Unsupported keys: {set(request) - SUPPORTED_KEYS}"
+        )
+    product = request["product_type"]
+    location = request["location"]
+    time_filters = get_time_filters(request)
+    product_details = dds.get_datasets([dataset_name])[dataset_name]["products"].get(
+        product, {}
+    )
+
+    index = get_product_index(dds, dataset_name, product)
+    cell = index.nearest_cell(float(location["latitude"]), float(location["longitude"]))
+    files = index.get_files(time_filters.get("year"))
+    if not files:
+        raise EmptyOutputFile("No data for the requested dates")
+
+    columns = []
+    nc_variables: Dict[str, str] = {}
+    for f in files:
+        with xr.open_dataset(f) as ds:
+            if not nc_variables:
+                variables = request.get("variable") or [
+                    v for v in ds.data_vars if ds[v].dims[:1] == ("time",)
+                ]
+                nc_variables = get_nc_variables(ds, variables, product_details)
+            # only the column of the cell is read
+            columns.append(ds[list(nc_variables)].isel(cell).load())
+    series = xr.concat(columns, dim="time").sortby("time")
+    for time_filter, values in time_filters.items():
+        selected = getattr(series["time"].dt, time_filter).isin(list(values))
+        series = series.isel(time=selected.values)
+    if not series.sizes["time"]:
+        raise EmptyOutputFile("No data for the requested dates")
+    series = series.rename(nc_variables)
+
+    format_ = request["format"]
+    output_path = output_dir.joinpath(
+        "{}_{}_{:.4f}_{:.4f}{}".format(
+            dataset_name,
+            product,
+            float(series[index.lat_name]),
+            float(series[index.lon_name]),
+            FORMATS[format_]["ext"],
+        )
+    )
+    write_output(series, output_path, format_)
+    log.debug("Time series of {} files written in {}", len(files), output_path)
+    return output_path
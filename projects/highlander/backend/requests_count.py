@@ -0,0 +1,42 @@
+"""
+Cached number of requests of the users, used by the paginated listing.
+The cached values are invalidated whenever a request is created or deleted
+"""
+from typing import Any
+
+from restapi.connectors import redis
+from restapi.utilities.logs import log
+
+# the expiration is only a safety net for requests created or deleted elsewhere
+COUNT_CACHE_TTL = 600
+
+
+def count_cache_key(user_id: int) -> str:
+    return f"highlander:requests_count:{user_id}"
+
+
+def count_requests(db: Any, user_id: int) -> int:
+    key = count_cache_key(user_id)
+    r = None
+    try:
+        r = redis.get_instance().r
+        cached = r.get(key)
+        if cached is not None:
+            return int(cached)
+    except Exception as exc:
+        log.warning("Unable to read the cached requests count: {}", exc)
+
+    counter: int = db.Request.query.filter_by(user_id=user_id).count()
+    if r is not None:
+        try:
+            r.set(key, counter, ex=COUNT_CACHE_TTL)
+        except Exception as exc:
+            log.warning("Unable to cache the requests count: {}", exc)
+    return counter
+
+
+def invalidate_requests_count(user_id: int) -> None:
+    try:
+        redis.get_instance().r.delete(count_cache_key(user_id))
+    except Exception as exc:
+        log.warning("Unable to invalidate the cached requests count: {}", exc)
@@ -0,0 +1,218 @@
+"""
+Retention of the output files of the user requests.
+The outputs expire after a time to live set for the user
+(User.output_retention_days) or for the dataset (OUTPUT_RETENTION_DATASETS),
+otherwise after OUTPUT_RETENTION_DAYS.
+When the free space of the download volume is below DOWNLOAD_MIN_FREE_SPACE
+the least recently downloaded outputs are evicted as well.
+If COLD_STORAGE_DIR is set, the outputs not downloaded for COLD_STORAGE_AFTER_DAYS
+are moved there and are still downloadable.
+"""
+import shutil
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from highlander.constants import DOWNLOAD_DIR
+from highlander.usage import update_used_bytes
+from restapi.env import Env
+from restapi.utilities.logs import log
+from sqlalchemy.sql import func
+
+# status of the requests whose output has been removed
+EXPIRED = "EXPIRED"
+
+OUTPUT_RETENTION_DAYS = Env.get_int("OUTPUT_RETENTION_DAYS", 30)
+# minimum free space (percentage) of the download volume
+DOWNLOAD_MIN_FREE_SPACE = Env.get_int("DOWNLOAD_MIN_FREE_SPACE", 10)
+COLD_STORAGE_DIR: Optional[Path] = (
+    Path(Env.get("COLD_STORAGE_DIR", "")) if Env.get("COLD_STORAGE_DIR", "") else None
+)
+COLD_STORAGE_AFTER_DAYS = Env.get_int("COLD_STORAGE_AFTER_DAYS", 7)
+
+
+def parse_dataset_values(value: str) -> Dict[str, int]:
+    """
+    Parse the values of the datasets, in the form dataset:value,dataset:value
+    (e.g. the time to live in days)
+    """
+    values: Dict[str, int] = {}
+    for item in value.split(","):
+        if not item.strip():
+            continue
+        dataset_name, dataset_value = item.rsplit(":", 1)
+        values[dataset_name.strip()] = int(dataset_value)
+    return values
+
+
+OUTPUT_RETENTION_DATASETS = parse_dataset_values(
+    Env.get("OUTPUT_RETENTION_DATASETS", "")
+)
+
+
+def get_storage_tiers() -> List[Path]:
+    if COLD_STORAGE_DIR:
+        return [DOWNLOAD_DIR, COLD_STORAGE_DIR]
+    return [DOWNLOAD_DIR]
+
+
+def get_relative_path(output_file: Any) -> Path:
+    if output_file.timestamp:
+        return Path(output_file.timestamp, output_file.filename)
+    return Path(output_file.filename)
+
+
+def get_output_path(output_file: Any) -> Optional[Path]:
+    """
+    Path of the output file in the storage tier where it is, if any
+    """
+    relative_path = get_relative_path(output_file)
+    for tier in get_storage_tiers():
+        path = tier.joinpath(relative_path)
+        if path.exists():
+            return path
+    return None
+
+
+def remove_output_file(db: Any, output_file: Any) -> List[Path]:
+    """
+    Delete an output file from the database and from the user usage.
+    Returns the paths to remove from the storage: the changes are committed
+    by the caller, that removes the paths (with remove_paths) only once
+    the commit succeeded
+    """
+    paths = [
+        tier.joinpath(output_file.timestamp or output_file.filename)
+        for tier in get_storage_tiers()
+    ]
+    db.session.delete(output_file)
+    update_used_bytes(db, output_file.request.user_id, -(output_file.size or 0))
+    return paths
+
+
+def remove_paths(paths: List[Path]) -> None:
+    """
+    Remove the outputs (files or directories of the timestamps) from the storage
+    """
+    for path in paths:
+        if path.is_dir():
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            path.unlink(missing_ok=True)
+
+
+def get_retention_days(output_file: Any) -> int:
+    request = output_file.request
+    if request.user.output_retention_days is not None:
+        return int(request.user.output_retention_days)
+    return OUTPUT_RETENTION_DATASETS.get(request.dataset_name, OUTPUT_RETENTION_DAYS)
+
+
+def expire(db: Any, output_file: Any, paths: List[Path]) -> Any:
+    request = output_file.request
+    paths.extend(remove_output_file(db, output_file))
+    request.status = EXPIRED
+    return request
+
+
+def expire_outputs(db: Any, now: datetime) -> Tuple[List[Any], List[Path]]:
+    """
+    Expire the outputs older than their time to live.
+    Returns the expired requests and the paths to remove after the commit
+    """
+    # only the outputs older than the shortest time to live are candidates
+    min_user_days = db.session.query(func.min(db.User.output_retention_days)).scalar()
+    min_days = min(
+        OUTPUT_RETENTION_DAYS,
+        *OUTPUT_RETENTION_DATASETS.values(),
+        *([min_user_days] if min_user_days is not None else []),
+    )
+    created = func.coalesce(db.Request.end_date, db.Request.submission_date)
+    candidates = (
+        db.OutputFile.query.join(db.Request, db.OutputFile.request_id == db.Request.id)
+        .filter(created < now - timedelta(days=min_days))
+        .all()
+    )
+    expired = []
+    paths: List[Path] = []
+    for output_file in candidates:
+        request = output_file.request
+        ttl = timedelta(days=get_retention_days(output_file))
+        if (request.end_date or request.submission_date) + ttl < now:
+            expired.append(expire(db, output_file, paths))
+    return expired, paths
+
+
+def move_cold_outputs(db: Any, now: datetime) -> int:
+    """
+    Move the outputs not downloaded for COLD_STORAGE_AFTER_DAYS
+    to the cold storage. Returns the number of moved outputs
+    """
+    if not COLD_STORAGE_DIR:
+        return 0
+    last_use = func.coalesce(
+        db.OutputFile.last_access, db.Request.end_date, db.Request.submission_date
+    )
+    candidates = (
+        db.OutputFile.query.join(db.Request, db.OutputFile.request_id == db.Request.id)
+        .filter(last_use < now - timedelta(days=COLD_STORAGE_AFTER_DAYS))
+        .all()
+    )
+    moved = 0
+    for output_file in candidates:
+        relative_path = get_relative_path(output_file)
+        hot_path = DOWNLOAD_DIR.joinpath(relative_path)
+        if not hot_path.exists():
+            continue
+        cold_path = COLD_STORAGE_DIR.joinpath(relative_path)
+        cold_path.parent.mkdir(parents=True, exist_ok=True)
+        # the modification time is kept: the downloads can be resumed
+        shutil.move(str(hot_path), str(cold_path))
+        if output_file.timestamp:
+            shutil.rmtree(hot_path.parent, ignore_errors=True)
+        moved += 1
+    return moved
+
+
+def get_bytes_to_free() -> int:
+    usage = shutil.disk_usage(DOWNLOAD_DIR)
+    min_free = usage.total * DOWNLOAD_MIN_FREE_SPACE // 100
+    return max(min_free - usage.free, 0)
+
+
+def evict_outputs(db: Any) -> Tuple[List[Any], List[Path]]:
+    """
+    Evict the least recently used outputs of the download volume
+    until its free space is above DOWNLOAD_MIN_FREE_SPACE.
+    Returns the evicted requests and the paths to remove after the commit
+    """
+    to_free = get_bytes_to_free()
+    if not to_free:
+        return [], []
+    log.warning("Download volume under pressure: {} bytes to free", to_free)
+    last_use = func.coalesce(
+        db.OutputFile.last_access, db.Request.end_date, db.Request.submission_date
+    )
+    # the outputs from the least recently used
+    candidates = (
+        db.session.query(
+            db.OutputFile.id,
+            db.OutputFile.timestamp,
+            db.OutputFile.filename,
+            db.OutputFile.size,
+        )
+        .join(db.Request, db.OutputFile.request_id == db.Request.id)
+        .order_by(last_use.asc())
+        .all()
+    )
+    evicted = []
+    paths: List[Path] = []
+    for candidate in candidates:
+        if to_free <= 0:
+            break
+        # only the outputs in the download volume free its space
+        if not DOWNLOAD_DIR.joinpath(get_relative_path(candidate)).exists():
+            continue
+        to_free -= candidate.size or 0
+        evicted.append(expire(db, db.OutputFile.query.get(candidate.id), paths))
+    return evicted, paths
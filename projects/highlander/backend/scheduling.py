@@ -0,0 +1,133 @@
+"""
+Scheduling of the user requests.
+The requests are routed by their estimated size to the small or to the large
+queue and prioritized so that the users with other requests in the queues
+are served after the other users (fair share).
+The small queue is the default celery queue, consumed by the celery worker,
+while the large requests are consumed by the celery-large worker
+(see confs/commons.yml), so that a large request does not hold the small ones.
+"""
+import datetime
+from functools import wraps
+from typing import Any, Optional, TypeVar
+
+from celery import states
+from highlander.notifications import publish_status
+from restapi.connectors import sqlalchemy
+from restapi.connectors.celery import CeleryExt
+from restapi.env import Env
+from restapi.utilities.logs import log
+
+T = TypeVar("T")
+
+SMALL = "small"
+LARGE = "large"
+
+QUEUES = {
+    SMALL: Env.get("REQUESTS_SMALL_QUEUE", "celery"),
+    LARGE: Env.get("REQUESTS_LARGE_QUEUE", "large"),
+}
+# requests estimated up to this size (in bytes) are small
+SMALL_REQUEST_MAX_SIZE = Env.get_int("SMALL_REQUEST_MAX_SIZE", 104857600)  # 100 MB
+# max requests of a user running at the same time
+MAX_RUNNING_REQUESTS_PER_USER = Env.get_int("MAX_RUNNING_REQUESTS_PER_USER", 2)
+# seconds before retrying a request that exceeds the concurrency limit
+CONCURRENCY_RETRY_DELAY = 30
+# the requests waiting for more than a day fail
+MAX_CONCURRENCY_RETRIES = 86400 // CONCURRENCY_RETRY_DELAY
+
+# N.B. with the redis transport 0 is the highest priority
+# and the priorities are grouped in the steps 0, 3, 6, 9
+PRIORITIES = {SMALL: 0, LARGE: 6}
+FAIR_SHARE_PENALTY = 3
+
+ACTIVE_STATES = ("CREATED", states.PENDING, states.STARTED, states.RETRY)
+
+
+def classify(estimated_size: Optional[int]) -> str:
+    # requests without an estimate are handled as large ones
+    if estimated_size is None or estimated_size > SMALL_REQUEST_MAX_SIZE:
+        return LARGE
+    return SMALL
+
+
+def get_priority(db: Any, user_id: int, size_class: str) -> int:
+    """
+    Priority of a new request of the user: the requests of the users that
+    already have queued requests come after the ones of the other users
+    """
+    queued = db.Request.query.filter(
+        db.Request.user_id == user_id,
+        db.Request.status.in_(ACTIVE_STATES),
+    ).count()
+    priority = PRIORITIES[size_class]
+    # the new request is already in the db
+    if queued > 1:
+        priority += FAIR_SHARE_PENALTY
+    return priority
+
+
+def start_request(db: Any, user_id: int, request_id: int) -> bool:
+    """
+    Mark the request as started, unless the user already has
+    MAX_RUNNING_REQUESTS_PER_USER running requests.
+    The user row is locked while counting, so that the concurrent tasks
+    of the same user can't all pass the check
+    """
+    db.session.query(db.User.id).filter_by(id=user_id).with_for_update().scalar()
+    running = db.Request.query.filter(
+        db.Request.user_id == user_id,
+        db.Request.status == states.STARTED,
+        db.Request.id != request_id,
+    ).count()
+    if running >= MAX_RUNNING_REQUESTS_PER_USER:
+        db.session.rollback()
+        return False
+    request = db.Request.query.get(request_id)
+    # deleted and cancelled requests are handled by the task
+    if request and request.status in ACTIVE_STATES:
+        request.status = states.STARTED
+    db.session.commit()
+    return True
+
+
+def throttled(task: T) -> T:
+    """
+    Limit the running requests of each user: the tasks of the users with too
+    many running requests are retried later, keeping the RETRY state.
+    The tasks get the user id as the first and the request id as the last argument.
+    N.B. the check wraps the run of the task as the celery autoretry does:
+    the rapydo task wrapper would mark the Retry raised by task.retry as failed
+    """
+    run = task.run  # type: ignore
+
+    @wraps(run)
+    def throttled_run(*args: Any, **kwargs: Any) -> Any:
+        user_id, request_id = args[0], args[-1]
+        with CeleryExt.app.app_context():  # type: ignore
+            db = sqlalchemy.get_instance()
+            started = start_request(db, user_id, request_id)
+            if not started and task.request.retries >= MAX_CONCURRENCY_RETRIES:  # type: ignore
+                request = db.Request.query.get(request_id)
+                if request:
+                    request.status = states.FAILURE
+                    request.error_message = "Too many running requests"
+                    request.end_date = datetime.datetime.utcnow()
+                    db.session.commit()
+                    publish_status(user_id, request)
+        if started:
+            return run(*args, **kwargs)
+        log.info("Too many running requests for user<{}>: retry later", user_id)
+        try:
+            raise task.retry(  # type: ignore
+                countdown=CONCURRENCY_RETRY_DELAY,
+                max_retries=MAX_CONCURRENCY_RETRIES,
+                throw=False,
+            )
+        finally:
+            # the max retries of the concurrency limit don't apply to the autoretries
+            if hasattr(task, "override_max_retries"):
+                delattr(task, "override_max_retries")
+
+    task.run = throttled_run  # type: ignore
+    return task
@@ -0,0 +1,159 @@
+"""
+Serving of the static json files (geojson assets and json data of the datasets).
+The gzip and brotli encodings of the files and the simplified geometries of the
+geojson files are computed once, stored in ASSETS_CACHE_DIR next to the mirrored
+path of the sources and recomputed when the sources change.
+The files are sent according to the Accept-Encoding of the client, with
+validators (ETag, Last-Modified) and Cache-Control headers.
+"""
+import gzip
+import os
+import threading
+from pathlib import Path
+from typing import Callable, Dict, Iterable, Optional
+
+import brotli
+import geopandas as gpd
+from flask import Response, request, send_file
+from highlander.constants import CATALOG_DIR
+from restapi.env import Env
+from restapi.utilities.logs import log
+
+ASSETS_CACHE_DIR = CATALOG_DIR.joinpath("assets_cache")
+STATIC_ASSETS_MAX_AGE = Env.get_int("STATIC_ASSETS_MAX_AGE", 86400)
+
+# tolerances (in degrees) of the simplified geometries by level of detail
+SIMPLIFY_TOLERANCES = {"high": 0.0005, "medium": 0.002, "low": 0.01}
+
+# encodings by order of preference
+COMPRESSORS: Dict[str, Callable[[bytes], bytes]] = {
+    "br": lambda content: brotli.compress(content, quality=11),
+    "gzip": lambda content: gzip.compress(content, compresslevel=9, mtime=0),
+}
+EXTENSIONS = {"br": ".br", "gzip": ".gz"}
+
+
+def get_cache_path(source: Path, name: str) -> Path:
+    """
+    Path of a derived file of the source in the assets cache
+    """
+    if source.is_relative_to(ASSETS_CACHE_DIR):
+        return source.with_name(name)
+    # the cache mirrors the absolute paths of the sources
+    mirrored = ASSETS_CACHE_DIR.joinpath(*source.resolve().parts[1:])
+    return mirrored.with_name(name)
+
+
+def is_fresh(path: Path, source: Path) -> bool:
+    try:
+        return path.stat().st_mtime_ns >= source.stat().st_mtime_ns
+    except OSError:
+        return False
+
+
+def write_atomic(path: Path, content: bytes) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}")
+    tmp_path.write_bytes(content)
+    # the concurrent readers get either the old or the new file
+    tmp_path.replace(path)
+
+
+def simplify_geojson(source: Path, tolerance: float) -> bytes:
+    """
+    :raises ValueError: if the source is not a valid geojson
+    """
+    try:
+        features = gpd.read_file(source)
+    except Exception as exc:
+        raise ValueError(f"Invalid geojson {source}: {exc}")
+    features["geometry"] = features.geometry.simplify(tolerance, preserve_topology=True)
+    return features.to_json().encode()
+
+
+def get_simplified(source: Path, detail: str) -> Path:
+    """
+    Path of the geojson with the geometries simplified at a level of detail
+
+    :raises ValueError: if the source is not a valid geojson
+    """
+    simplified = get_cache_path(source, f"{source.stem}.{detail}{source.suffix}")
+    if not is_fresh(simplified, source):
+        log.debug("Simplifying {} with detail {}", source, detail)
+        content = simplify_geojson(source, SIMPLIFY_TOLERANCES[detail])
+        write_atomic(simplified, content)
+    return simplified
+
+
+def get_encoded(path: Path, encoding: str) -> Path:
+    encoded = get_cache_path(path, f"{path.name}{EXTENSIONS[encoding]}")
+    if not is_fresh(encoded, path):
+        log.debug("Compressing {} with {}", path, encoding)
+        write_atomic(encoded, COMPRESSORS[encoding](path.read_bytes()))
+    return encoded
+
+
+def negotiate_encoding() -> Optional[str]:
+    """
+    Best encoding accepted by the client, if any
+    """
+    accepted = request.accept_encodings
+    # the order of preference breaks the ties
+    encoding = max(COMPRESSORS, key=lambda e: accepted[e])
+    return encoding if accepted[encoding] else None
+
+
+def send_static_file(path: Path, mimetype: str) -> Response:
+    """
+    Send a file with the best encoding accepted by the client
+    """
+    encoding = negotiate_encoding()
+    if encoding:
+        try:
+            path = get_encoded(path, encoding)
+        except OSError as exc:
+            # e.g. for a read only cache, the file is sent uncompressed
+            log.warning("Unable to compress {}: {}", path, exc)
+            encoding = None
+    stat = path.stat()
+    response = send_file(
+        path,
+        mimetype=mimetype,
+        conditional=True,
+        etag=f"{encoding or 'identity'}-{stat.st_size:x}-{stat.st_mtime_ns:x}",
+        max_age=STATIC_ASSETS_MAX_AGE,
+    )
+    if encoding:
+        response.headers["Content-Encoding"] = encoding
+    response.vary.add("Accept-Encoding")
+    return response
+
+
+def send_static_json(source: Path, detail: Optional[str] = None) -> Response:
+    """
+    Send a json file, the geojson files can be sent with simplified geometries
+
+    :raises ValueError: if the detail is requested for an invalid geojson
+    """
+    path = get_simplified(source, detail) if detail else source
+    return send_static_file(path, "application/json")
+
+
+def precompute_assets(sources: Iterable[Path], simplify: bool = False) -> int:
+    """
+    Compute the missing or outdated encodings (and simplified geometries)
+    of the sources. Returns the number of processed sources
+    """
+    processed = 0
+    for source in sources:
+        paths = [source]
+        if simplify:
+            try:
+                paths.extend(get_simplified(source, d) for d in SIMPLIFY_TOLERANCES)
+            except ValueError as exc:
+                log.warning(exc)
+        for path in paths:
+            for encoding in COMPRESSORS:
+                get_encoded(path, encoding)
+        processed += 1
+    return processed
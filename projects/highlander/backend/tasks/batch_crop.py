@@ -0,0 +1,342 @@
+import datetime
+import json
+import shutil
+import zipfile
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from celery import states
+from celery.exceptions import Ignore
+from highlander.cancellation import check_cancelled
+from highlander.connectors import broker
+from highlander.constants import DOWNLOAD_DIR
+from highlander.crop_manifest import is_fresh
+from highlander.endpoints.utils import MapCropConfig as config
+from highlander.endpoints.utils import CropEngine, PlotUtils
+from highlander.exceptions import DiskQuotaException, RequestCancelled
+from highlander.metrics import StageTimer
+from highlander.models.sqlalchemy import Request
+from highlander.notifications import publish_status
+from highlander.scheduling import throttled
+from highlander.usage import check_quota, update_used_bytes
+from restapi.connectors import sqlalchemy
+from restapi.connectors.celery import CeleryExt, Task
+from restapi.utilities.logs import log
+
+ERA5_DATASET = "era5-downscaled-over-italy"
+
+# conservative sizes of the outputs of an area, for the disk quota check
+OUTPUT_SIZES = {"map": 1048576, "plot": 524288, "report": 2097152}
+
+
+def handle_exception(request: Optional[Request], error_msg: str) -> None:
+    if request:
+        request.status = states.FAILURE
+        request.error_message = error_msg
+
+
+def is_missing(filepath: Path) -> bool:
+    return not is_fresh(filepath)
+
+
+def estimate_batch_size(req_body: Dict[str, Any]) -> int:
+    """
+    Size of the zip of a batch request: the outputs are stored as they are
+    """
+    area_ids = req_body.get("area_ids")
+    if area_ids is None:
+        area_ids = PlotUtils.getAreas(None, req_body["area_type"]).index
+    return len(area_ids) * sum(OUTPUT_SIZES[o] for o in req_body["outputs"])
+
+
+def create_batch_outputs(
+    dataset_id: str,
+    product_id: str,
+    req_body: Dict[str, Any],
+    zip_path: Path,
+    request_id: int,
+) -> int:
+    """
+    Create the maps, plots and reports of all the requested areas and
+    pack them in a zip file. Returns the number of packed files.
+
+    The source data are read once: all the areas are cropped with a single mask.
+    Outputs and cropped data already in the crops (or stripes) tree are reused
+    and the new ones are saved there to be reused by the crop and report
+    endpoints.
+    The cancellation of the request is checked between the areas.
+    """
+    timer = StageTimer("batch", dataset_id, product_id)
+    outputs: List[str] = req_body["outputs"]
+    area_type = req_body["area_type"]
+    variables: Dict[str, Any] = {
+        "dataset_id": dataset_id,
+        "product_id": product_id,
+        "area_type": area_type,
+        "indicator": req_body.get("indicator"),
+        "model_id": req_body.get("model_id"),
+        "year": req_body.get("year"),
+        "date": req_body.get("date"),
+        "daily_metric": req_body.get("daily_metric"),
+        "time_period": req_body.get("time_period"),
+        "reference_period": req_body.get("reference_period"),
+    }
+
+    dds = broker.get_instance()
+    with timer.stage("dataset_details"):
+        dataset_details = dds.get_dataset_details([dataset_id])
+    if not dataset_details["data"]:
+        raise LookupError(f"dataset {dataset_id} not found")
+    product_details = CropEngine.getProductDetails(
+        dataset_details, dataset_id, product_id
+    )
+    if not product_details:
+        raise LookupError(f"product {product_id} for dataset {dataset_id} not found")
+
+    output_structure = config.getOutputPath(dataset_id, product_id, variables)
+    if not output_structure:
+        raise LookupError(
+            f"{dataset_id} or {product_id} keys not present in output structure map"
+        )
+    output_dir = config.CROPS_OUTPUT_ROOT.joinpath(*output_structure)
+
+    # parse the geojson once for all the areas
+    with timer.stage("get_area"):
+        areas = PlotUtils.getAreas(req_body.get("area_ids"), area_type)
+
+    # the outputs of each area
+    artifacts: Dict[str, Dict[str, Path]] = {}
+    for area_name in areas.index:
+        map_filepath, plot_filepath = CropEngine.getReportArtifacts(
+            dataset_id, area_name, output_dir, variables
+        )
+        artifacts[area_name] = {"map": map_filepath, "plot": plot_filepath}
+
+    # the report needs both the map and the plot
+    need_map = "map" in outputs or "report" in outputs
+    need_plot = "plot" in outputs or "report" in outputs
+
+    # crop only the areas with missing outputs
+    to_plot = [
+        area_name
+        for area_name, paths in artifacts.items()
+        if (need_map and is_missing(paths["map"]))
+        or (need_plot and dataset_id != ERA5_DATASET and is_missing(paths["plot"]))
+    ]
+    # the cropped data stored by previous requests are reused
+    cropped_filepaths = {
+        area_name: output_dir.joinpath(config.getCroppedFilename(area_name))
+        for area_name in to_plot
+    }
+    to_crop = [a for a, path in cropped_filepaths.items() if is_missing(path)]
+    crops: Dict[str, Any] = {}
+    if to_crop:
+        crops = CropEngine.cropDataAreas(
+            dds,
+            dataset_id,
+            product_id,
+            product_details,
+            variables,
+            areas.loc[to_crop],
+            timer=timer,
+        )
+        # share the cropped data with the crop and report endpoints
+        for area_name, nc_cropped in crops.items():
+            check_cancelled(request_id)
+            CropEngine.storeCrop(
+                nc_cropped, cropped_filepaths[area_name], dataset_id, timer=timer
+            )
+    for area_name in to_plot:
+        if area_name not in crops:
+            with timer.stage("read_crop"):
+                crops[area_name] = PlotUtils.readCrop(cropped_filepaths[area_name])
+    for area_name, nc_cropped in crops.items():
+        check_cancelled(request_id)
+        paths = artifacts[area_name]
+        if need_map and is_missing(paths["map"]):
+            CropEngine.plotCrop(
+                nc_cropped,
+                dataset_id,
+                product_id,
+                variables,
+                "map",
+                None,
+                "png",
+                paths["map"],
+                timer=timer,
+            )
+        if need_plot and dataset_id != ERA5_DATASET and is_missing(paths["plot"]):
+            CropEngine.plotCrop(
+                nc_cropped,
+                dataset_id,
+                product_id,
+                variables,
+                "plot",
+                "distribution",
+                "png",
+                paths["plot"],
+                timer=timer,
+            )
+
+    # the plots of the era5 reports are the climate stripes
+    stripes_to_plot = [
+        area_name
+        for area_name, paths in artifacts.items()
+        if need_plot and dataset_id == ERA5_DATASET and is_missing(paths["plot"])
+    ]
+    if stripes_to_plot:
+        stripes_filepath = CropEngine.getStripesSourceFilepath(
+            dds,
+            dataset_id,
+            variables["indicator"],
+            variables["reference_period"],
+            variables["time_period"],
+        )
+        stripes = PlotUtils.cropAreas(
+            stripes_filepath,
+            areas.loc[stripes_to_plot],
+            variables["indicator"],
+            decode_time=True,
+            timer=timer,
+        )
+        for area_name, nc_cropped in stripes.items():
+            check_cancelled(request_id)
+            CropEngine.plotStripesData(
+                nc_cropped,
+                area_name,
+                artifacts[area_name]["plot"],
+                timer=timer,
+                source_path=stripes_filepath,
+                dataset_id=dataset_id,
+            )
+
+    packed = 0
+    # pngs and pdfs are already compressed: store them as they are
+    with timer.stage("zip"), zipfile.ZipFile(zip_path, "w") as zf:
+        for area_name, paths in artifacts.items():
+            check_cancelled(request_id)
+            area_dir = area_name.replace(" ", "_")
+            if "map" in outputs:
+                zf.write(paths["map"], f"{area_dir}/{paths['map'].name}")
+                packed += 1
+            if "plot" in outputs:
+                zf.write(paths["plot"], f"{area_dir}/{paths['plot'].name}")
+                packed += 1
+            if "report" in outputs:
+                label_map, label_plot = CropEngine.getReportLabels(
+                    dataset_id,
+                    area_name,
+                    output_structure,
+                    req_body.get("label"),
+                    variables["reference_period"],
+                )
+                report_filepath = CropEngine.writeReport(
+                    dataset_details,
+                    output_structure,
+                    area_name,
+                    label_map,
+                    paths["map"],
+                    label_plot,
+                    paths["plot"],
+                    timer=timer,
+                )
+                zf.write(report_filepath, f"{area_dir}/{area_dir}_report.pdf")
+                packed += 1
+    log.info("Pipeline timing: {}", json.dumps(timer.to_dict()))
+    return packed
+
+
+@throttled
+@CeleryExt.task(idempotent=True)
+def batch_crop(
+    self: Task[[int, str, str, Dict[str, Any], int], None],
+    user_id: int,
+    dataset_id: str,
+    product_id: str,
+    req_body: Dict[str, Any],
+    request_id: int,
+) -> None:
+    log.info("Start task [{}:{}]", self.request.id, self.name)
+    log.debug(
+        "Batch crop: Dataset<{}> Product<{}> UserID<{}>",
+        dataset_id,
+        product_id,
+        user_id,
+    )
+    db = sqlalchemy.get_instance()
+    request = None
+    cancelled = False
+    output_dir = None
+    recorded = False
+    try:
+        # a request deleted before the task started is cancelled as well
+        check_cancelled(request_id)
+        # load request by id
+        request = db.Request.query.get(request_id)
+        if not request:
+            raise ReferenceError(
+                f"Cannot find request reference for task {self.request.id}"
+            )
+        request.status = states.STARTED
+        db.session.commit()
+        publish_status(user_id, request)
+
+        # check the size estimate to avoid exceeding the user quota
+        check_quota(db, user_id, estimate_batch_size(req_body))
+        check_cancelled(request_id)
+
+        timestamp = datetime.datetime.utcnow().strftime("%Y%m%dT%H%M%S%f")
+        output_dir = DOWNLOAD_DIR.joinpath(timestamp)
+        output_dir.mkdir(parents=True, exist_ok=True)
+        zip_path = output_dir.joinpath(
+            f"{dataset_id}_{product_id}_{req_body['area_type']}.zip"
+        )
+        publish_status(user_id, request, progress="creating the outputs")
+        packed = create_batch_outputs(
+            dataset_id, product_id, req_body, zip_path, request_id
+        )
+        log.debug("{} files packed in {}", packed, zip_path)
+
+        # the request can be cancelled while its output is written:
+        # lock it and check its status before recording the output
+        db.session.refresh(request, with_for_update=True)
+        if request.status == states.REVOKED:
+            raise RequestCancelled(f"Request ID<{request_id}> cancelled")
+
+        # update request status
+        request.status = states.SUCCESS
+
+        # create output_file record in db
+        data_size = zip_path.stat().st_size
+        output_file = db.OutputFile(
+            request_id=request_id,
+            filename=zip_path.name,
+            timestamp=timestamp,
+            size=data_size,
+        )
+        db.session.add(output_file)
+        update_used_bytes(db, user_id, data_size)
+
+    except RequestCancelled as exc:
+        # the request can be already deleted: leave it as it is
+        cancelled = True
+        db.session.rollback()
+        raise Ignore(str(exc))
+    except DiskQuotaException as exc:
+        handle_exception(request, error_msg=str(exc))
+        raise Ignore(str(exc))
+    except Exception as exc:
+        handle_exception(request, error_msg=f"Failed to create the batch: {str(exc)}")
+        raise exc
+    finally:
+        try:
+            if request and not cancelled:
+                request.end_date = datetime.datetime.utcnow()
+                db.session.commit()
+                recorded = request.status == states.SUCCESS
+                publish_status(user_id, request)
+        finally:
+            # remove the partial outputs of a job failed or cancelled at any step
+            if output_dir and not recorded:
+                log.info("Remove the partial outputs: {}", output_dir)
+                shutil.rmtree(output_dir, ignore_errors=True)
@@ -0,0 +1,34 @@
+from typing import Dict
+
+from highlander.crop_manifest import evict_outputs, purge_outputs
+from highlander.endpoints.utils import MapCropConfig, PlotUtils
+from restapi.connectors.celery import CeleryExt, Task
+from restapi.utilities.logs import log
+
+
+@CeleryExt.task(idempotent=True)
+def purge_crops(self: Task[[], Dict[str, int]]) -> Dict[str, int]:
+    """
+    Remove the cached crops and stripes whose source file, legend or renderer
+    changed, and the ones missing in the manifest. They are rendered again
+    at the next request.
+    """
+    log.info("Start task [{}:{}]", self.request.id, self.name)
+    stale, untracked = purge_outputs(
+        [MapCropConfig.CROPS_OUTPUT_ROOT, MapCropConfig.STRIPES_OUTPUT_ROOT],
+        PlotUtils.getLegendLevels,
+    )
+    log.info("Crops removed: {} stale, {} untracked", stale, untracked)
+    return {"stale": stale, "untracked": untracked}
+
+
+@CeleryExt.task(idempotent=True)
+def evict_crops(self: Task[[], int]) -> int:
+    """
+    Remove the least recently used cached crops and stripes of the datasets
+    over their quota and of the crops tree over its disk budget
+    """
+    log.info("Start task [{}:{}]", self.request.id, self.name)
+    evicted = evict_outputs()
+    log.info("Crops evicted: {}", evicted)
+    return evicted
@@ -1,20 +1,34 @@
 import datetime
 import pathlib
+import shutil
 from typing import Any, Dict, List, Optional
 
 from celery import states
 from celery.exceptions import Ignore
+from highlander.cancellation import check_cancelled
 from highlander.connectors import broker
+from highlander.constants import DOWNLOAD_DIR
 from highlander.exceptions import (
     AccessToDatasetDenied,
     DiskQuotaException,
     EmptyOutputFile,
+    RequestCancelled,
+    UnsupportedPointRequest,
 )
 from highlander.models.sqlalchemy import Request
+from highlander.notifications import publish_status
+from highlander.output_formats import (
+    NETCDF,
+    convert_output,
+    estimate_output_size,
+    is_point_request,
+)
+from highlander.point_series import extract_point_series
+from highlander.scheduling import throttled
+from highlander.usage import check_quota, update_used_bytes
 from restapi.connectors import sqlalchemy
 from restapi.connectors.celery import CeleryExt, Task
 from restapi.utilities.logs import log
-from sqlalchemy.sql import func
 
 
 def handle_exception(request: Optional[Request], error_msg: str) -> None:
@@ -23,15 +37,66 @@ def handle_exception(request: Optional[Request], error_msg: str) -> None:
         request.error_message = error_msg
 
 
-def human_size(
-    bytes: int, units: List[str] = [" bytes", "KB", "MB", "GB", "TB", "PB", "EB"]
-) -> str:
-    """Returns a human-readable string representation of bytes
-    :rtype: string
+def remove_output(result_path: pathlib.Path) -> None:
+    log.info("Remove the output: {}", result_path)
+    if result_path.parent.name != "download":
+        shutil.rmtree(result_path.parent, ignore_errors=True)
+    else:
+        result_path.unlink(missing_ok=True)
+
+
+def retrieve_point_series(
+    dds: Any, dataset_name: str, req_body: Dict[str, Any]
+) -> Optional[pathlib.Path]:
+    """
+    Fast path of the location requests.
+    Returns None when the request has to be retrieved by the broker
     """
-    return str(bytes) + units[0] if bytes < 1024 else human_size(bytes >> 10, units[1:])
+    timestamp = datetime.datetime.utcnow().strftime("%Y%m%dT%H%M%S%f")
+    output_dir = DOWNLOAD_DIR.joinpath(timestamp)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    try:
+        return extract_point_series(dds, dataset_name, req_body, output_dir)
+    except UnsupportedPointRequest as exc:
+        log.info("Location request retrieved by the broker: {}", exc)
+        shutil.rmtree(output_dir, ignore_errors=True)
+        return None
+    except Exception:
+        shutil.rmtree(output_dir, ignore_errors=True)
+        raise
+
+
+def retrieve_by_year(
+    dds: Any, dataset_name: str, req_body: Dict[str, Any], request_id: int
+) -> List[pathlib.Path]:
+    """
+    Retrieve the data with the broker a year at a time, so that the
+    cancellation of the request is checked between the years.
+    Returns the retrieved files
+    """
+    # the broker always writes netcdf files
+    request = {**req_body, "format": NETCDF}
+    time = request.get("time") or {}
+    parts: List[pathlib.Path] = []
+    try:
+        for year in time.get("year") or [None]:
+            check_cancelled(request_id)
+            if year is not None:
+                request["time"] = {**time, "year": [year]}
+            result_path = dds.broker.retrieve(
+                dataset_name=dataset_name, request=request.copy()
+            )
+            log.debug("data result_path: {}", result_path)
+            parts.append(pathlib.Path(result_path))
+        check_cancelled(request_id)
+    except BaseException:
+        for part in parts:
+            remove_output(part)
+        raise
+    return parts
 
 
+@throttled
 @CeleryExt.task(idempotent=True)
 def extract_data(
     self: Task[[int, str, Dict[str, Any], int], None],
@@ -42,50 +107,63 @@ def extract_data(
 ) -> None:
     log.info("Start task [{}:{}]", self.request.id, self.name)
     log.debug("Data Extraction: Dataset<{}> UserID<{}>", dataset_name, user_id)
+    db = sqlalchemy.get_instance()
     request = None
+    cancelled = False
+    result_path = None
     try:
-        db = sqlalchemy.get_instance()
+        # a request deleted before the task started is cancelled as well
+        check_cancelled(request_id)
         # load request by id
         request = db.Request.query.get(request_id)
         if not request:
             raise ReferenceError(
                 f"Cannot find request reference for task {self.request.id}"
             )
+        request.status = states.STARTED
+        db.session.commit()
+        publish_status(user_id, request)
 
         dds = broker.get_instance()
+        format_ = req_body.get("format", NETCDF)
 
         # check the size estimate to avoid exceeding the user quota
-        data_size_estimate = dds.broker.estimate_size(
-            dataset_name=dataset_name, request=req_body.copy()
-        )
-        log.debug("DATA SIZE ESTIMATE: {}", data_size_estimate)
-        user_quota = db.session.query(db.User.disk_quota).filter_by(id=user_id).scalar()  # type: ignore
-        log.debug("USER QUOTA for user<{}>: {}", user_id, user_quota)
-        used_quota = (
-            db.session.query(func.sum(db.OutputFile.size).label("total_used"))
-            .join(db.Request)  # type: ignore
-            .filter(db.Request.user_id == user_id, db.OutputFile.size is not None)
-            .all()[0][0]
-            or 0
+        data_size_estimate = estimate_output_size(
+            dds.broker.estimate_size(
+                dataset_name=dataset_name, request=req_body.copy()
+            ),
+            format_,
         )
-        log.debug("USED QUOTA: {}", used_quota)
-        if used_quota + data_size_estimate > user_quota:
-            free_space = max(user_quota - used_quota, 0)
-            # save error message in db
-            message = (
-                "Disk quota exceeded: required size {}; remaining space {}".format(
-                    human_size(data_size_estimate), human_size(free_space)
-                )
-            )
-            raise DiskQuotaException(message)
+        check_quota(db, user_id, data_size_estimate)
 
         log.debug(req_body)
-        # run data extraction
-        result_path = dds.broker.retrieve(
-            dataset_name=dataset_name, request=req_body.copy()
-        )
-
-        log.debug("data result_path: {}", result_path)
+        check_cancelled(request_id)
+        publish_status(user_id, request, progress="extracting data")
+        # the time series at a location are read without the broker, if possible
+        if is_point_request(req_body):
+            result_path = retrieve_point_series(dds, dataset_name, req_body)
+        if not result_path:
+            # run data extraction
+            parts = retrieve_by_year(dds, dataset_name, req_body, request_id)
+            # write the data compressed and in the requested format
+            publish_status(user_id, request, progress="writing the output")
+            try:
+                result_path = convert_output(parts, format_)
+            except BaseException:
+                for part in parts:
+                    remove_output(part)
+                raise
+            # remove the directories of the other retrieved files
+            for part in parts[1:]:
+                if part.parent != result_path.parent:
+                    remove_output(part)
+        check_cancelled(request_id)
+
+        # the request can be cancelled while its output is written:
+        # lock it and check its status before recording the output
+        db.session.refresh(request, with_for_update=True)
+        if request.status == states.REVOKED:
+            raise RequestCancelled(f"Request ID<{request_id}> cancelled")
 
         # update request status
         request.status = states.SUCCESS
@@ -106,7 +184,15 @@ def extract_data(
             size=data_size,
         )
         db.session.add(output_file)
-
+        update_used_bytes(db, user_id, data_size)
+
+    except RequestCancelled as exc:
+        # the request can be already deleted: leave it as it is
+        cancelled = True
+        db.session.rollback()
+        if result_path:
+            remove_output(pathlib.Path(result_path))
+        raise Ignore(str(exc))
     except (DiskQuotaException, AccessToDatasetDenied, EmptyOutputFile) as exc:
         handle_exception(request, error_msg=str(exc))
         raise Ignore(str(exc))
@@ -114,6 +200,7 @@ def extract_data(
         handle_exception(request, error_msg=f"Failed to extract data: {str(exc)}")
         raise exc
     finally:
-        if request:
+        if request and not cancelled:
             request.end_date = datetime.datetime.utcnow()
             db.session.commit()
+            publish_status(user_id, request)
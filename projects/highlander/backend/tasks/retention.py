@@ -0,0 +1,52 @@
+import datetime
+from typing import Dict
+
+from highlander.notifications import publish_status
+from highlander.retention import (
+    evict_outputs,
+    expire_outputs,
+    move_cold_outputs,
+    remove_paths,
+)
+from restapi.connectors import sqlalchemy
+from restapi.connectors.celery import CeleryExt, Task
+from restapi.utilities.logs import log
+
+
+@CeleryExt.task(idempotent=True)
+def apply_retention(self: Task[[], Dict[str, int]]) -> Dict[str, int]:
+    """
+    Periodic cleaning of the download volume.
+    The expired outputs are removed, the cold ones are moved to the cold
+    storage (if any) and, if the volume is still short of space, the least
+    recently used outputs are evicted.
+    """
+    log.info("Start task [{}:{}]", self.request.id, self.name)
+    db = sqlalchemy.get_instance()
+    now = datetime.datetime.utcnow()
+    # the files are removed only once their rows are deleted:
+    # after a failed commit the rows still point to existing files
+    try:
+        expired, expired_paths = expire_outputs(db, now)
+        db.session.commit()
+    except Exception as exc:
+        db.session.rollback()
+        raise exc
+    remove_paths(expired_paths)
+    try:
+        moved = move_cold_outputs(db, now)
+        evicted, evicted_paths = evict_outputs(db)
+        db.session.commit()
+    except Exception as exc:
+        db.session.rollback()
+        raise exc
+    remove_paths(evicted_paths)
+    for request in expired + evicted:
+        publish_status(request.user_id, request)
+    log.info(
+        "Outputs expired: {}, moved to the cold storage: {}, evicted: {}",
+        len(expired),
+        moved,
+        len(evicted),
+    )
+    return {"expired": len(expired), "moved": moved, "evicted": len(evicted)}
@@ -0,0 +1,56 @@
+from pathlib import Path
+from typing import Dict, List
+
+from highlander.catalog import get_catalog_ext
+from highlander.endpoints.utils import MapCropConfig
+from highlander.static_assets import precompute_assets
+from highlander.vector_tiles import PRECOMPUTED_MAX_ZOOM, precompute_tiles
+from restapi.connectors.celery import CeleryExt, Task
+from restapi.utilities.logs import log
+
+
+@CeleryExt.task(idempotent=True)
+def precompute_static_assets(self: Task[[], Dict[str, int]]) -> Dict[str, int]:
+    """
+    Compute the encodings of the static json files and the simplified
+    geometries of the geojson assets, so that they are ready to be sent.
+    """
+    log.info("Start task [{}:{}]", self.request.id, self.name)
+    assets = sorted(Path(MapCropConfig.GEOJSON_PATH).glob("*.json"))
+    json_data: List[Path] = []
+    cat_ext = get_catalog_ext()
+    if cat_ext:
+        for dataset in cat_ext.get_datasets():
+            if "source_path" in dataset:
+                json_data.extend(sorted(Path(dataset["source_path"]).glob("*.json")))
+    result = {
+        "assets": precompute_assets(assets, simplify=True),
+        "json_data": precompute_assets(json_data),
+    }
+    log.info("Static assets precomputed: {}", result)
+    return result
+
+
+@CeleryExt.task(idempotent=True)
+def precompute_boundary_tiles(
+    self: Task[[List[str], int], Dict[str, int]],
+    administratives: List[str] = [],
+    max_zoom: int = PRECOMPUTED_MAX_ZOOM,
+) -> Dict[str, int]:
+    """
+    Build the vector tiles of the administrative boundaries up to a zoom level.
+
+    @param administratives: administrative levels (e.g. regions), all if empty
+    @param max_zoom: the tiles of the higher zoom levels are built on request
+    """
+    log.info("Start task [{}:{}]", self.request.id, self.name)
+    if not administratives:
+        administratives = [
+            f.stem[len("italy-") :]
+            for f in sorted(Path(MapCropConfig.GEOJSON_PATH).glob("italy-*.json"))
+        ]
+    result = {}
+    for administrative in administratives:
+        result[administrative] = precompute_tiles(administrative, max_zoom)
+        log.info("Tiles of {}: {}", administrative, result[administrative])
+    return result
@@ -0,0 +1,26 @@
+from highlander.usage import reconcile_used_bytes
+from restapi.connectors import sqlalchemy
+from restapi.connectors.celery import CeleryExt, Task
+from restapi.utilities.logs import log
+
+
+@CeleryExt.task(idempotent=True)
+def reconcile_usage(self: Task[[], int]) -> int:
+    """
+    Periodic check of the used bytes counters of the users.
+    Counters drifted from the sizes of the user output files
+    (e.g. for files removed outside the API) are realigned.
+    """
+    log.info("Start task [{}:{}]", self.request.id, self.name)
+    db = sqlalchemy.get_instance()
+    try:
+        fixed = reconcile_used_bytes(db)
+        db.session.commit()
+    except Exception as exc:
+        db.session.rollback()
+        raise exc
+    if fixed:
+        log.warning("Used bytes realigned for {} users", fixed)
+    else:
+        log.info("Used bytes counters are aligned")
+    return fixed
@@ -0,0 +1,93 @@
+"""
+Benchmarks of the hot paths of the crop, stripes, report and dataset endpoints.
+
+The benchmarks are slow (the synthetic data have realistic sizes) and are
+skipped unless RUN_BENCHMARKS is enabled.
+Store a baseline with:
+    RUN_BENCHMARKS=1 pytest tests/benchmarks --benchmark-autosave
+and check for regressions against the last stored baseline with:
+    RUN_BENCHMARKS=1 pytest tests/benchmarks --benchmark-compare
+A benchmark fails when its mean is worse than the baseline by more than
+DEFAULT_COMPARE_FAIL, unless a different --benchmark-compare-fail is given.
+In the backend workflow the runs are compared with the baseline stored by
+the last run on main, kept in the actions cache (no baseline is committed:
+the timings depend on the machine).
+"""
+from pathlib import Path
+from typing import Any, Iterator
+
+import netCDF4  # type: ignore
+import numpy as np
+import pytest
+from pytest_benchmark.utils import parse_compare_fail
+from restapi.env import Env
+
+RUN_BENCHMARKS = Env.get_bool("RUN_BENCHMARKS")
+DEFAULT_COMPARE_FAIL = "mean:20%"
+
+# Italy at the 2.2 km resolution of the VHR datasets
+LAT_RANGE = (35.5, 47.5)
+LON_RANGE = (6.0, 19.0)
+GRID_STEP = 0.02
+DAYS = 365
+
+
+@pytest.hookimpl(tryfirst=True)
+def pytest_configure(config: Any) -> None:
+    if (
+        getattr(config.option, "benchmark_compare", None)
+        and not config.option.benchmark_compare_fail
+    ):
+        config.option.benchmark_compare_fail = [
+            parse_compare_fail(DEFAULT_COMPARE_FAIL)
+        ]
+
+
+def pytest_collection_modifyitems(items: Any) -> None:
+    if RUN_BENCHMARKS:
+        return
+    skip = pytest.mark.skip(reason="benchmarks are enabled by RUN_BENCHMARKS")
+    for item in items:
+        if "benchmarks" in item.nodeid:
+            item.add_marker(skip)
+
+
+def write_synthetic_netcdf(path: Path, variable: str, days: int) -> Path:
+    lat = np.arange(*LAT_RANGE, GRID_STEP, dtype=np.float32)
+    lon = np.arange(*LON_RANGE, GRID_STEP, dtype=np.float32)
+    rng = np.random.default_rng(42)
+    with netCDF4.Dataset(path, "w") as nc:
+        nc.createDimension("lat", len(lat))
+        nc.createDimension("lon", len(lon))
+        dims = ("lat", "lon")
+        if days:
+            nc.createDimension("time", days)
+            nc.createVariable("time", "f8", ("time",))[:] = np.arange(days)
+            nc["time"].units = "days since 2020-01-01 00:00:00"
+            dims = ("time", "lat", "lon")
+        nc.createVariable("lat", "f4", ("lat",))[:] = lat
+        nc.createVariable("lon", "f4", ("lon",))[:] = lon
+        var = nc.createVariable(variable, "f4", dims, fill_value=np.nan)
+        var.units = "°C"
+        var.long_name = "wind-chill"
+        if days:
+            # write a layer at a time to keep the memory bounded
+            for day in range(days):
+                var[day] = rng.normal(15, 10, (len(lat), len(lon)))
+        else:
+            var[:] = rng.normal(15, 10, (len(lat), len(lon)))
+    return path
+
+
+@pytest.fixture(scope="session")
+def daily_netcdf(tmp_path_factory: Any) -> Iterator[Path]:
+    """A year of daily layers over Italy"""
+    path = tmp_path_factory.mktemp("data").joinpath("wc_2020_daymax.nc")
+    yield write_synthetic_netcdf(path, "wc", DAYS)
+
+
+@pytest.fixture(scope="session")
+def multiyear_netcdf(tmp_path_factory: Any) -> Iterator[Path]:
+    """A single layer over Italy"""
+    path = tmp_path_factory.mktemp("data").joinpath("wc_multiyearmean.nc")
+    yield write_synthetic_netcdf(path, "wc", 0)
@@ -0,0 +1,42 @@
+from typing import Any
+
+import pytest
+from highlander.connectors import broker
+from highlander.tests import TestParams as params
+from restapi.tests import FlaskClient
+
+
+@pytest.fixture
+def dds(client: FlaskClient) -> Any:
+    dds = broker.get_instance()
+    not_cached_datasets = dds.get_uncached_datasets()
+    if params.DATASET_ID in not_cached_datasets:
+        pytest.skip(f"{params.DATASET_ID} has no cache")
+    if params.DATASET_VHR in not_cached_datasets:
+        pytest.skip(f"{params.DATASET_VHR} has no cache")
+    return dds
+
+
+def test_get_dataset_details(benchmark: Any, dds: Any) -> None:
+    details = benchmark(dds.get_dataset_details, [params.DATASET_ID])
+    assert details["data"]
+
+
+def test_get_product_for_dataset(benchmark: Any, dds: Any) -> None:
+    product = benchmark(
+        dds.get_product_for_dataset, params.DATASET_ID, params.PRODUCT_ID
+    )
+    assert product["widgets"]
+
+
+def test_estimate_size_check(benchmark: Any, dds: Any) -> None:
+    request = {
+        "product_type": params.PRODUCT_VHR,
+        "format": "netcdf",
+        "variable": ["air_temperature"],
+        "time": {"year": ["2020"], "month": ["1"], "day": ["1"]},
+    }
+    size = benchmark(
+        dds.estimate_size_check, dataset_name=params.DATASET_VHR, request=request
+    )
+    assert size > 0
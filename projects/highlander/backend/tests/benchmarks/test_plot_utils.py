@@ -0,0 +1,110 @@
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any
+
+import numpy as np
+import pytest
+from highlander.endpoints.utils import MapCropConfig, PlotUtils
+from highlander.tests import TestParams as params
+
+REGIONS = ["lombardia", "sicilia", "valle d'aosta"]
+REGIONS_GEOJSON = Path(MapCropConfig.GEOJSON_PATH, "italy-regions.json")
+
+
+@pytest.fixture(scope="module")
+def areas() -> Any:
+    if not REGIONS_GEOJSON.is_file():
+        pytest.skip(f"{REGIONS_GEOJSON} not found")
+    return {region: PlotUtils.getArea(region, "regions")[1] for region in REGIONS}
+
+
+@pytest.mark.parametrize("region", REGIONS)
+def test_crop_area_daily(
+    benchmark: Any, daily_netcdf: Path, areas: Any, region: str
+) -> None:
+    cropped = benchmark(
+        PlotUtils.cropArea,
+        daily_netcdf,
+        region,
+        areas[region],
+        "wc",
+        year_day=180,
+        has_time=True,
+    )
+    assert cropped.size > 0
+
+
+def test_crop_area_multiyear(
+    benchmark: Any, multiyear_netcdf: Path, areas: Any
+) -> None:
+    cropped = benchmark(
+        PlotUtils.cropArea, multiyear_netcdf, "lombardia", areas["lombardia"], "wc"
+    )
+    assert cropped.size > 0
+
+
+def test_get_area(benchmark: Any) -> None:
+    if not REGIONS_GEOJSON.is_file():
+        pytest.skip(f"{REGIONS_GEOJSON} not found")
+    area_name, area = benchmark(PlotUtils.getArea, params.REGION_ID, "regions")
+    assert not area.empty
+
+
+def test_plot_map_netcdf(
+    benchmark: Any, multiyear_netcdf: Path, areas: Any, tmp_path: Path
+) -> None:
+    cropped = PlotUtils.cropArea(
+        multiyear_netcdf, "lombardia", areas["lombardia"], "wc"
+    )
+    outputfile = tmp_path.joinpath("lombardia_map.png")
+    benchmark(
+        PlotUtils.plotMapNetcdf,
+        cropped.values,
+        cropped.lat.values,
+        cropped.lon.values,
+        cropped.units,
+        cropped.long_name,
+        params.PRODUCT_ID_HW,
+        outputfile,
+        "",
+    )
+    assert outputfile.stat().st_size > 0
+
+
+def test_plot_stripes(benchmark: Any, tmp_path: Path) -> None:
+    years = [str(y) for y in range(1981, 2021)]
+    anomalies = np.random.default_rng(42).normal(0, 1, (1, len(years)))
+    outputfile = tmp_path.joinpath("italy_stripes.png")
+    benchmark(PlotUtils.plotStripes, anomalies, years, "Italy", outputfile)
+    assert outputfile.stat().st_size > 0
+
+
+def test_plot_stripes_threads(benchmark: Any, tmp_path: Path) -> None:
+    years = [str(y) for y in range(1981, 2021)]
+    rng = np.random.default_rng(42)
+    anomalies = [rng.normal(0, 1, (1, len(years))) for _ in range(8)]
+    expected = tmp_path.joinpath("expected")
+    rendered = tmp_path.joinpath("rendered")
+    expected.mkdir()
+    rendered.mkdir()
+    for i, a in enumerate(anomalies):
+        PlotUtils.plotStripes(a, years, f"area_{i}", expected.joinpath(f"{i}.png"))
+
+    def render() -> None:
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            list(
+                executor.map(
+                    lambda i: PlotUtils.plotStripes(
+                        anomalies[i], years, f"area_{i}", rendered.joinpath(f"{i}.png")
+                    ),
+                    range(len(anomalies)),
+                )
+            )
+
+    benchmark(render)
+    # the concurrent renders are the same as the sequential ones
+    for i in range(len(anomalies)):
+        assert (
+            rendered.joinpath(f"{i}.png").read_bytes()
+            == expected.joinpath(f"{i}.png").read_bytes()
+        )
@@ -0,0 +1,47 @@
+from restapi.tests import API_URI, BaseTests, FlaskClient
+
+# a point in Rome and one in the sea
+ROME = {"latitude": 41.9, "longitude": 12.5}
+SEA = {"latitude": 40.0, "longitude": 5.0}
+
+
+class TestApp(BaseTests):
+    def test_areas_lookup(self, client: FlaskClient) -> None:
+        endpoint = f"{API_URI}/areas/lookup"
+
+        # invalid coordinates
+        r = client.get(endpoint, query_string={"latitude": 100, "longitude": 12})
+        assert r.status_code == 400
+
+        # invalid level
+        r = client.get(endpoint, query_string={**ROME, "levels": "countries"})
+        assert r.status_code == 400
+
+        # lookup a point in all the levels
+        r = client.get(endpoint, query_string=ROME)
+        assert r.status_code == 200
+        areas = self.get_content(r)
+        assert isinstance(areas, dict)
+        assert areas["regions"] == "lazio"
+        assert areas["provinces"]
+
+        # lookup a point in a level
+        r = client.get(endpoint, query_string={**SEA, "levels": "regions"})
+        assert r.status_code == 200
+        areas = self.get_content(r)
+        assert areas == {"regions": None}
+
+        # lookup several points
+        r = client.post(
+            endpoint, json={"points": [ROME, SEA], "levels": ["regions", "provinces"]}
+        )
+        assert r.status_code == 200
+        areas = self.get_content(r)
+        assert isinstance(areas, list)
+        assert len(areas) == 2
+        assert areas[0]["regions"] == "lazio"
+        assert areas[1] == {"regions": None, "provinces": None}
+
+        # no points
+        r = client.post(endpoint, json={"points": []})
+        assert r.status_code == 400
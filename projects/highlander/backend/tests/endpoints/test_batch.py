@@ -0,0 +1,139 @@
+import pytest
+from faker import Faker
+from flask import Flask
+from highlander.constants import DOWNLOAD_DIR
+from highlander.tests import TestParams as params
+from restapi.connectors import sqlalchemy
+from restapi.connectors.celery import Ignore
+from restapi.services.authentication import BaseAuthentication
+from restapi.tests import API_URI, BaseTests, FlaskClient
+
+
+class TestApp(BaseTests):
+    def test_api_access(self, client: FlaskClient) -> None:
+        endpoint = (
+            f"{API_URI}/datasets/{params.DATASET_ID}/products/{params.PRODUCT_ID}/batch"
+        )
+        r = client.post(endpoint, json={"area_type": "regions", "all_areas": True})
+        assert r.status_code == 401
+
+    def test_batch_request(self, client: FlaskClient, faker: Faker) -> None:
+        headers, _ = self.do_login(client, None, None)
+        endpoint = (
+            f"{API_URI}/datasets/{params.DATASET_ID}/products/{params.PRODUCT_ID}/batch"
+        )
+        data = {
+            "area_type": "regions",
+            "indicator": params.INDICATOR,
+            "model_id": params.MODEL_ID,
+        }
+
+        # check missing areas
+        r = client.post(endpoint, json=data, headers=headers)
+        assert r.status_code == 400
+
+        # check not existing dataset
+        fake_dataset = faker.pystr()
+        fake_endpoint = (
+            f"{API_URI}/datasets/{fake_dataset}/products/{params.PRODUCT_ID}/batch"
+        )
+        r = client.post(
+            fake_endpoint, json={**data, "all_areas": True}, headers=headers
+        )
+        assert r.status_code == 404
+        response_msg = self.get_content(r)
+        assert response_msg == f"dataset {fake_dataset} not found"
+
+        # check missing parameters
+        r = client.post(
+            endpoint,
+            json={
+                "area_type": "regions",
+                "indicator": params.INDICATOR,
+                "all_areas": True,
+            },
+            headers=headers,
+        )
+        assert r.status_code == 400
+        response_msg = self.get_content(r)
+        assert "parameter is needed" in response_msg
+
+        # check not existing area
+        fake_area = faker.pystr()
+        r = client.post(
+            endpoint,
+            json={**data, "area_ids": [params.REGION_ID, fake_area]},
+            headers=headers,
+        )
+        assert r.status_code == 404
+        response_msg = self.get_content(r)
+        assert fake_area.lower() in response_msg
+
+        # submit the batch
+        r = client.post(
+            endpoint,
+            json={**data, "area_ids": [params.REGION_ID], "outputs": ["map"]},
+            headers=headers,
+        )
+        assert r.status_code == 202
+        task_id = self.get_content(r)
+        assert isinstance(task_id, str)
+
+        # check a task request has been created
+        db = sqlalchemy.get_instance()
+        db_request = db.Request.query.filter_by(task_id=task_id).first()
+        assert db_request is not None
+        assert db_request.name == "batch"
+        assert db_request.args["area_ids"] == [params.REGION_ID.lower()]
+
+        # teardown test request
+        r = client.delete(f"{API_URI}/requests/{db_request.id}", headers=headers)
+        assert r.status_code == 200
+
+    def test_batch_quota(self, app: Flask) -> None:
+        db = sqlalchemy.get_instance()
+        user = db.User.query.filter_by(email=BaseAuthentication.default_user).first()
+        args = {
+            "area_type": "regions",
+            "area_ids": [params.REGION_ID.lower()],
+            "outputs": ["map", "report"],
+            "indicator": params.INDICATOR,
+            "model_id": params.MODEL_ID,
+        }
+        request = db.Request(
+            name="batch",
+            dataset_name=params.DATASET_ID,
+            args={"product_id": params.PRODUCT_ID, **args},
+            user_id=user.id,
+            status="CREATED",
+        )
+        db.session.add(request)
+        quota = user.disk_quota
+        user.disk_quota = 1024
+        db.session.commit()
+        downloads = set(DOWNLOAD_DIR.iterdir()) if DOWNLOAD_DIR.exists() else set()
+
+        # the batch is rejected before creating any output
+        try:
+            with pytest.raises(Ignore, match="Disk quota exceeded"):
+                self.send_task(
+                    app,
+                    "batch_crop",
+                    user.id,
+                    params.DATASET_ID,
+                    params.PRODUCT_ID,
+                    args,
+                    request.id,
+                )
+        finally:
+            user.disk_quota = quota
+            db.session.commit()
+        db.session.refresh(request)
+        assert request.status == "FAILURE"
+        assert "Disk quota exceeded" in request.error_message
+        assert request.output_file is None
+        if DOWNLOAD_DIR.exists():
+            assert set(DOWNLOAD_DIR.iterdir()) == downloads
+
+        db.session.delete(request)
+        db.session.commit()
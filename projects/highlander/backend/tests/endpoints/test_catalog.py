@@ -0,0 +1,63 @@
+import os
+from pathlib import Path
+from typing import Any, Dict
+
+import pytest
+import yaml
+from highlander.catalog import CatalogExt
+from restapi.tests import BaseTests
+
+
+def write_dataset(path: Path, dataset_id: str, label: str) -> None:
+    metadata: Dict[str, Any] = {
+        "id": dataset_id,
+        "label": label,
+        "default": "product",
+        "products": [{"id": "product"}],
+    }
+    path.write_text(yaml.safe_dump({"metadata": metadata}))
+
+
+class TestApp(BaseTests):
+    def test_catalog_ext(self, tmp_path: Path) -> None:
+        first = tmp_path.joinpath("first.yaml")
+        second = tmp_path.joinpath("second.yaml")
+        write_dataset(first, "first", "First")
+        write_dataset(second, "second", "Second")
+        catalog_path = tmp_path.joinpath("catalog-ext.yaml")
+        catalog_path.write_text(
+            yaml.safe_dump(
+                {
+                    "sources": {
+                        "first": {"path": str(first)},
+                        "second": {"path": str(second)},
+                    }
+                }
+            )
+        )
+        catalog = CatalogExt(str(catalog_path))
+
+        # the catalog is parsed once
+        datasets, index = catalog.load()
+        assert [d["id"] for d in datasets] == ["first", "second"]
+        assert catalog.load()[0] is datasets
+        assert catalog.load()[1] is index
+        # the callers get a copy of the list
+        assert catalog.get_datasets() == datasets
+        assert catalog.get_datasets() is not datasets
+
+        # the datasets are indexed by id
+        assert catalog.get_dataset("second") is index["second"]
+        assert catalog.get_dataset("missing") is None
+        assert catalog.get_dataset_content_filename("first", "label") == "First"
+        with pytest.raises(LookupError):
+            catalog.get_dataset_content_filename("missing", "label")
+
+        # the catalog is reloaded when a dataset file changes
+        write_dataset(second, "second", "Updated")
+        mtime = second.stat().st_mtime + 10
+        os.utime(second, (mtime, mtime))
+        reloaded, _ = catalog.load()
+        assert reloaded is not datasets
+        assert catalog.get_dataset("second")["label"] == "Updated"
+        assert catalog.get_dataset_content_filename("second", "label") == "Updated"
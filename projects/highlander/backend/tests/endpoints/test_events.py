@@ -0,0 +1,48 @@
+import json
+
+from highlander.notifications import publish_status
+from restapi.connectors import sqlalchemy
+from restapi.services.authentication import BaseAuthentication
+from restapi.tests import API_URI, BaseTests, FlaskClient
+
+
+class FakeRequest:
+    id = 1
+    task_id = "fake-task-id"
+    status = "STARTED"
+    end_date = None
+    error_message = None
+
+
+class TestApp(BaseTests):
+    def test_requests_events(self, client: FlaskClient) -> None:
+        endpoint = f"{API_URI}/events/requests"
+
+        # test without login
+        r = client.get(endpoint)
+        assert r.status_code == 401
+
+        headers, token = self.do_login(client, None, None)
+        r = client.get(endpoint, headers=headers, buffered=False)
+        assert r.status_code == 200
+        assert r.mimetype == "text/event-stream"
+        stream = iter(r.response)
+        # the reconnection delay is sent once subscribed
+        assert next(stream).decode().startswith("retry: ")
+
+        # the state transitions of the user requests are streamed
+        db = sqlalchemy.get_instance()
+        user = db.User.query.filter_by(email=BaseAuthentication.default_user).first()
+        publish_status(user.id, FakeRequest(), progress="extracting data")
+        event = next(stream).decode()
+        assert event.startswith("event: request\ndata: ")
+        data = json.loads(event.split("data: ")[1])
+        assert data["id"] == FakeRequest.id
+        assert data["status"] == FakeRequest.status
+        assert data["progress"] == "extracting data"
+        r.close()
+
+        # the access token can be passed as parameter (EventSource can't set headers)
+        r = client.get(f"{endpoint}?access_token={token}", buffered=False)
+        assert r.status_code == 200
+        r.close()
@@ -1,3 +1,4 @@
+import gzip
 import json
 
 from faker import Faker
@@ -24,3 +25,38 @@ def test_geojson(self, client: FlaskClient, faker: Faker) -> None:
         # check the file is a correct json
         retrieved_file = self.get_content(r)
         assert type(retrieved_file) == dict
+
+    def test_geojson_encodings(self, client: FlaskClient) -> None:
+        endpoint = f"{API_URI}/geojson/{GEOJSON_FILENAME}"
+
+        # retrieve the gzip encoding of the file
+        r = client.get(endpoint, headers={"Accept-Encoding": "gzip"})
+        assert r.status_code == 200
+        assert r.headers["Content-Encoding"] == "gzip"
+        assert "Accept-Encoding" in r.headers["Vary"]
+        assert "max-age" in r.headers["Cache-Control"]
+        content = json.loads(gzip.decompress(r.data))
+        assert type(content) == dict
+
+        # the file is not sent again if not modified
+        etag = r.headers["ETag"]
+        r = client.get(
+            endpoint, headers={"Accept-Encoding": "gzip", "If-None-Match": etag}
+        )
+        assert r.status_code == 304
+
+        # the identity encoding has its own validator
+        r = client.get(endpoint, headers={"Accept-Encoding": "identity"})
+        assert r.status_code == 200
+        assert "Content-Encoding" not in r.headers
+        assert r.headers["ETag"] != etag
+
+        # retrieve the simplified geometries
+        r = client.get(f"{endpoint}?detail=low", headers={"Accept-Encoding": "gzip"})
+        assert r.status_code == 200
+        simplified = json.loads(gzip.decompress(r.data))
+        assert len(simplified["features"]) == len(content["features"])
+
+        # invalid level of detail
+        r = client.get(f"{endpoint}?detail=ultra")
+        assert r.status_code == 400
@@ -1,11 +1,16 @@
+from datetime import datetime, timedelta
 from pathlib import Path
-from typing import Optional
+from typing import Any, Optional
 
+import pytest
 from faker import Faker
+from flask import Flask
 from highlander.connectors import broker
-from highlander.endpoints.utils import MapCropConfig
+from highlander.crop_manifest import evict_outputs
+from highlander.endpoints.utils import CropEngine, MapCropConfig
 from highlander.tests import TestParams as params
 from highlander.tests import invalidate_dataset_cache
+from restapi.connectors import sqlalchemy
 from restapi.tests import API_URI, BaseTests, FlaskClient
 from restapi.utilities.logs import log
 
@@ -13,6 +18,39 @@
 
 
 class TestApp(BaseTests):
+    def test_map_crop_config(self, tmp_path: Path) -> None:
+        settings = MapCropConfig.settings()
+        # the config is loaded only once
+        assert MapCropConfig.settings() is settings
+        # templates are compiled with their fields
+        source_file = settings.get_source_file(
+            params.DATASET_ID2,
+            "daily",
+            {
+                "indicator": params.INDICATOR_HW,
+                "year": "2020",
+                "daily_metric": "daymax",
+            },
+        )
+        assert source_file.endswith(
+            f"{params.INDICATOR_HW}_2020_daymax_VHR-REA_regular.nc"
+        )
+        assert "year" in settings.get_mandatory_params(params.DATASET_ID2, "daily")
+        assert "year" not in settings.get_mandatory_params(
+            params.DATASET_ID2, params.PRODUCT_ID_HW
+        )
+
+        # invalid configs are refused
+        invalid_config = tmp_path.joinpath("map_crop.yaml")
+        invalid_config.write_text("variables: {}\n")
+        with pytest.raises(ValueError):
+            MapCropConfig.load_settings(invalid_config)
+        invalid_config.write_text(
+            MapCropConfig.SETTINGS_PATH.read_text().replace("viridis_r", "not_a_cmap")
+        )
+        with pytest.raises(ValueError):
+            MapCropConfig.load_settings(invalid_config)
+
     def test_map_crop_validation_on_query_params(
         self, client: FlaskClient, faker: Faker
     ) -> None:
@@ -132,6 +170,11 @@ def test_map_crop_get_a_map(self, client: FlaskClient, faker: Faker) -> None:
         assert r.status_code == 200
         assert region_output_file.stat().st_mtime == file_creation_time
 
+        # check the timing header is sent when requested
+        r = client.get(endpoint, headers={**self.get("auth_header"), "X-Timing": "1"})
+        assert r.status_code == 200
+        assert "dataset_details;dur=" in r.headers["Server-Timing"]
+
         # crop a province on human wellbeing dataset
         query_params = f"indicator={params.INDICATOR_HW}&daily_metric={params.DAILY_METRIC}&area_type=provinces&area_id={params.PROVINCE_ID}&type=map"
         endpoint = f"{API_URI}/datasets/{params.DATASET_ID2}/products/{params.PRODUCT_ID_HW}/crop?{query_params}"
@@ -161,6 +204,296 @@ def test_map_crop_get_a_map(self, client: FlaskClient, faker: Faker) -> None:
         region_output_file.unlink()
         province_output_file.unlink()
 
+    def test_map_crop_render_options(self, client: FlaskClient) -> None:
+        query_params = f"indicator={params.INDICATOR}&model_id={params.MODEL_ID}&area_type=regions&area_id={params.REGION_ID}&type=map"
+        endpoint = f"{API_URI}/datasets/{params.DATASET_ID}/products/{params.PRODUCT_ID}/crop?{query_params}"
+        output_dir = Path(
+            MapCropConfig.CROPS_OUTPUT_ROOT,
+            params.DATASET_ID,
+            params.PRODUCT_ID,
+            params.MODEL_ID,
+            "regions",
+        )
+        region_name = params.REGION_ID.lower().replace(" ", "_")
+
+        # invalid resolution
+        r = client.get(f"{endpoint}&resolution=poster", headers=self.get("auth_header"))
+        assert r.status_code == 400
+
+        # each render is cached in its own file
+        renders = {
+            "resolution=thumbnail&plot_format=webp": (
+                f"{region_name}_map_thumbnail.webp",
+                "image/webp",
+            ),
+            "resolution=thumbnail&plot_format=png8": (
+                f"{region_name}_map_thumbnail_png8.png",
+                "image/png",
+            ),
+            "resolution=print": (f"{region_name}_map_print.png", "image/png"),
+        }
+        sizes = {}
+        for options, (filename, mimetype) in renders.items():
+            r = client.get(f"{endpoint}&{options}", headers=self.get("auth_header"))
+            assert r.status_code == 200
+            assert r.mimetype == mimetype
+            output_file = output_dir.joinpath(filename)
+            assert output_file.is_file()
+            sizes[options] = output_file.stat().st_size
+
+        # the thumbnails are lighter than the print images
+        assert (
+            sizes["resolution=thumbnail&plot_format=webp"] < sizes["resolution=print"]
+        )
+        assert (
+            sizes["resolution=thumbnail&plot_format=png8"] < sizes["resolution=print"]
+        )
+
+        for filename, _ in renders.values():
+            output_dir.joinpath(filename).unlink()
+
+    def test_map_crop_manifest(self, client: FlaskClient, app: Flask) -> None:
+        query_params = f"indicator={params.INDICATOR}&model_id={params.MODEL_ID}&area_type=regions&area_id={params.REGION_ID}&type=map"
+        endpoint = f"{API_URI}/datasets/{params.DATASET_ID}/products/{params.PRODUCT_ID}/crop?{query_params}"
+        r = client.get(endpoint, headers=self.get("auth_header"))
+        assert r.status_code == 200
+        output_file = Path(
+            MapCropConfig.CROPS_OUTPUT_ROOT,
+            params.DATASET_ID,
+            params.PRODUCT_ID,
+            params.MODEL_ID,
+            "regions",
+            f"{params.REGION_ID.lower().replace(' ', '_')}_map.png",
+        )
+
+        # the crop is recorded with its source
+        db = sqlalchemy.get_instance()
+        artifact = db.CropArtifact.query.filter_by(path=str(output_file)).first()
+        assert artifact is not None
+        assert Path(artifact.source_path).is_file()
+
+        # a crop of an outdated source is rendered again
+        artifact.source_mtime = 0
+        db.session.commit()
+        file_creation_time = output_file.stat().st_mtime
+        r = client.get(endpoint, headers=self.get("auth_header"))
+        assert r.status_code == 200
+        assert output_file.stat().st_mtime != file_creation_time
+        db.session.expire_all()
+        artifact = db.CropArtifact.query.filter_by(path=str(output_file)).first()
+        assert artifact.source_mtime == Path(artifact.source_path).stat().st_mtime
+
+        # the stale crops are purged
+        artifact.renderer_version = "0"
+        db.session.commit()
+        result = self.send_task(app, "purge_crops")
+        assert result["stale"] >= 1
+        assert not output_file.exists()
+        db.session.expire_all()
+        assert db.CropArtifact.query.filter_by(path=str(output_file)).first() is None
+
+    def test_map_crop_eviction(self, client: FlaskClient) -> None:
+        query_params = f"indicator={params.INDICATOR}&model_id={params.MODEL_ID}&area_type=regions&area_id={params.REGION_ID}&type=map"
+        endpoint = f"{API_URI}/datasets/{params.DATASET_ID}/products/{params.PRODUCT_ID}/crop?{query_params}"
+        r = client.get(endpoint, headers=self.get("auth_header"))
+        assert r.status_code == 200
+        output_file = Path(
+            MapCropConfig.CROPS_OUTPUT_ROOT,
+            params.DATASET_ID,
+            params.PRODUCT_ID,
+            params.MODEL_ID,
+            "regions",
+            f"{params.REGION_ID.lower().replace(' ', '_')}_map.png",
+        )
+
+        # the crop is recorded with its dataset, size and access
+        db = sqlalchemy.get_instance()
+        artifact = db.CropArtifact.query.filter_by(path=str(output_file)).first()
+        assert artifact.dataset_id == params.DATASET_ID
+        assert artifact.size == output_file.stat().st_size
+        assert artifact.last_access is not None
+
+        # the served crop is marked as accessed
+        artifact.last_access = datetime.utcnow() - timedelta(days=1)
+        db.session.commit()
+        r = client.get(endpoint, headers=self.get("auth_header"))
+        assert r.status_code == 200
+        db.session.expire_all()
+        artifact = db.CropArtifact.query.filter_by(path=str(output_file)).first()
+        assert artifact.last_access > datetime.utcnow() - timedelta(hours=1)
+
+        # within the budget nothing is evicted
+        assert evict_outputs(artifact.size, {}) == 0
+        assert output_file.is_file()
+
+        # the crops of a dataset over its quota are evicted
+        assert evict_outputs(0, {params.DATASET_ID: 1}) >= 1
+        assert not output_file.exists()
+        db.session.expire_all()
+        assert db.CropArtifact.query.filter_by(path=str(output_file)).first() is None
+
+    def test_map_crop_shared_data(self, client: FlaskClient) -> None:
+        query_params = f"indicator={params.INDICATOR}&model_id={params.MODEL_ID}&area_type=provinces&area_id={params.PROVINCE_ID}"
+        endpoint = f"{API_URI}/datasets/{params.DATASET_ID}/products/{params.PRODUCT_ID}/crop?{query_params}"
+        r = client.get(f"{endpoint}&type=map", headers=self.get("auth_header"))
+        assert r.status_code == 200
+        output_dir = Path(
+            MapCropConfig.CROPS_OUTPUT_ROOT,
+            params.DATASET_ID,
+            params.PRODUCT_ID,
+            params.MODEL_ID,
+            "provinces",
+        )
+        # the cropped data are cached with the map
+        cropped_file = output_dir.joinpath(
+            MapCropConfig.getCroppedFilename(params.PROVINCE_ID)
+        )
+        assert cropped_file.is_file()
+        db = sqlalchemy.get_instance()
+        assert db.CropArtifact.query.filter_by(path=str(cropped_file)).first()
+        file_creation_time = cropped_file.stat().st_mtime
+
+        # and reused by the plots of the area
+        r = client.get(
+            f"{endpoint}&type=plot&plot_type=distribution",
+            headers=self.get("auth_header"),
+        )
+        assert r.status_code == 200
+        r = client.get(
+            f"{endpoint}&type=plot&plot_format=json", headers=self.get("auth_header")
+        )
+        assert r.status_code == 200
+        assert isinstance(self.get_content(r), dict)
+        assert cropped_file.stat().st_mtime == file_creation_time
+
+        for output_file in output_dir.iterdir():
+            output_file.unlink()
+
+    def test_map_crop_days(
+        self, client: FlaskClient, monkeypatch: pytest.MonkeyPatch
+    ) -> None:
+        base_params = f"indicator={params.INDICATOR_HW}&daily_metric={params.DAILY_METRIC}&area_type=regions&area_id={params.REGION_ID}&year=2020"
+        endpoint = f"{API_URI}/datasets/{params.DATASET_ID2}/products/daily/crop/days"
+
+        # the days have to be in the requested year and in order
+        for days in [
+            "start_date=2020-12-30&end_date=2021-01-02",
+            "start_date=2020-01-05&end_date=2020-01-01",
+            "start_date=2020-01-01&end_date=2020-03-01",
+        ]:
+            r = client.get(
+                f"{endpoint}?{base_params}&{days}", headers=self.get("auth_header")
+            )
+            assert r.status_code == 400
+
+        # only the daily products have days
+        r = client.get(
+            f"{API_URI}/datasets/{params.DATASET_ID2}/products/{params.PRODUCT_ID_HW}/crop/days?{base_params}&start_date=2020-01-01&end_date=2020-01-03",
+            headers=self.get("auth_header"),
+        )
+        assert r.status_code == 400
+
+        r = client.get(
+            f"{endpoint}?{base_params}&start_date=2020-07-01&end_date=2020-07-03",
+            headers=self.get("auth_header"),
+        )
+        assert r.status_code == 200
+        response_body = self.get_content(r)
+        assert isinstance(response_body, list)
+        assert [d["date"] for d in response_body] == [
+            "2020-07-01",
+            "2020-07-02",
+            "2020-07-03",
+        ]
+        for day in response_body:
+            assert day["min"] <= day["mean"] <= day["max"]
+
+        # the days already cropped and plotted are not read again
+        def fail_crop(*args: Any, **kwargs: Any) -> None:
+            raise AssertionError("the days are cropped again")
+
+        with monkeypatch.context() as m:
+            m.setattr(CropEngine, "cropDataDays", fail_crop)
+            r = client.get(
+                f"{endpoint}?{base_params}&start_date=2020-07-01&end_date=2020-07-03",
+                headers=self.get("auth_header"),
+            )
+        assert r.status_code == 200
+        assert self.get_content(r) == response_body
+
+        # the missing outputs are plotted from the stored cropped data
+        first_map = Path(
+            MapCropConfig.CROPS_OUTPUT_ROOT,
+            params.DATASET_ID2,
+            "daily",
+            params.INDICATOR_HW,
+            "2020",
+            "2020-07-01",
+            "regions",
+            f"{params.REGION_ID.lower().replace(' ', '_')}_map.png",
+        )
+        first_map.unlink()
+        with monkeypatch.context() as m:
+            m.setattr(CropEngine, "cropDataDays", fail_crop)
+            r = client.get(
+                f"{endpoint}?{base_params}&start_date=2020-07-01&end_date=2020-07-03",
+                headers=self.get("auth_header"),
+            )
+        assert r.status_code == 200
+        assert self.get_content(r) == response_body
+        assert first_map.is_file()
+
+        # the maps of the days are served by the crop endpoint from the cache
+        db = sqlalchemy.get_instance()
+        output_files = []
+        for day in response_body:
+            output_file = Path(
+                MapCropConfig.CROPS_OUTPUT_ROOT,
+                params.DATASET_ID2,
+                "daily",
+                params.INDICATOR_HW,
+                "2020",
+                day["date"],
+                "regions",
+                f"{params.REGION_ID.lower().replace(' ', '_')}_map.png",
+            )
+            assert output_file.is_file()
+            output_files.append(output_file)
+            # with the cropped data, shared with the other outputs of the day
+            cropped_file = output_file.with_name(
+                MapCropConfig.getCroppedFilename(params.REGION_ID)
+            )
+            assert cropped_file.is_file()
+            assert db.CropArtifact.query.filter_by(path=str(cropped_file)).first()
+            output_files.append(cropped_file)
+        # output_files[2:4] are the map and the cropped data of the second day
+        file_creation_time = output_files[2].stat().st_mtime
+        query_params = f"{base_params}&date=2020-07-02&type=map"
+        r = client.get(
+            f"{API_URI}/datasets/{params.DATASET_ID2}/products/daily/crop?{query_params}",
+            headers=self.get("auth_header"),
+        )
+        assert r.status_code == 200
+        assert output_files[2].stat().st_mtime == file_creation_time
+
+        # the plots of the day are created from the cached cropped data
+        cropped_creation_time = output_files[3].stat().st_mtime
+        query_params = f"{base_params}&date=2020-07-02&type=plot&plot_format=json"
+        r = client.get(
+            f"{API_URI}/datasets/{params.DATASET_ID2}/products/daily/crop?{query_params}",
+            headers=self.get("auth_header"),
+        )
+        assert r.status_code == 200
+        assert output_files[3].stat().st_mtime == cropped_creation_time
+        output_files.append(
+            output_files[2].with_name(
+                f"{params.REGION_ID.lower().replace(' ', '_')}.json"
+            )
+        )
+
+        for output_file in output_files:
+            output_file.unlink()
+
     def test_map_crop_get_a_plot(self, client: FlaskClient, faker: Faker) -> None:
         # get a json plot
         query_params = f"indicator={params.INDICATOR}&model_id={params.MODEL_ID}&area_type=regions&area_id={params.REGION_ID}&type=plot&plot_format=json"
@@ -198,7 +531,8 @@ def test_map_crop_get_a_plot(self, client: FlaskClient, faker: Faker) -> None:
             params.MODEL_ID,
             "regions",
         )
-        assert len([f for f in output_dir.iterdir()]) == 1
+        # a single json for both the plot types (next to the cropped data)
+        assert len([f for f in output_dir.iterdir() if f.suffix == ".json"]) == 1
 
         # check the file is not recreated again the second time
         assert region_json_output_file.stat().st_mtime == file_creation_time
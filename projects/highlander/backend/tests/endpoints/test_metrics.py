@@ -0,0 +1,30 @@
+from restapi.tests import API_URI, BaseTests, FlaskClient
+
+
+class TestApp(BaseTests):
+    def test_metrics(self, client: FlaskClient) -> None:
+        endpoint = f"{API_URI}/admin/metrics"
+
+        # test without login
+        r = client.get(endpoint)
+        assert r.status_code == 401
+
+        # test admin user
+        headers, _ = self.do_login(client, None, None)
+        r = client.get(endpoint, headers=headers)
+        assert r.status_code == 200
+        assert r.headers["Content-Type"].startswith("text/plain")
+        assert "highlander_pipeline_stage_seconds" in r.data.decode("utf-8")
+
+    def test_invalid_request_labels(self, client: FlaskClient) -> None:
+        headers, _ = self.do_login(client, None, None)
+
+        # the ids of the invalid requests are not used as labels
+        query_params = "indicator=tas&area_type=regions&area_id=lazio&type=map"
+        endpoint = f"{API_URI}/datasets/made-up-dataset/products/made-up-product/crop?{query_params}"
+        r = client.get(endpoint, headers=headers)
+        assert r.status_code == 404
+
+        r = client.get(f"{API_URI}/admin/metrics", headers=headers)
+        assert r.status_code == 200
+        assert "made-up-dataset" not in r.data.decode("utf-8")
@@ -1,8 +1,11 @@
 import shutil
 from pathlib import Path
 
+import pytest
 from faker import Faker
-from highlander.endpoints.utils import MapCropConfig
+from highlander import crop_manifest
+from highlander.crop_manifest import purge_outputs
+from highlander.endpoints.utils import MapCropConfig, PlotUtils
 from highlander.endpoints.utils import MapCropConfig as config
 from highlander.tests import TestParams as params
 from restapi.tests import API_URI, BaseTests, FlaskClient
@@ -34,17 +37,18 @@ def test_not_found_cases(self, client: FlaskClient, faker: Faker) -> None:
         assert response_msg == f"dataset {fake_dataset} not found"
 
         # check if dataset not present in output structure map
-        original_map = config.OUTPUT_STRUCTURE_MAP
+        settings = config.settings()
+        original_map = settings.output_structure
         # create a fake map without the desired dataset
         fake_map = {**original_map}
         fake_map.pop(params.DATASET_ID)
         # replace the map
-        config.OUTPUT_STRUCTURE_MAP = fake_map
+        settings.output_structure = fake_map
         endpoint = f"{API_URI}/datasets/{params.DATASET_ID}/products/{params.PRODUCT_ID}/report?{query_params}"
         r = client.get(endpoint, headers=headers)
         assert r.status_code == 500
         # restore the original map
-        config.OUTPUT_STRUCTURE_MAP = original_map
+        settings.output_structure = original_map
 
         # check if there are missing parameters
         incomplete_query_params = f"area_type=regions&area_id={params.REGION_ID}"
@@ -54,45 +58,45 @@ def test_not_found_cases(self, client: FlaskClient, faker: Faker) -> None:
         response_msg = self.get_content(r)
         assert "parameter is needed" in response_msg
 
-        # check not existing map
+        # check not existing map without the parameters to create it
         r = client.get(endpoint, headers=headers)
         assert r.status_code == 404
         response_msg = self.get_content(r)
         assert (
             response_msg
-            == "Map file for requested report not found: Please use /crop api to create it"
+            == "Map file for requested report not found: the indicator parameter is needed to create it"
         )
 
-        # create the map
-        mapcrop_query_params = f"indicator={params.INDICATOR}&model_id={params.MODEL_ID}&area_type=regions&area_id={params.REGION_ID}&type=map"
-        mapcrop_endpoint = f"{API_URI}/datasets/{params.DATASET_ID}/products/{params.PRODUCT_ID}/crop?{mapcrop_query_params}"
-        r = client.get(mapcrop_endpoint, headers=headers)
+        # the missing map and plot are created on demand
+        r = client.get(f"{endpoint}&indicator={params.INDICATOR}", headers=headers)
         assert r.status_code == 200
-        map_filename = f"{params.REGION_ID.lower().replace(' ', '_').lower()}_map.png"
-        map_output_file = Path(
+        assert r.mimetype == "application/pdf"
+        output_dir = Path(
             MapCropConfig.CROPS_OUTPUT_ROOT,
             params.DATASET_ID,
             params.PRODUCT_ID,
             params.MODEL_ID,
             "regions",
-            map_filename,
         )
+        map_filename = f"{params.REGION_ID.lower().replace(' ', '_').lower()}_map.png"
+        map_output_file = Path(output_dir, map_filename)
         assert map_output_file.is_file()
-
-        self.save("map_filepath", map_output_file)
-
-        # check not existing plot
-        r = client.get(endpoint, headers=headers)
-        assert r.status_code == 404
-        response_msg = self.get_content(r)
-        assert (
-            response_msg
-            == "Plot file for requested report not found: Please use /crop api to create it"
+        plot_filename = (
+            f"{params.REGION_ID.lower().replace(' ', '_').lower()}_distribution.png"
         )
+        assert Path(output_dir, plot_filename).is_file()
+        # the report is cached
+        reports = list(output_dir.glob("*_report_*.pdf"))
+        assert len(reports) == 1
+        r = client.get(endpoint, headers=headers)
+        assert r.status_code == 200
+        assert list(output_dir.glob("*_report_*.pdf")) == reports
 
-        # check not existing plot for stripes
+        self.save("map_filepath", map_output_file)
 
-    def test_get_report(self, client: FlaskClient, faker: Faker) -> None:
+    def test_get_report(
+        self, client: FlaskClient, faker: Faker, monkeypatch: pytest.MonkeyPatch
+    ) -> None:
 
         headers = self.get("auth_header")
         map_output_file = self.get("map_filepath")
@@ -179,7 +183,20 @@ def test_get_report(self, client: FlaskClient, faker: Faker) -> None:
         response_body = r.get_data().decode("latin-1")
         assert type(response_body) == str
 
+        # the replaced reports are removed by the purge
+        latest_report = max(
+            map_output_file.parent.glob("*_report_*.pdf"),
+            key=lambda p: p.stat().st_mtime,
+        )
+        monkeypatch.setattr(crop_manifest, "UNTRACKED_GRACE_PERIOD", 0)
+        purge_outputs([map_output_file.parent], PlotUtils.getLegendLevels)
+        assert list(map_output_file.parent.glob("*_report_*.pdf")) == [latest_report]
+
         # remove the created elements
+        for report_file in map_output_file.parent.glob("*_report_*.pdf"):
+            report_file.unlink()
+        for report_file in mapstripes_output_dir.glob("*_report_*.pdf"):
+            report_file.unlink()
         map_output_file.unlink()
         plot_output_file.unlink()
         mapstripes_output_file.unlink()
@@ -1,17 +1,71 @@
 import json
-from typing import Any, Dict, Iterator, Optional
+import os
+import re
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Any, Dict, Iterator, Optional, Tuple
 
+import numpy as np
+import pandas as pd
 import pytest
+import xarray as xr
+from celery.exceptions import Retry
 from celery.result import AsyncResult
+from flask import Flask
+from highlander.cancellation import cancellation_key
+from highlander.constants import DOWNLOAD_DIR
+from highlander.endpoints import requests as requests_endpoint
+from highlander.endpoints.requests import get_filename_options, send_output_file
+from highlander.exceptions import RequestCancelled
 from highlander.models.sqlalchemy import Request
+from highlander.point_series import ProductIndex
+from highlander.retention import EXPIRED, OUTPUT_RETENTION_DAYS
+from highlander.scheduling import MAX_RUNNING_REQUESTS_PER_USER, start_request
+from highlander.tasks.data_extraction import retrieve_by_year
 from highlander.tests import TestParams as params
-from restapi.connectors import sqlalchemy
+from highlander.usage import update_used_bytes
+from restapi.connectors import redis, sqlalchemy
+from restapi.services.authentication import BaseAuthentication
 from restapi.tests import API_URI, BaseTests, FlaskClient
+from werkzeug.datastructures import Headers
 
 __author__ = "Giuseppe Trotta (g.trotta@cineca.it)"
 PRODUCT_FORMAT = "netcdf"
 
 
+def create_output_file(
+    content: bytes, end_date: Optional[datetime] = None
+) -> Tuple[Request, Path]:
+    """create a completed request of the default user with its output file"""
+    db = sqlalchemy.get_instance()
+    user = db.User.query.filter_by(email=BaseAuthentication.default_user).first()
+    request = db.Request(
+        name="test",
+        dataset_name=params.DATASET_VHR,
+        args={},
+        user_id=user.id,
+        status="SUCCESS",
+        end_date=end_date or datetime.utcnow(),
+    )
+    db.session.add(request)
+    db.session.commit()
+    timestamp = datetime.utcnow().strftime("%Y%m%dT%H%M%S%f")
+    output_path = DOWNLOAD_DIR.joinpath(timestamp, "test.nc")
+    output_path.parent.mkdir(parents=True)
+    output_path.write_bytes(content)
+    db.session.add(
+        db.OutputFile(
+            request_id=request.id,
+            filename=output_path.name,
+            timestamp=timestamp,
+            size=len(content),
+        )
+    )
+    update_used_bytes(db, user.id, len(content))
+    db.session.commit()
+    return request, output_path
+
+
 class TestApp(BaseTests):
     def test_get_user_requests(self, client: FlaskClient) -> None:
         endpoint = f"{API_URI}/requests"
@@ -30,13 +84,230 @@ def test_get_user_requests(self, client: FlaskClient) -> None:
         response_body = self.get_content(r)
         assert isinstance(response_body, list)
 
+        # test the total count
+        r = client.get(f"{endpoint}?get_total=true", headers=headers)
+        assert r.status_code == 200
+        assert self.get_content(r)["total"] >= len(response_body)
+
+        # test the listing without the request args
+        r = client.get(f"{endpoint}?with_args=false", headers=headers)
+        assert r.status_code == 200
+        for item in self.get_content(r):
+            assert "args" not in item
+
+        # test an invalid cursor
+        r = client.get(f"{endpoint}?cursor=invalid", headers=headers)
+        assert r.status_code == 400
+
+    def test_requests_pagination(
+        self,
+        client: FlaskClient,
+        data_filter: Dict[str, Any],
+        headers: Optional[Dict[str, str]],
+    ) -> None:
+        endpoint = f"{API_URI}/requests"
+        # submit two requests
+        for _ in range(2):
+            r = client.post(
+                f"{endpoint}/{params.DATASET_VHR}", json=data_filter, headers=headers
+            )
+            assert r.status_code == 202
+
+        r = client.get(f"{endpoint}?get_total=true", headers=headers)
+        total = self.get_content(r)["total"]
+        assert total >= 2
+
+        # browse the requests a page at a time following the cursor
+        r = client.get(f"{endpoint}?size=1", headers=headers)
+        assert r.status_code == 200
+        first_page = self.get_content(r)
+        assert len(first_page) == 1
+        cursor = r.headers["X-Next-Cursor"]
+        r = client.get(f"{endpoint}?size=1&cursor={cursor}", headers=headers)
+        assert r.status_code == 200
+        second_page = self.get_content(r)
+        assert len(second_page) == 1
+        assert second_page[0]["id"] != first_page[0]["id"]
+        assert second_page[0]["submission_date"] <= first_page[0]["submission_date"]
+
+        # remove the requests
+        for item in first_page + second_page:
+            r = client.delete(f"{endpoint}/{item['id']}", headers=headers)
+            assert r.status_code == 200
+        # the cached count is invalidated
+        r = client.get(f"{endpoint}?get_total=true", headers=headers)
+        assert self.get_content(r)["total"] == total - 2
+
+    def test_cancel_request(
+        self,
+        client: FlaskClient,
+        data_filter: Dict[str, Any],
+        headers: Optional[Dict[str, str]],
+    ) -> None:
+        endpoint = f"{API_URI}/requests"
+        r = client.post(
+            f"{endpoint}/{params.DATASET_VHR}", json=data_filter, headers=headers
+        )
+        assert r.status_code == 202
+        db = sqlalchemy.get_instance()
+        db_request = db.Request.query.filter_by(task_id=self.get_content(r)).first()
+        assert db_request is not None
+
+        # check not existing request
+        r = client.post(f"{endpoint}/0/cancel", headers=headers)
+        assert r.status_code == 404
+
+        r = client.post(f"{endpoint}/{db_request.id}/cancel", headers=headers)
+        # the extraction can be already completed
+        assert r.status_code in (200, 400)
+        if r.status_code == 200:
+            db.session.refresh(db_request)
+            assert db_request.status == "REVOKED"
+            # a cancelled request can't be cancelled again
+            r = client.post(f"{endpoint}/{db_request.id}/cancel", headers=headers)
+            assert r.status_code == 400
+
+        r = client.delete(f"{endpoint}/{db_request.id}", headers=headers)
+        assert r.status_code == 200
+
+    def test_output_formats(
+        self,
+        client: FlaskClient,
+        data_filter: Dict[str, Any],
+        headers: Optional[Dict[str, str]],
+    ) -> None:
+        endpoint = f"{API_URI}/estimate-size/{params.DATASET_VHR}"
+
+        # test an unknown format
+        r = client.post(
+            endpoint, json={**data_filter, "format": "pickle"}, headers=headers
+        )
+        assert r.status_code == 400
+
+        # csv is available only for a location
+        r = client.post(
+            endpoint, json={**data_filter, "format": "csv"}, headers=headers
+        )
+        assert r.status_code == 400
+
+        # the estimate of a zipped zarr output
+        r = client.post(
+            endpoint, json={**data_filter, "format": "zarr"}, headers=headers
+        )
+        assert r.status_code == 200
+        assert isinstance(self.get_content(r), int)
+
+    def test_outputs_retention(
+        self, client: FlaskClient, app: Flask, headers: Optional[Dict[str, str]]
+    ) -> None:
+        r = client.get(f"{API_URI}/usage", headers=headers)
+        used = self.get_content(r)["used"]
+
+        # an output older than the retention
+        end_date = datetime.utcnow() - timedelta(days=OUTPUT_RETENTION_DAYS + 1)
+        request, output_path = create_output_file(os.urandom(1024), end_date)
+        r = client.get(f"{API_URI}/usage", headers=headers)
+        assert self.get_content(r)["used"] == used + 1024
+
+        result = self.send_task(app, "apply_retention")
+        assert result["expired"] >= 1
+
+        db = sqlalchemy.get_instance()
+        db.session.expire_all()
+        request = db.Request.query.get(request.id)
+        assert request.status == EXPIRED
+        assert request.output_file is None
+        assert not output_path.exists()
+        r = client.get(f"{API_URI}/usage", headers=headers)
+        assert self.get_content(r)["used"] == used
+
+        r = client.delete(f"{API_URI}/requests/{request.id}", headers=headers)
+        assert r.status_code == 200
+
+    def test_request_validation(
+        self,
+        client: FlaskClient,
+        data_filter: Dict[str, Any],
+        headers: Optional[Dict[str, str]],
+    ) -> None:
+        endpoint = f"{API_URI}/estimate-size"
+
+        r = client.post(f"{endpoint}/unknown", json=data_filter, headers=headers)
+        assert r.status_code == 404
+        data = {**data_filter, "product_type": "unknown"}
+        r = client.post(f"{endpoint}/{params.DATASET_VHR}", json=data, headers=headers)
+        assert r.status_code == 404
+
+        # the requests out of the product coverage are rejected
+        invalid_filters = [
+            {"variable": json.dumps(["unknown"])},
+            {"time": {"year": ["1800"]}},
+            {"time": {"month": ["13"]}},
+            {"location": {"latitude": 0, "longitude": 0}},
+            {"area": {"north": 1, "south": 0, "east": 1, "west": 0}},
+            # the swapped bounds are not sorted into a different area
+            {"area": {"north": 43, "south": 41, "east": 11, "west": 13}},
+        ]
+        for invalid_filter in invalid_filters:
+            data = {**data_filter, **invalid_filter}
+            r = client.post(
+                f"{endpoint}/{params.DATASET_VHR}", json=data, headers=headers
+            )
+            assert r.status_code == 400
+            # the doomed requests are not submitted
+            r = client.post(
+                f"{API_URI}/requests/{params.DATASET_VHR}", json=data, headers=headers
+            )
+            assert r.status_code == 400
+
     def test_get_a_request(self, client: FlaskClient) -> None:
         # TODO
         pass
 
-    def test_download_extracted_data(self, client: FlaskClient) -> None:
-        # TODO
-        pass
+    def test_download_extracted_data(
+        self, client: FlaskClient, headers: Optional[Dict[str, str]]
+    ) -> None:
+        content = os.urandom(1024)
+        request, output_path = create_output_file(content)
+        timestamp = output_path.parent.name
+        output_dir = output_path.parent
+
+        endpoint = f"{API_URI}/download/{timestamp}"
+        # test without login
+        r = client.get(endpoint)
+        assert r.status_code == 401
+
+        r = client.get(endpoint, headers=headers)
+        assert r.status_code == 200
+        assert r.data == content
+        assert r.headers["Accept-Ranges"] == "bytes"
+        etag = r.headers["ETag"]
+
+        # resume the download
+        r = client.get(endpoint, headers={**headers, "Range": "bytes=1000-"})
+        assert r.status_code == 206
+        assert r.data == content[1000:]
+        assert r.headers["Content-Range"] == "bytes 1000-1023/1024"
+
+        # the range is sent only if the file is not changed
+        range_headers = {**headers, "Range": "bytes=1000-", "If-Range": etag}
+        r = client.get(endpoint, headers=range_headers)
+        assert r.status_code == 206
+        range_headers["If-Range"] = '"changed"'
+        r = client.get(endpoint, headers=range_headers)
+        assert r.status_code == 200
+        assert r.data == content
+
+        r = client.get(endpoint, headers={**headers, "If-None-Match": etag})
+        assert r.status_code == 304
+
+        r = client.get(endpoint, headers={**headers, "Range": "bytes=2000-"})
+        assert r.status_code == 416
+
+        # remove the request and its output file
+        r = client.delete(f"{API_URI}/requests/{request.id}", headers=headers)
+        assert r.status_code == 200
+        assert not output_dir.exists()
 
     def test_estimate_size(
         self,
@@ -70,6 +341,160 @@ def test_data_extraction(
         assert result is None
         assert task.state == "SUCCESS"
 
+    def test_location_extraction(
+        self,
+        client: FlaskClient,
+        data_filter: Dict[str, Any],
+        headers: Optional[Dict[str, str]],
+    ) -> None:
+        # the time series at a location, as csv
+        data = {
+            **data_filter,
+            "format": "csv",
+            "location": {"latitude": 41.9, "longitude": 12.5},
+        }
+        r = client.post(
+            f"{API_URI}/requests/{params.DATASET_VHR}", json=data, headers=headers
+        )
+        assert r.status_code == 202
+        task: AsyncResult[Any] = AsyncResult(self.get_content(r))
+        assert task.get(timeout=5) is None
+        assert task.state == "SUCCESS"
+
+        db = sqlalchemy.get_instance()
+        db_request = db.Request.query.filter_by(task_id=task.id).first()
+        # the output is named after the nearest cell by the fast path
+        # (and not by the broker)
+        pattern = r"{}_{}_-?\d+\.\d{{4}}_-?\d+\.\d{{4}}\.csv".format(
+            re.escape(params.DATASET_VHR), re.escape(data_filter["product_type"])
+        )
+        assert re.fullmatch(pattern, db_request.output_file.filename)
+        r = client.delete(f"{API_URI}/requests/{db_request.id}", headers=headers)
+        assert r.status_code == 200
+
+    def test_product_index(self, tmp_path: Path) -> None:
+        files = []
+        for year in (2000, 2001):
+            ds = xr.Dataset(
+                {"tas": (("time", "lat", "lon"), np.zeros((2, 2, 2)))},
+                coords={
+                    "time": pd.date_range(f"{year}-01-01", periods=2),
+                    "lat": [41.0, 42.0],
+                    "lon": [12.0, 13.0],
+                },
+            )
+            path = tmp_path.joinpath(f"tas_{year}.nc")
+            ds.to_netcdf(path)
+            files.append(path)
+
+        def get_signature() -> Tuple[Tuple[str, int], ...]:
+            return tuple((str(f), f.stat().st_mtime_ns) for f in files)
+
+        index = ProductIndex(files, get_signature())
+        assert index.indexed == 2
+        assert index.get_files({2001}) == [files[1]]
+        assert index.nearest_cell(41.9, 12.1) == {"lat": 1, "lon": 0}
+
+        # only the changed files are indexed again
+        mtime = files[1].stat().st_mtime + 10
+        os.utime(files[1], (mtime, mtime))
+        reindexed = ProductIndex(files, get_signature(), index)
+        assert reindexed.indexed == 1
+        assert reindexed.time_ranges == index.time_ranges
+
+    def test_download_filename(self) -> None:
+        # the filenames of the proxied downloads are quoted as by send_file
+        headers = Headers()
+        headers.set(
+            "Content-Disposition",
+            "attachment",
+            **get_filename_options("my output; 2020.nc"),
+        )
+        assert (
+            headers["Content-Disposition"]
+            == 'attachment; filename="my output; 2020.nc"'
+        )
+        assert get_filename_options("città.nc") == {
+            "filename": "citta.nc",
+            "filename*": "UTF-8''citt%C3%A0.nc",
+        }
+
+    def test_accel_redirect(self, app: Flask, monkeypatch: pytest.MonkeyPatch) -> None:
+        monkeypatch.setattr(requests_endpoint, "DOWNLOAD_ACCEL_REDIRECT", "/internal/")
+        output_path = DOWNLOAD_DIR.joinpath("20200101T000000", "my output città.nc")
+        with app.test_request_context():
+            response = send_output_file(output_path)
+        # the internal redirect of the proxy is a quoted uri
+        assert (
+            response.headers["X-Accel-Redirect"]
+            == "/internal/20200101T000000/my%20output%20citt%C3%A0.nc"
+        )
+
+    def test_throttled_extraction(self, app: Flask) -> None:
+        db = sqlalchemy.get_instance()
+        user = db.User.query.filter_by(email=BaseAuthentication.default_user).first()
+        requests = [
+            db.Request(
+                name="test",
+                dataset_name=params.DATASET_VHR,
+                args={},
+                user_id=user.id,
+                status=status,
+            )
+            for status in ["STARTED"] * MAX_RUNNING_REQUESTS_PER_USER + ["CREATED"]
+        ]
+        db.session.add_all(requests)
+        db.session.commit()
+        throttled = requests[-1]
+
+        # the task is retried later instead of failing
+        with pytest.raises(Retry):
+            self.send_task(
+                app, "extract_data", user.id, params.DATASET_VHR, {}, throttled.id
+            )
+        db.session.refresh(throttled)
+        assert throttled.status == "CREATED"
+
+        # the request starts once a running request of the user ends
+        requests[0].status = "SUCCESS"
+        db.session.commit()
+        assert start_request(db, user.id, throttled.id)
+        db.session.refresh(throttled)
+        assert throttled.status == "STARTED"
+
+        for request in requests:
+            db.session.delete(request)
+        db.session.commit()
+
+    def test_retrieve_by_year(self, app: Flask) -> None:
+        retrieved = []
+
+        class FakeBroker:
+            def retrieve(self, dataset_name: str, request: Dict[str, Any]) -> str:
+                retrieved.append(request)
+                part = DOWNLOAD_DIR.joinpath(f"part-{len(retrieved)}.nc")
+                part.write_bytes(b"data")
+                # the request is cancelled while the first year is retrieved
+                cancel_flag.set(cancellation_key(request_id), 1)
+                return str(part)
+
+        class FakeDDS:
+            broker = FakeBroker()
+
+        request_id = 0
+        cancel_flag = redis.get_instance().r
+        cancel_flag.delete(cancellation_key(request_id))
+        req_body = {"time": {"year": ["2000", "2001"], "month": ["1"]}}
+        with pytest.raises(RequestCancelled):
+            retrieve_by_year(FakeDDS(), params.DATASET_VHR, req_body, request_id)
+        cancel_flag.delete(cancellation_key(request_id))
+        # the data are retrieved a year at a time
+        assert len(retrieved) == 1
+        assert retrieved[0]["time"] == {"year": ["2000"], "month": ["1"]}
+        assert retrieved[0]["format"] == "netcdf"
+        # the partial output is removed
+        assert not DOWNLOAD_DIR.joinpath("part-1.nc").exists()
+
     @pytest.fixture
     def headers(self, client: FlaskClient) -> Optional[Dict[str, str]]:
         """login: default user"""
@@ -97,7 +522,10 @@ def data_request(
         db = sqlalchemy.get_instance()
         db_request = db.Request.query.filter_by(task_id=task_id).first()
         assert db_request is not None
-        assert db_request.status == "PENDING"
+        # the task can be already running
+        assert db_request.status in ("PENDING", "STARTED", "SUCCESS")
+        # the request is routed by its size
+        assert db_request.queue in ("small", "large")
         yield db_request
 
         # teardown test request
@@ -0,0 +1,46 @@
+from faker import Faker
+from restapi.tests import API_URI, BaseTests, FlaskClient
+
+ADMINISTRATIVE = "regions"
+
+
+class TestApp(BaseTests):
+    def test_boundary_tiles(self, client: FlaskClient, faker: Faker) -> None:
+
+        # unknown administrative level
+        endpoint = f"{API_URI}/tiles/{faker.pystr()}/0/0/0.mvt"
+        r = client.get(endpoint)
+        assert r.status_code == 404
+
+        # tile out of the zoom level
+        endpoint = f"{API_URI}/tiles/{ADMINISTRATIVE}/2/4/0.mvt"
+        r = client.get(endpoint)
+        assert r.status_code == 400
+
+        # zoom over the max zoom
+        endpoint = f"{API_URI}/tiles/{ADMINISTRATIVE}/20/0/0.mvt"
+        r = client.get(endpoint)
+        assert r.status_code == 400
+
+        # the tile covering the world
+        endpoint = f"{API_URI}/tiles/{ADMINISTRATIVE}/0/0/0.mvt"
+        r = client.get(endpoint)
+        assert r.status_code == 200
+        assert r.mimetype == "application/vnd.mapbox-vector-tile"
+        assert r.data
+        etag = r.headers["ETag"]
+
+        # the tile is not sent again if not modified
+        r = client.get(endpoint, headers={"If-None-Match": etag})
+        assert r.status_code == 304
+
+        # a tile over Italy is compressed if requested
+        endpoint = f"{API_URI}/tiles/{ADMINISTRATIVE}/6/34/23.mvt"
+        r = client.get(endpoint, headers={"Accept-Encoding": "gzip"})
+        assert r.status_code == 200
+        assert r.headers["Content-Encoding"] == "gzip"
+
+        # a tile without boundaries (in the Pacific ocean)
+        endpoint = f"{API_URI}/tiles/{ADMINISTRATIVE}/6/0/32.mvt"
+        r = client.get(endpoint)
+        assert r.status_code == 204
@@ -1,5 +1,8 @@
 from typing import Any, Dict
 
+from flask import Flask
+from restapi.connectors import sqlalchemy
+from restapi.services.authentication import BaseAuthentication
 from restapi.tests import API_URI, BaseTests, FlaskClient
 
 __author__ = "Giuseppe Trotta (g.trotta@cineca.it)"
@@ -25,3 +28,23 @@ def test_usage(self, client: FlaskClient) -> None:
         assert isinstance(response_body["quota"], int)
         assert isinstance(response_body["used"], int)
         assert response_body["quota"] >= response_body["used"]
+
+    def test_usage_reconciliation(self, client: FlaskClient, app: Flask) -> None:
+        headers, _ = self.do_login(client, None, None)
+        r = client.get(f"{API_URI}/usage", headers=headers)
+        assert r.status_code == 200
+        used = self.get_content(r)["used"]
+
+        # make the counter drift
+        db = sqlalchemy.get_instance()
+        user = db.User.query.filter_by(email=BaseAuthentication.default_user).first()
+        user.used_bytes = used + 1024
+        db.session.commit()
+        r = client.get(f"{API_URI}/usage", headers=headers)
+        assert self.get_content(r)["used"] == used + 1024
+
+        # the counter is realigned with the output files
+        fixed = self.send_task(app, "reconcile_usage")
+        assert fixed >= 1
+        r = client.get(f"{API_URI}/usage", headers=headers)
+        assert self.get_content(r)["used"] == used
@@ -0,0 +1,74 @@
+"""
+Disk usage of the users.
+The used_bytes counter of each user is kept in sync with the sizes of the user
+output files, within the same transaction that creates or deletes them
+"""
+from typing import Any, List
+
+from highlander.exceptions import DiskQuotaException
+from restapi.utilities.logs import log
+from sqlalchemy.sql import func
+
+
+def human_size(
+    bytes: int, units: List[str] = [" bytes", "KB", "MB", "GB", "TB", "PB", "EB"]
+) -> str:
+    """Returns a human-readable string representation of bytes
+    :rtype: string
+    """
+    return str(bytes) + units[0] if bytes < 1024 else human_size(bytes >> 10, units[1:])
+
+
+def get_used_bytes(db: Any, user_id: int) -> int:
+    return db.session.query(db.User.used_bytes).filter_by(id=user_id).scalar() or 0
+
+
+def check_quota(db: Any, user_id: int, size_estimate: int) -> None:
+    """
+    Raise a DiskQuotaException if an output of the estimated size
+    exceeds the remaining quota of the user
+    """
+    log.debug("DATA SIZE ESTIMATE: {}", size_estimate)
+    user_quota = db.session.query(db.User.disk_quota).filter_by(id=user_id).scalar()
+    log.debug("USER QUOTA for user<{}>: {}", user_id, user_quota)
+    used_quota = get_used_bytes(db, user_id)
+    log.debug("USED QUOTA: {}", used_quota)
+    if used_quota + size_estimate > user_quota:
+        free_space = max(user_quota - used_quota, 0)
+        raise DiskQuotaException(
+            "Disk quota exceeded: required size {}; remaining space {}".format(
+                human_size(size_estimate), human_size(free_space)
+            )
+        )
+
+
+def update_used_bytes(db: Any, user_id: int, delta: int) -> None:
+    """
+    Add delta (negative for removed files) to the used bytes of a user.
+    The increment is computed by the database to be safe with concurrent tasks
+    """
+    if not delta:
+        return
+    db.session.query(db.User).filter(db.User.id == user_id).update(
+        {db.User.used_bytes: func.greatest(db.User.used_bytes + delta, 0)},
+        synchronize_session=False,
+    )
+
+
+def reconcile_used_bytes(db: Any) -> int:
+    """
+    Realign the used bytes of all the users with the sizes of their output files.
+    Returns the number of fixed counters
+    """
+    total_used = (
+        db.session.query(func.coalesce(func.sum(db.OutputFile.size), 0))
+        .join(db.Request, db.OutputFile.request_id == db.Request.id)
+        .filter(db.Request.user_id == db.User.id)
+        .correlate(db.User)
+        .scalar_subquery()
+    )
+    return (
+        db.session.query(db.User)
+        .filter(db.User.used_bytes.is_distinct_from(total_used))
+        .update({db.User.used_bytes: total_used}, synchronize_session=False)
+    )
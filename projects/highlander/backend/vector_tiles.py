@@ -0,0 +1,183 @@
+"""
+Mapbox vector tiles (MVT) of the administrative boundaries.
+The tiles are built from the same geojson assets used to crop the maps
+(italy-<administrative>.json): the areas are projected once in web mercator,
+then each tile gets the areas intersecting it, clipped to the tile and
+simplified to the pixel size of its zoom level.
+The tiles are stored in TILES_DIR and rebuilt when the geojson changes,
+the empty tiles are stored as empty files.
+"""
+import math
+import threading
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Tuple
+
+import geopandas as gpd
+import mapbox_vector_tile
+import numpy as np
+from highlander.constants import CATALOG_DIR
+from highlander.endpoints.utils import MapCropConfig
+from highlander.static_assets import is_fresh, write_atomic
+from restapi.utilities.logs import log
+from shapely.geometry import MultiPolygon, Polygon, box
+
+TILES_DIR = CATALOG_DIR.joinpath("tiles")
+MAX_ZOOM = 14
+# the tiles are precomputed up to this zoom, the others are built on request
+PRECOMPUTED_MAX_ZOOM = 9
+EXTENT = 4096
+# the geometries exceeding the tile borders avoid artifacts at the edges
+BUFFER = 64
+# half of the side of the web mercator square
+ORIGIN = 20037508.342789244
+
+Bounds = Tuple[float, float, float, float]
+
+
+def get_geojson_path(administrative: str) -> Path:
+    return Path(MapCropConfig.GEOJSON_PATH, f"italy-{administrative}.json")
+
+
+def get_tile_path(administrative: str, z: int, x: int, y: int) -> Path:
+    return TILES_DIR.joinpath(administrative, str(z), str(x), f"{y}.mvt")
+
+
+def tile_bounds(z: int, x: int, y: int) -> Bounds:
+    size = 2 * ORIGIN / 2**z
+    west = -ORIGIN + x * size
+    north = ORIGIN - y * size
+    return west, north - size, west + size, north
+
+
+def is_valid_tile(z: int, x: int, y: int) -> bool:
+    return 0 <= z <= MAX_ZOOM and 0 <= x < 2**z and 0 <= y < 2**z
+
+
+def get_tiles(bounds: Bounds, z: int) -> Iterator[Tuple[int, int]]:
+    """
+    Tiles of a zoom level covering the bounds
+    """
+    size = 2 * ORIGIN / 2**z
+    west, south, east, north = bounds
+    last = 2**z - 1
+    x_range = (math.floor((west + ORIGIN) / size), math.floor((east + ORIGIN) / size))
+    y_range = (
+        math.floor((ORIGIN - north) / size),
+        math.floor((ORIGIN - south) / size),
+    )
+    for x in range(max(x_range[0], 0), min(x_range[1], last) + 1):
+        for y in range(max(y_range[0], 0), min(y_range[1], last) + 1):
+            yield x, y
+
+
+def get_polygons(geometry: Any) -> Any:
+    """
+    Polygonal part of a clipped geometry (the clipping can add lines and points)
+    """
+    if isinstance(geometry, (Polygon, MultiPolygon)):
+        return geometry
+    polygons = [g for g in getattr(geometry, "geoms", []) if isinstance(g, Polygon)]
+    return MultiPolygon(polygons) if polygons else None
+
+
+def to_property(value: Any) -> Any:
+    if isinstance(value, np.generic):
+        value = value.item()
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return None
+    return value if isinstance(value, (str, int, float, bool)) else str(value)
+
+
+class BoundaryLayer:
+    """
+    Areas of an administrative level in web mercator
+    """
+
+    def __init__(self, administrative: str, mtime_ns: int) -> None:
+        self.name = administrative
+        self.mtime_ns = mtime_ns
+        areas = gpd.read_file(get_geojson_path(administrative)).to_crs(epsg=3857)
+        self.geometries = list(areas.geometry)
+        self.bounds = areas.geometry.bounds.to_numpy()
+        self.total_bounds: Bounds = tuple(areas.total_bounds)
+        self.properties: List[Dict[str, Any]] = [
+            {k: p for k, v in row.items() if (p := to_property(v)) is not None}
+            for row in areas.drop(columns="geometry").to_dict("records")
+        ]
+
+    def build_tile(self, z: int, x: int, y: int) -> bytes:
+        """
+        Encode the areas intersecting a tile. Returns no bytes for an empty tile
+        """
+        bounds = tile_bounds(z, x, y)
+        west, south, east, north = bounds
+        pixel = (east - west) / EXTENT
+        margin = BUFFER * pixel
+        clip_box = box(west - margin, south - margin, east + margin, north + margin)
+        # candidates by bounding box, then clipped to the tile
+        candidates = np.flatnonzero(
+            (self.bounds[:, 0] <= east + margin)
+            & (self.bounds[:, 2] >= west - margin)
+            & (self.bounds[:, 1] <= north + margin)
+            & (self.bounds[:, 3] >= south - margin)
+        )
+        features = []
+        for i in candidates:
+            geometry = get_polygons(self.geometries[i].intersection(clip_box))
+            if geometry is None or geometry.is_empty:
+                continue
+            # the details under the pixel are not visible at this zoom
+            geometry = geometry.simplify(pixel, preserve_topology=True)
+            features.append({"geometry": geometry, "properties": self.properties[i]})
+        if not features:
+            return b""
+        return mapbox_vector_tile.encode(
+            [{"name": self.name, "features": features}],
+            quantize_bounds=bounds,
+            extents=EXTENT,
+        )
+
+
+_layers: Dict[str, BoundaryLayer] = {}
+_lock = threading.Lock()
+
+
+def get_layer(administrative: str) -> BoundaryLayer:
+    """
+    :raises FileNotFoundError: if there is no geojson for the administrative level
+    """
+    mtime_ns = get_geojson_path(administrative).stat().st_mtime_ns
+    with _lock:
+        layer = _layers.get(administrative)
+        if layer is None or layer.mtime_ns != mtime_ns:
+            log.info("Loading the boundaries of {}", administrative)
+            layer = BoundaryLayer(administrative, mtime_ns)
+            _layers[administrative] = layer
+    return layer
+
+
+def get_tile(administrative: str, z: int, x: int, y: int) -> Path:
+    """
+    Path of a tile, built if missing or older than the geojson
+
+    :raises FileNotFoundError: if there is no geojson for the administrative level
+    """
+    tile_path = get_tile_path(administrative, z, x, y)
+    if not is_fresh(tile_path, get_geojson_path(administrative)):
+        layer = get_layer(administrative)
+        write_atomic(tile_path, layer.build_tile(z, x, y))
+    return tile_path
+
+
+def precompute_tiles(administrative: str, max_zoom: int = PRECOMPUTED_MAX_ZOOM) -> int:
+    """
+    Build the tiles covering the boundaries up to a zoom level.
+    Returns the number of tiles
+    """
+    layer = get_layer(administrative)
+    count = 0
+    for z in range(min(max_zoom, MAX_ZOOM) + 1):
+        for x, y in get_tiles(layer.total_bounds, z):
+            get_tile(administrative, z, x, y)
+            count += 1
+    return count